@@ -1,15 +1,39 @@
-from fastapi import APIRouter, HTTPException, Form, Depends
+import json
+import asyncio
+from fastapi import APIRouter, HTTPException, Form, Depends, Query, Request
+from fastapi.responses import StreamingResponse
 from typing import Optional
 from app.models.chat import ChatCreate
 from app.services.chat_service import chat_service
-from app.auth.dependencies import get_current_user
+from app.services.concurrency import AIServiceBusyError
+from app.services.model_router import ROUTING_POLICIES
+from app.auth.dependencies import get_current_user, limit_message_rate
+from app.config import settings
 
 router = APIRouter()
 
+async def run_until_disconnect(request: Request, coro):
+    """
+    执行coro并定期检查客户端是否已断开；断开后取消coro，使上游AI调用立即取消并释放名额
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=settings.CHAT_DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                # 客户端已经离开，状态码只用于日志
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
 @router.post("/", response_model=dict)
 async def create_chat(
     chat_data: ChatCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(limit_message_rate)
 ):
     try:
         # 使用当前用户ID
@@ -19,56 +43,122 @@ async def create_chat(
             chat_data.model_id or "default",
             chat_data.initial_message
         )
-        return {"id": chat_id, "message": "Chat created successfully"}
+        # 初始消息的AI回复在后台生成，完成前获取对话详情时reply_pending为True
+        return {"id": chat_id, "message": "Chat created successfully", "reply_pending": bool(chat_data.initial_message)}
+    except AIServiceBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/{chat_id}", response_model=dict)
-async def get_chat(chat_id: str, current_user: dict = Depends(get_current_user)):
-    chat = await chat_service.get_chat(chat_id)
+async def get_chat(
+    chat_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=200),  # 每页消息数，不指定分页参数时返回全部消息
+    before: Optional[int] = Query(None, ge=1),  # 返回序号小于before的最新一页
+    after: Optional[int] = Query(None, ge=0),  # 返回序号大于after的最早一页
+    current_user: dict = Depends(get_current_user)
+):
+    # 查询条件包含当前用户ID，一次查询同时完成权限验证
+    try:
+        if limit is None and before is None and after is None:
+            chat = await chat_service.get_chat(chat_id, user_id=current_user["_id"])
+        else:
+            chat = await chat_service.get_chat_page(
+                chat_id, limit or settings.CHAT_PAGE_SIZE, before=before, after=after, user_id=current_user["_id"]
+            )
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="You don't have permission to access this chat")
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    # 验证权限
-    if chat["user_id"] != current_user["_id"]:
-        raise HTTPException(status_code=403, detail="You don't have permission to access this chat")
-    
     return chat
 
 @router.post("/{chat_id}/messages", response_model=dict)
 async def add_message(
     chat_id: str,
+    request: Request,
     content: str = Form(...),
-    current_user: dict = Depends(get_current_user)
+    routing_policy: Optional[str] = Form(None),  # 可选：pinned / prefer_fast / fallback_on_error
+    current_user: dict = Depends(limit_message_rate)
 ):
+    if routing_policy and routing_policy not in ROUTING_POLICIES:
+        raise HTTPException(status_code=400, detail=f"routing_policy must be one of {', '.join(ROUTING_POLICIES)}")
+    
     try:
-        # 确认聊天属于当前用户
-        chat = await chat_service.get_chat(chat_id)
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        
-        if chat["user_id"] != current_user["_id"]:
-            raise HTTPException(status_code=403, detail="You don't have permission to access this chat")
-        
-        # 添加消息
-        result = await chat_service.add_message(chat_id, content, files=None)
+        # 添加消息，读取和写入对话时都以当前用户ID为条件验证权限
+        result = await run_until_disconnect(request, chat_service.add_message(
+            chat_id, content, files=None, routing_policy=routing_policy, user_id=current_user["_id"]
+        ))
         return result
+    except HTTPException:
+        raise
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="You don't have permission to access this chat")
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except AIServiceBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/{chat_id}/messages/stream")
+async def add_message_stream(
+    chat_id: str,
+    content: str = Form(...),
+    routing_policy: Optional[str] = Form(None),  # 可选：pinned / prefer_fast / fallback_on_error
+    current_user: dict = Depends(limit_message_rate)
+):
+    """以Server-Sent Events方式发送消息并逐段返回AI回复"""
+    if routing_policy and routing_policy not in ROUTING_POLICIES:
+        raise HTTPException(status_code=400, detail=f"routing_policy must be one of {', '.join(ROUTING_POLICIES)}")
+    
+    events = chat_service.add_message_stream(
+        chat_id, content, files=None, routing_policy=routing_policy, user_id=current_user["_id"]
+    )
+    
+    async def event_stream(start):
+        try:
+            yield f"event: start\ndata: {json.dumps(start, ensure_ascii=False)}\n\n"
+            async for event in events:
+                data = json.dumps(event, ensure_ascii=False, default=str)
+                yield f"event: {event['type']}\ndata: {data}\n\n"
+        except Exception as e:
+            # 推流开始后无法再修改状态码，通过error事件通知客户端
+            status_code = 503 if isinstance(e, AIServiceBusyError) else 500
+            data = json.dumps({"type": "error", "status": status_code, "detail": str(e)}, ensure_ascii=False)
+            yield f"event: error\ndata: {data}\n\n"
+        finally:
+            await events.aclose()
+    
+    # 先取出start事件：对话不存在或不属于当前用户时在开始推流之前返回正常的HTTP错误码。
+    # 在交给StreamingResponse之前出错（包括请求被取消）时关闭生成器，立即释放它持有的轮次锁
+    try:
+        start = await events.__anext__()
+        return StreamingResponse(
+            event_stream(start),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no"  # 禁止反向代理缓冲，保证增量及时送达
+            }
+        )
+    except PermissionError:
+        await events.aclose()
+        raise HTTPException(status_code=403, detail="You don't have permission to access this chat")
+    except ValueError as e:
+        await events.aclose()
+        raise HTTPException(status_code=404, detail=str(e))
+    except BaseException:
+        await events.aclose()
+        raise
+
 @router.delete("/{chat_id}")
 async def delete_chat(chat_id: str, current_user: dict = Depends(get_current_user)):
-    # 确认聊天属于当前用户
-    chat = await chat_service.get_chat(chat_id)
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    
-    if chat["user_id"] != current_user["_id"]:
+    # 删除条件包含当前用户ID，只会删除自己的对话
+    try:
+        success = await chat_service.delete_chat(chat_id, user_id=current_user["_id"])
+    except PermissionError:
         raise HTTPException(status_code=403, detail="You don't have permission to delete this chat")
-    
-    success = await chat_service.delete_chat(chat_id)
     if not success:
         raise HTTPException(status_code=404, detail="Chat not found")
     return {"message": "Chat deleted successfully"}
@@ -80,24 +170,22 @@ async def update_chat_title(
     auto_generate: bool = Form(False),  # 新增参数，是否自动生成标题
     current_user: dict = Depends(get_current_user)
 ):
-    # 确认聊天属于当前用户
-    chat = await chat_service.get_chat(chat_id)  # 只需获取基本聊天信息
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    
-    if chat["user_id"] != current_user["_id"]:
-        raise HTTPException(status_code=403, detail="You don't have permission to update this chat")
-    
+    # 读取和更新对话时都以当前用户ID为条件验证权限
     if auto_generate:
-        # 使用AI自动生成标题
+        # 在后台使用AI自动生成标题，立即返回当前标题，新标题在对话列表下次刷新时可见
         try:
-            new_title = await chat_service.generate_title(chat_id)
-            return {"message": "Chat title updated successfully", "title": new_title}
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to generate title: {str(e)}")
+            result = await chat_service.request_title(chat_id, user_id=current_user["_id"])
+            return {"message": "Chat title generation scheduled", **result}
+        except PermissionError:
+            raise HTTPException(status_code=403, detail="You don't have permission to update this chat")
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
     elif title:
         # 使用提供的标题
-        success = await chat_service.update_chat_title(chat_id, title)
+        try:
+            success = await chat_service.update_chat_title(chat_id, title, user_id=current_user["_id"])
+        except PermissionError:
+            raise HTTPException(status_code=403, detail="You don't have permission to update this chat")
         if not success:
             raise HTTPException(status_code=404, detail="Chat not found")
         return {"message": "Chat title updated successfully", "title": title}
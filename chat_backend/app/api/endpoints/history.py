@@ -1,17 +1,43 @@
 from fastapi import APIRouter, HTTPException, Query, Depends
-from typing import List
+from typing import Optional
 from app.services.chat_service import chat_service
 from app.services.file_service import file_service
 from app.auth.dependencies import get_current_user
+from app.config import settings
 
 router = APIRouter()
 
 @router.get("/user")
-async def get_user_chats(current_user: dict = Depends(get_current_user)):
-    """获取当前用户的所有聊天记录"""
+async def get_user_chats(
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    获取当前用户的聊天记录；
+    指定limit或cursor时按更新时间倒序分页返回，并返回下一页的next_cursor，否则返回全部
+    """
     try:
-        chats = await chat_service.get_user_chats(current_user["_id"])
-        return {"chats": chats}
+        if limit is None and cursor is None:
+            chats = await chat_service.get_user_chats(current_user["_id"])
+            return {"chats": chats}
+        limit = min(limit or settings.CHAT_LIST_PAGE_SIZE, settings.CHAT_LIST_MAX_PAGE_SIZE)
+        return await chat_service.get_user_chats_page(current_user["_id"], limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/search")
+async def search_chats(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """在当前用户的聊天记录中搜索，按相关度返回命中的消息及摘录"""
+    try:
+        hits = await chat_service.search_messages(current_user["_id"], q, limit)
+        return {"query": q, "hits": hits}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -23,15 +49,14 @@ async def export_chat(
 ):
     """导出聊天记录为指定格式"""
     try:
-        # 获取聊天数据
-        chat = await chat_service.get_chat(chat_id)
+        # 获取聊天数据，查询条件包含当前用户ID
+        try:
+            chat = await chat_service.get_chat(chat_id, user_id=current_user["_id"])
+        except PermissionError:
+            raise HTTPException(status_code=403, detail="You don't have permission to export this chat")
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         
-        # 验证权限
-        if chat["user_id"] != current_user["_id"]:
-            raise HTTPException(status_code=403, detail="You don't have permission to export this chat")
-        
         # 导出为指定格式
         file_path = await file_service.export_chat(chat, format)
         
@@ -40,6 +65,8 @@ async def export_chat(
             "file_path": file_path,
             "filename": f"{chat['title']}.{format}".replace(" ", "_")
         }
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Depends
+from app.services.ai_service import ai_service
+from app.services.chat_service import chat_service
+from app.services.shared_state import shared_backend
+from app.database import db
+from app.indexes import index_drift
+from app.auth.dependencies import get_admin_user
+
+router = APIRouter()
+
+@router.get("/ai")
+async def get_ai_metrics(current_user: dict = Depends(get_admin_user)):
+    """获取AI调用的并发、排队等实时指标"""
+    return ai_service.get_metrics()
+
+@router.get("/chats")
+async def get_chat_metrics(current_user: dict = Depends(get_admin_user)):
+    """获取对话上下文缓存的命中率等指标"""
+    return chat_service.get_metrics()
+
+@router.get("/shared")
+async def get_shared_state_metrics(current_user: dict = Depends(get_admin_user)):
+    """获取共享缓存后端的状态"""
+    return shared_backend.stats()
+
+@router.get("/indexes")
+async def get_index_drift(current_user: dict = Depends(get_admin_user)):
+    """比对索引清单与数据库中的实际索引（与python -m app.indexes的输出相同）"""
+    return await index_drift(db.db)
@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from app.api.endpoints import chat, history, files,auth
+from app.api.endpoints import chat, history, files,auth, metrics
 
 
 api_router = APIRouter()
@@ -7,4 +7,5 @@ api_router = APIRouter()
 api_router.include_router(chat.router, prefix="/chats", tags=["chats"])
 api_router.include_router(history.router, prefix="/history", tags=["history"])
 api_router.include_router(files.router, prefix="/files", tags=["files"])
-api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
\ No newline at end of file
+api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
+api_router.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
\ No newline at end of file
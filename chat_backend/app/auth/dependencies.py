@@ -1,8 +1,10 @@
+import time
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer
 from jwt import PyJWTError, decode
 from app.config import settings
 from app.services.user_service import user_service
+from app.services.shared_state import shared_backend
 
 # 使用HTTPBearer来处理Bearer令牌
 security = HTTPBearer(
@@ -30,4 +32,29 @@ async def get_current_user(credentials = Depends(security)):
     if user is None:
         raise credentials_exception
     
-    return user
\ No newline at end of file
+    return user
+
+async def limit_message_rate(current_user: dict = Depends(get_current_user)):
+    """按用户限制每分钟发送的消息数，多进程部署时计数保存在共享后端中"""
+    limit = settings.RATE_LIMIT_MESSAGES_PER_MINUTE
+    if limit <= 0:
+        return current_user
+    
+    now = int(time.time())
+    count = await shared_backend.incr(f"rate:messages:{current_user['_id']}:{now // 60}", ttl=60)
+    if count > limit:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many messages, please try again later",
+            headers={"Retry-After": str(60 - now % 60)},
+        )
+    return current_user
+
+async def get_admin_user(current_user: dict = Depends(get_current_user)):
+    """只允许METRICS_ADMIN_USERS中的用户访问运维接口"""
+    if current_user.get("username") not in settings.METRICS_ADMIN_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return current_user
@@ -16,17 +16,149 @@ class Settings:
     # 数据库配置
     MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
     DATABASE_NAME = os.getenv("DATABASE_NAME", "chat_app")
+    DB_ENSURE_INDEXES = os.getenv("DB_ENSURE_INDEXES", "true").lower() == "true"  # 启动时按索引清单创建索引
+    DB_INDEX_BUILD_BLOCKING = os.getenv("DB_INDEX_BUILD_BLOCKING", "false").lower() == "true"  # 是否等待索引创建完成再启动
     
     # 智谱AI模型配置 - 只需要一个API KEY
     AI_API_KEY = os.getenv("AI_API_KEY")
     
     # 智谱AI模型配置
+    # 值可以写成"provider:模型名"指定provider，例如"mock:glm-4"；未指定时使用AI_PROVIDER
     AI_MODELS = {
         "default": "glm-4",  # 默认使用GLM-4
         "1": "glm-4",        # 对应用户请求中的model_id="1"
         "2": "glm-3-turbo",  # 可以添加其他模型
         "advanced": "glm-4-vision"  # 支持图像的模型
     }
+    AI_PROVIDER = os.getenv("AI_PROVIDER", "zhipu")  # 默认provider，压测时设为mock即可不访问网络
+    
+    # 模拟provider配置（AI_PROVIDER=mock时生效）
+    MOCK_AI_TTFT_MEDIAN = float(os.getenv("MOCK_AI_TTFT_MEDIAN", "0.3"))  # 首个token延迟的中位数（秒）
+    MOCK_AI_TTFT_SIGMA = float(os.getenv("MOCK_AI_TTFT_SIGMA", "0.5"))  # 首个token延迟对数正态分布的sigma
+    MOCK_AI_TOKENS_PER_SECOND = float(os.getenv("MOCK_AI_TOKENS_PER_SECOND", "50"))
+    MOCK_AI_RESPONSE_TOKENS = int(os.getenv("MOCK_AI_RESPONSE_TOKENS", "120"))
+    MOCK_AI_ERROR_RATE = float(os.getenv("MOCK_AI_ERROR_RATE", "0"))  # 注入错误的比例
+    MOCK_AI_ERROR_STATUS = int(os.getenv("MOCK_AI_ERROR_STATUS", "503"))  # 注入错误的状态码，0表示模拟网络错误
+    MOCK_AI_SEED = int(os.getenv("MOCK_AI_SEED")) if os.getenv("MOCK_AI_SEED") else None
+    
+    # 默认的system提示词
+    AI_SYSTEM_PROMPT = os.getenv("AI_SYSTEM_PROMPT", "你是一个有用的AI助手。")
+    
+    # 上下文窗口配置：每轮发送给模型的token预算，超出预算的较早轮次不再发送
+    AI_CONTEXT_TOKEN_BUDGET = {
+        "default": int(os.getenv("AI_CONTEXT_TOKEN_BUDGET", "6000")),
+        "glm-3-turbo": int(os.getenv("AI_GLM3_TURBO_CONTEXT_TOKEN_BUDGET", "4000")),
+    }
+    AI_CONTEXT_RESPONSE_RESERVE = int(os.getenv("AI_CONTEXT_RESPONSE_RESERVE", "1024"))  # 为模型回复预留的token数
+    AI_CONTEXT_MAX_MESSAGES = int(os.getenv("AI_CONTEXT_MAX_MESSAGES", "100"))  # 构造上下文时最多读取的最近消息数
+    AI_CONTEXT_MAX_MESSAGE_TOKENS = int(os.getenv("AI_CONTEXT_MAX_MESSAGE_TOKENS", "2000"))  # 单条消息超过该长度时省略中间部分
+    # token估算系数：每个中日韩字符/其他字符约折合的token数
+    AI_TOKEN_RATES = {
+        "default": {"cjk": 0.7, "other": 0.3},
+        "glm-3-turbo": {"cjk": 0.75, "other": 0.3},
+    }
+    
+    # 滚动摘要配置：滑出上下文窗口的较早轮次在后台增量合并为摘要
+    AI_SUMMARY_ENABLED = os.getenv("AI_SUMMARY_ENABLED", "true").lower() == "true"
+    AI_SUMMARY_MODEL_ID = os.getenv("AI_SUMMARY_MODEL_ID", "2")  # 生成摘要使用的model_id
+    AI_SUMMARY_MIN_MESSAGES = int(os.getenv("AI_SUMMARY_MIN_MESSAGES", "4"))  # 至少积累多少条未摘要的消息才更新
+    AI_SUMMARY_BATCH_MESSAGES = int(os.getenv("AI_SUMMARY_BATCH_MESSAGES", "40"))  # 每次最多合并的消息数
+    AI_SUMMARY_MAX_CHARS = int(os.getenv("AI_SUMMARY_MAX_CHARS", "500"))
+    
+    # AI回复缓存：相同模型、消息和采样参数的调用直接返回缓存结果；只对调用方显式启用缓存的请求（标题、摘要、新对话的初始回复）生效
+    AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "true").lower() == "true"
+    AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "1000"))  # 进程内缓存条数上限
+    AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "3600"))  # 缓存有效期（秒）
+    AI_CACHE_SHARED = os.getenv("AI_CACHE_SHARED", "false").lower() == "true"  # 是否启用MongoDB共享缓存
+    
+    # 失败重试：对网络错误、超时、429和5xx按带抖动的指数退避重试
+    AI_RETRY_MAX_ATTEMPTS = int(os.getenv("AI_RETRY_MAX_ATTEMPTS", "3"))  # 包含首次调用在内的最多尝试次数
+    AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", "0.5"))
+    AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", "8"))
+    
+    # 对冲请求：调用耗时超过近期P95仍未返回时，再发起一次相同请求，取先返回的结果
+    AI_HEDGE_ENABLED = os.getenv("AI_HEDGE_ENABLED", "false").lower() == "true"
+    AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "95"))
+    AI_HEDGE_MIN_SAMPLES = int(os.getenv("AI_HEDGE_MIN_SAMPLES", "20"))  # 样本数不足时不发起对冲
+    AI_LATENCY_WINDOW = int(os.getenv("AI_LATENCY_WINDOW", "200"))  # 统计延迟分位数的最近调用数
+    
+    # 熔断器：连续失败的调用数达到阈值后在冷却时间内快速失败（一次调用的多次重试只计一次失败）
+    AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "5"))
+    AI_BREAKER_RESET_TIMEOUT = float(os.getenv("AI_BREAKER_RESET_TIMEOUT", "30"))  # 冷却时间（秒）
+    
+    # 模型路由：根据近期延迟和错误率在模型之间切换
+    AI_ROUTING_POLICY = os.getenv("AI_ROUTING_POLICY", "pinned")  # 默认策略：pinned / prefer_fast / fallback_on_error
+    AI_BACKGROUND_ROUTING_POLICY = os.getenv("AI_BACKGROUND_ROUTING_POLICY", "prefer_fast")  # 标题、摘要等非关键调用使用的策略
+    AI_FALLBACK_MODELS = {  # 每个模型的备用模型，按顺序尝试
+        "glm-4": ["glm-3-turbo"],
+        "glm-4-vision": ["glm-4"],
+    }
+    AI_ROUTER_SLOW_P95 = float(os.getenv("AI_ROUTER_SLOW_P95", "20"))  # P95延迟超过该值（秒）视为变慢
+    AI_ROUTER_MAX_ERROR_RATE = float(os.getenv("AI_ROUTER_MAX_ERROR_RATE", "0.2"))  # 错误率超过该值视为异常
+    AI_ROUTER_MIN_SAMPLES = int(os.getenv("AI_ROUTER_MIN_SAMPLES", "10"))  # 样本数不足时不做判断
+    AI_ROUTER_ERROR_WINDOW = int(os.getenv("AI_ROUTER_ERROR_WINDOW", "50"))  # 统计错误率的最近调用数
+    
+    # 智谱AI HTTP客户端配置（基于连接池的异步客户端）
+    AI_BASE_URL = os.getenv("AI_BASE_URL", "https://open.bigmodel.cn/api/paas/v4")
+    AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100"))  # 连接池总连接数
+    AI_HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("AI_HTTP_MAX_CONNECTIONS_PER_HOST", "50"))
+    AI_HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("AI_HTTP_KEEPALIVE_TIMEOUT", "60"))  # 空闲长连接保留时间（秒）
+    AI_HTTP_CONNECT_TIMEOUT = float(os.getenv("AI_HTTP_CONNECT_TIMEOUT", "10"))
+    AI_HTTP_READ_TIMEOUT = float(os.getenv("AI_HTTP_READ_TIMEOUT", "60"))  # 流式响应两个数据块之间的最长等待
+    AI_HTTP_TIMEOUT = float(os.getenv("AI_HTTP_TIMEOUT", "120"))  # 非流式请求整体超时
+    
+    # 模型并发限制：每个模型同时进行的调用数上限，超出部分进入有界队列排队
+    AI_MAX_CONCURRENCY_PER_MODEL = int(os.getenv("AI_MAX_CONCURRENCY_PER_MODEL", "20"))
+    AI_MODEL_CONCURRENCY = {  # 按模型名单独设置的上限，未列出的模型使用上面的默认值
+        "glm-4": int(os.getenv("AI_GLM4_CONCURRENCY", "20")),
+        "glm-3-turbo": int(os.getenv("AI_GLM3_TURBO_CONCURRENCY", "40")),
+    }
+    AI_QUEUE_MAX_SIZE = int(os.getenv("AI_QUEUE_MAX_SIZE", "100"))  # 每个模型的排队上限，超过后直接返回503
+    AI_QUEUE_MAX_WAIT = float(os.getenv("AI_QUEUE_MAX_WAIT", "30"))  # 排队最长等待时间（秒）
+    
+    # 调用优先级：interactive（用户等待中的回复）> background（标题、摘要）> batch（批量任务）
+    AI_INTERACTIVE_RESERVED_RATIO = float(os.getenv("AI_INTERACTIVE_RESERVED_RATIO", "0.25"))  # 每个模型只给interactive使用的名额比例
+    AI_PRIORITY_WEIGHTS = {  # background和batch争用剩余名额时的权重
+        "background": float(os.getenv("AI_BACKGROUND_WEIGHT", "3")),
+        "batch": float(os.getenv("AI_BATCH_WEIGHT", "1")),
+    }
+    AI_PRIORITY_AGING = float(os.getenv("AI_PRIORITY_AGING", "10"))  # 后台请求排队超过该时间（秒）后与interactive按先后竞争
+    
+    # 对话消息分页的默认每页条数
+    CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "50"))
+    # 对话列表分页的默认每页条数和上限
+    CHAT_LIST_PAGE_SIZE = int(os.getenv("CHAT_LIST_PAGE_SIZE", "20"))
+    CHAT_LIST_MAX_PAGE_SIZE = int(os.getenv("CHAT_LIST_MAX_PAGE_SIZE", "100"))
+    # 活跃对话的上下文缓存（进程内），按估算的内存占用限制大小；多进程部署时通过共享后端广播失效消息
+    CHAT_CONTEXT_CACHE_ENABLED = os.getenv("CHAT_CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+    CHAT_CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CONTEXT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    # 多进程共享的缓存和协调后端（Redis协议），例如redis://localhost:6379/0；为空时只在进程内生效
+    SHARED_BACKEND_URL = os.getenv("SHARED_BACKEND_URL", "")
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # 鉴权时用户信息的缓存时间（秒），0表示不缓存
+    RATE_LIMIT_MESSAGES_PER_MINUTE = int(os.getenv("RATE_LIMIT_MESSAGES_PER_MINUTE", "0"))  # 每个用户每分钟可发送的消息数，0表示不限制
+    # 可以访问/metrics下运维接口的用户名，逗号分隔；为空时所有用户都不能访问（索引差异也可以用python -m app.indexes查看）
+    METRICS_ADMIN_USERS = [name.strip() for name in os.getenv("METRICS_ADMIN_USERS", "").split(",") if name.strip()]
+    
+    # 聊天记录搜索：每条消息最多保存的索引词数（0表示不限制，设置上限后超出部分的内容搜索不到）、
+    # 每次搜索最多读取的候选消息数（取最新的消息）
+    SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "0"))
+    SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "200"))
+    
+    # 客户端在AI生成过程中断开连接时：取消上游调用；流式接口是否保存已生成的部分回复
+    CHAT_SAVE_PARTIAL_ON_DISCONNECT = os.getenv("CHAT_SAVE_PARTIAL_ON_DISCONNECT", "false").lower() == "true"
+    CHAT_DISCONNECT_POLL_INTERVAL = float(os.getenv("CHAT_DISCONNECT_POLL_INTERVAL", "0.5"))  # 非流式接口检测断开的间隔（秒）
+    # 新对话的初始回复由其他进程生成时，发送到本进程的消息最多等待它写入的时间（秒）
+    CHAT_INITIAL_REPLY_WAIT = float(os.getenv("CHAT_INITIAL_REPLY_WAIT", "120"))
+    
+    # 对话标题：第一轮对话后自动在后台生成，使用较便宜的模型
+    CHAT_TITLE_AUTO_GENERATE = os.getenv("CHAT_TITLE_AUTO_GENERATE", "true").lower() == "true"
+    CHAT_TITLE_MODEL_ID = os.getenv("CHAT_TITLE_MODEL_ID", "2")
+    # 首次生成标题时优先从用户的第一条消息中本地抽取，抽取不出时才调用AI
+    CHAT_TITLE_LOCAL_ENABLED = os.getenv("CHAT_TITLE_LOCAL_ENABLED", "true").lower() == "true"
+    CHAT_TITLE_MAX_LENGTH = int(os.getenv("CHAT_TITLE_MAX_LENGTH", "20"))
+    
+    # 对话列表中最后一条消息预览的最大长度
+    CHAT_PREVIEW_LENGTH = int(os.getenv("CHAT_PREVIEW_LENGTH", "200"))
     
     # 文件配置
     UPLOAD_DIR = "uploads"
@@ -1,9 +1,12 @@
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from app.config import settings
+from app.indexes import ensure_indexes, index_drift
 
 class Database:
     client = None
     db = None
+    index_task = None
 
     async def connect(self):
         """连接到MongoDB数据库并创建必要的索引"""
@@ -22,20 +25,33 @@ class Database:
             await self.client.admin.command('ping')
             print(f"Connected to MongoDB at {settings.MONGODB_URL}")
             
-            # 创建索引 - 为用户表创建唯一索引
-            if 'users' in await self.db.list_collection_names():
-                # 为用户名和邮箱创建唯一索引
-                await self.db.users.create_index("username", unique=True)
-                await self.db.users.create_index("email", unique=True)
-                print("User indexes created/verified")
+            # 按索引清单创建索引；在后台进行，大集合上建索引不会阻塞启动
+            if settings.DB_ENSURE_INDEXES:
+                if settings.DB_INDEX_BUILD_BLOCKING:
+                    await self._ensure_indexes()
+                else:
+                    self.index_task = asyncio.get_running_loop().create_task(self._ensure_indexes())
             
             return self.db
         except Exception as e:
             print(f"Failed to connect to MongoDB: {e}")
             raise
 
+    async def _ensure_indexes(self):
+        """创建索引清单中的索引，并报告与数据库实际索引的差异"""
+        result = await ensure_indexes(self.db)
+        for failure in result["failed"]:
+            print(f"Failed to create index {failure['collection']}.{failure['name']}: {failure['error']}")
+        print(f"Indexes created/verified: {len(result['created'])}")
+        
+        drift = await index_drift(self.db)
+        if drift["missing"] or drift["mismatched"] or drift["extra"]:
+            print(f"Index drift detected: {drift}")
+    
     async def disconnect(self):
         """关闭MongoDB连接"""
+        if self.index_task and not self.index_task.done():
+            self.index_task.cancel()
         if self.client:
             self.client.close()
             print("Disconnected from MongoDB")
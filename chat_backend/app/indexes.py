@@ -0,0 +1,95 @@
+"""
+MongoDB索引声明：应用启动时按此清单创建索引，并可与数据库中的实际索引比对
+
+检查差异（在后端项目根目录下）：python -m app.indexes [--apply]
+"""
+import asyncio
+import argparse
+from typing import List, Dict, Any, Tuple
+
+class IndexSpec:
+    """一个集合上的一个索引"""
+    def __init__(self, collection: str, keys: List[Tuple[str, Any]], **options: Any):
+        self.collection = collection
+        self.keys = keys
+        self.options = options
+        # 与MongoDB默认的命名规则一致，例如user_id_1_updated_at_-1
+        self.name = options.pop("name", None) or "_".join(f"{field}_{direction}" for field, direction in keys)
+
+    def matches(self, info: Dict[str, Any]) -> bool:
+        """与index_information()返回的索引信息比较键和选项是否一致"""
+        if [(field, direction) for field, direction in info["key"]] != self.keys:
+            return False
+        return all(info.get(option) == value for option, value in self.options.items())
+
+    def describe(self) -> Dict[str, Any]:
+        return {"collection": self.collection, "name": self.name, "keys": self.keys, **self.options}
+
+# 应用依赖的全部索引
+INDEXES: List[IndexSpec] = [
+    # 用户名和邮箱唯一
+    IndexSpec("users", [("username", 1)], unique=True),
+    IndexSpec("users", [("email", 1)], unique=True),
+    # 对话列表：按用户过滤并按(updated_at, _id)倒序分页
+    IndexSpec("chats", [("user_id", 1), ("updated_at", -1), ("_id", -1)]),
+    # 消息按对话和序号读取、分页
+    IndexSpec("messages", [("chat_id", 1), ("seq", 1)], unique=True),
+    # 聊天记录搜索：按用户和索引词查找消息，按时间倒序取候选
+    IndexSpec("messages", [("user_id", 1), ("terms", 1), ("timestamp", -1)]),
+    # AI共享缓存按过期时间自动清理
+    IndexSpec("ai_cache", [("expires_at", 1)], expireAfterSeconds=0),
+]
+
+async def ensure_indexes(database) -> Dict[str, Any]:
+    """
+    创建清单中的全部索引（已存在的索引不会重复创建），返回创建成功和失败的索引
+    """
+    created, failed = [], []
+    for spec in INDEXES:
+        try:
+            await database[spec.collection].create_index(spec.keys, name=spec.name, **spec.options)
+            created.append(spec.name)
+        except Exception as e:
+            # 例如已有数据违反唯一约束、同名索引选项不同等，记录后继续处理其他索引
+            failed.append({"collection": spec.collection, "name": spec.name, "error": str(e)})
+    return {"created": created, "failed": failed}
+
+async def index_drift(database) -> Dict[str, Any]:
+    """
+    比对清单与数据库中的实际索引：
+    missing为缺少的索引，mismatched为同名但键或选项不同的索引，extra为清单之外的索引
+    """
+    missing, mismatched, extra = [], [], []
+    for collection in sorted({spec.collection for spec in INDEXES}):
+        live = await database[collection].index_information()
+        declared = {spec.name: spec for spec in INDEXES if spec.collection == collection}
+        for name, spec in declared.items():
+            if name not in live:
+                missing.append(spec.describe())
+            elif not spec.matches(live[name]):
+                mismatched.append({**spec.describe(), "live": {k: v for k, v in live[name].items() if k != "v"}})
+        for name in live:
+            if name != "_id_" and name not in declared:
+                extra.append({"collection": collection, "name": name})
+    return {"missing": missing, "mismatched": mismatched, "extra": extra}
+
+async def main():
+    from app.database import db, connect_to_mongo, close_mongo_connection
+    from app.config import settings
+
+    parser = argparse.ArgumentParser(description="Check declared MongoDB indexes against the live database")
+    parser.add_argument("--apply", action="store_true", help="创建缺少的索引")
+    args = parser.parse_args()
+
+    # 由本命令自己创建索引，不在连接时后台创建
+    settings.DB_ENSURE_INDEXES = False
+    await connect_to_mongo()
+    try:
+        if args.apply:
+            print(await ensure_indexes(db.db))
+        print(await index_drift(db.db))
+    finally:
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+"""
+回填对话文档上的message_count、last_message_preview、last_message_at字段
+
+用法（在后端项目根目录下）：python -m app.migrations.chat_summaries --batch-size 500 [--only-missing]
+"""
+import asyncio
+import argparse
+from app.database import db, connect_to_mongo, close_mongo_connection
+from app.services.message_store import message_store
+
+async def backfill_chat(chat: dict):
+    """根据消息重新计算单个对话的预览字段"""
+    chat_id = str(chat["_id"])
+    if "messages" in chat:
+        # 尚未迁移的旧格式对话
+        messages = chat["messages"]
+        count = len([m for m in messages if not m.get("hidden", False)])
+        last = messages[-1] if messages else None
+    else:
+        count = await db.db.messages.count_documents({"chat_id": chat_id, "hidden": {"$ne": True}})
+        last = await message_store.get_last(chat_id)
+
+    await db.db.chats.update_one(
+        {"_id": chat["_id"]},
+        {"$set": {"message_count": count, **message_store.preview_fields(last)}}
+    )
+
+async def backfill(batch_size: int, only_missing: bool = False) -> int:
+    """按_id顺序分批处理，返回处理的对话数"""
+    query = {"last_message_preview": {"$exists": False}} if only_missing else {}
+    processed = 0
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        chats = await db.db.chats.find(batch_query, {"messages": 1}).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not chats:
+            break
+        for chat in chats:
+            await backfill_chat(chat)
+        processed += len(chats)
+        last_id = chats[-1]["_id"]
+        print(f"Backfilled {processed} chats")
+    return processed
+
+async def main():
+    parser = argparse.ArgumentParser(description="Backfill denormalized chat list fields")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批处理的对话数")
+    parser.add_argument("--only-missing", action="store_true", help="只处理缺少预览字段的对话")
+    args = parser.parse_args()
+
+    await connect_to_mongo()
+    try:
+        total = await backfill(args.batch_size, args.only_missing)
+        print(f"Done, {total} chats backfilled")
+    finally:
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
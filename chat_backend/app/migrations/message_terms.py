@@ -0,0 +1,46 @@
+"""
+为已有消息回填全文搜索使用的terms字段
+
+用法（在后端项目根目录下）：python -m app.migrations.message_terms --batch-size 1000
+"""
+import asyncio
+import argparse
+from pymongo import UpdateOne
+from app.database import db, connect_to_mongo, close_mongo_connection
+from app.services.message_store import message_store
+
+async def backfill(batch_size: int) -> int:
+    """按_id顺序分批处理缺少terms字段的可见消息，返回处理的消息数"""
+    query = {"terms": {"$exists": False}, "hidden": {"$ne": True}}
+    processed = 0
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        messages = await db.db.messages.find(batch_query, {"content": 1}).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not messages:
+            break
+        await db.db.messages.bulk_write([
+            UpdateOne({"_id": message["_id"]}, {"$set": message_store.search_fields(message)})
+            for message in messages
+        ], ordered=False)
+        processed += len(messages)
+        last_id = messages[-1]["_id"]
+        print(f"Indexed {processed} messages")
+    return processed
+
+async def main():
+    parser = argparse.ArgumentParser(description="Backfill search terms on messages")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批处理的消息数")
+    args = parser.parse_args()
+
+    await connect_to_mongo()
+    try:
+        total = await backfill(args.batch_size)
+        print(f"Done, {total} messages indexed")
+    finally:
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+"""
+将旧格式对话中内嵌的messages数组分批迁移到messages集合
+
+用法（在后端项目根目录下）：python -m app.migrations.messages_to_collection --batch-size 200
+"""
+import asyncio
+import argparse
+from app.database import db, connect_to_mongo, close_mongo_connection
+from app.services.message_store import message_store
+
+async def migrate(batch_size: int) -> int:
+    """按_id顺序分批迁移，可中断后重新执行；返回迁移的对话数"""
+    migrated_chats = 0
+    migrated_messages = 0
+    while True:
+        # 已迁移的对话不再包含messages字段，每批总是从剩余的对话开始
+        chats = await db.db.chats.find({"messages": {"$exists": True}}).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not chats:
+            break
+        for chat in chats:
+            migrated_messages += await message_store.migrate_chat(chat)
+            migrated_chats += 1
+        print(f"Migrated {migrated_chats} chats ({migrated_messages} messages)")
+    return migrated_chats
+
+async def main():
+    parser = argparse.ArgumentParser(description="Move embedded chat messages into the messages collection")
+    parser.add_argument("--batch-size", type=int, default=200, help="每批迁移的对话数")
+    args = parser.parse_args()
+
+    await connect_to_mongo()
+    try:
+        total = await migrate(args.batch_size)
+        print(f"Done, {total} chats migrated")
+    finally:
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,4 +1,4 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional
 from datetime import datetime
 from pydantic import BaseModel, Field
 from app.models.common import PyObjectId
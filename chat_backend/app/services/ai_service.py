@@ -1,46 +1,412 @@
-import zhipuai
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, AsyncIterator
 import os
 import aiofiles
+import time
 import asyncio
+import contextlib
+import math
 from app.config import settings
+from app.services.providers import LLMProvider, ProviderError, create_provider
+from app.services.concurrency import ModelLimiter, AIServiceBusyError
+from app.services.response_cache import ResponseCache, make_cache_key
+from app.services.single_flight import SingleFlight
+from app.services.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, is_retryable
+from app.services.model_router import ModelRouter
+from app.services.shared_state import shared_backend
 
 class AIService:
     def __init__(self):
         self.api_key = settings.AI_API_KEY
         self.models = settings.AI_MODELS
-        # 初始化zhipuai客户端
-        self.client = zhipuai.ZhipuAI(api_key=self.api_key)
+        # provider在首次使用时创建
+        self.providers: Dict[str, LLMProvider] = {}
+        # 每个模型一个并发限制器，多个model_id指向同一模型时共享名额
+        self.limiters: Dict[str, ModelLimiter] = {}
+        # 每个模型的熔断器
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # 按延迟和错误率在模型之间路由
+        self.router = ModelRouter()
+        self.retry_policy = RetryPolicy(
+            settings.AI_RETRY_MAX_ATTEMPTS,
+            settings.AI_RETRY_BASE_DELAY,
+            settings.AI_RETRY_MAX_DELAY
+        )
+        self.counters = {"retries": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0}
+        self.cache = ResponseCache(
+            settings.AI_CACHE_MAX_ENTRIES,
+            settings.AI_CACHE_TTL,
+            shared=settings.AI_CACHE_SHARED
+        )
+        # 合并并发的相同请求
+        self.flights = SingleFlight(shared_backend, lock_ttl=settings.AI_HTTP_TIMEOUT)
+        # 默认采样参数
+        self.params = {"temperature": 0.7}
         
-    async def get_response(self, messages: List[Dict[str, str]], model_id: Optional[str] = None) -> str:
+    async def get_response(
+        self,
+        messages: List[Dict[str, str]],
+        model_id: Optional[str] = None,
+        use_cache: bool = False,
+        policy: Optional[str] = None,
+        priority: str = "interactive"
+    ) -> str:
         """
-        从智谱AI模型获取响应
+        从AI模型获取响应。use_cache=True时使用回复缓存并合并相同请求，只用于标题、摘要、新对话初始回复等可以共享结果的调用，
+        对话回复按采样温度随机生成且不应在用户之间复用，不使用缓存；
+        priority为interactive、background或batch，决定排队时获得名额的先后
+        """
+        result = await self.generate(messages, model_id, use_cache=use_cache, policy=policy, priority=priority)
+        return result["content"]
+    
+    async def generate(
+        self,
+        messages: List[Dict[str, str]],
+        model_id: Optional[str] = None,
+        use_cache: bool = False,
+        policy: Optional[str] = None,
+        priority: str = "interactive"
+    ) -> Dict[str, str]:
+        """
+        按路由策略依次尝试候选模型，返回{"content": 回复内容, "model": 实际提供回复的模型}
         """
-        model = self.models.get(model_id, self.models["default"])
-        
         # 添加system消息（如果需要）
+        self._ensure_system_message(messages)
+        
+        candidates = self.router.candidates(self.resolve_model(model_id), policy)
+        for index, model in enumerate(candidates):
+            try:
+                content = await self._generate_with(model, messages, use_cache, priority)
+                return {"content": content, "model": model}
+            except Exception as e:
+                self._record_rejection(model, e)
+                # 还有备用模型时继续尝试
+                if index == len(candidates) - 1:
+                    raise
+                self.counters["fallbacks"] += 1
+    
+    async def stream_response(
+        self,
+        messages: List[Dict[str, str]],
+        model_id: Optional[str] = None,
+        use_cache: bool = False,
+        policy: Optional[str] = None,
+        priority: str = "interactive"
+    ) -> AsyncIterator[str]:
+        """
+        以流式方式从AI模型获取响应，逐段返回增量内容；命中缓存时一次性返回完整内容
+        """
+        async for event in self.stream_generate(messages, model_id, use_cache=use_cache, policy=policy, priority=priority):
+            if "delta" in event:
+                yield event["delta"]
+    
+    async def stream_generate(
+        self,
+        messages: List[Dict[str, str]],
+        model_id: Optional[str] = None,
+        use_cache: bool = False,
+        policy: Optional[str] = None,
+        priority: str = "interactive"
+    ) -> AsyncIterator[Dict[str, str]]:
+        """
+        以流式方式按路由策略调用模型：先返回{"model": 实际使用的模型}，再逐段返回{"delta": 增量内容}；
+        只有在输出第一段内容之前失败才会改用备用模型
+        """
+        self._ensure_system_message(messages)
+        
+        candidates = self.router.candidates(self.resolve_model(model_id), policy)
+        for index, model in enumerate(candidates):
+            started = False
+            try:
+                async for delta in self._stream_with(model, messages, use_cache, priority):
+                    if not started:
+                        started = True
+                        yield {"model": model}
+                    yield {"delta": delta}
+                if not started:
+                    yield {"model": model}
+                return
+            except Exception as e:
+                self._record_rejection(model, e)
+                if started or index == len(candidates) - 1:
+                    raise
+                self.counters["fallbacks"] += 1
+    
+    async def _generate_with(self, model: str, messages: List[Dict[str, str]], use_cache: bool, priority: str) -> str:
+        """
+        使用指定模型获取回复，先查缓存，并发的相同请求只调用一次上游
+        """
+        if not (use_cache and settings.AI_CACHE_ENABLED):
+            return await self._complete(model, messages, priority)
+        
+        cache_key = make_cache_key(model, messages, self.params)
+        cached = await self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # 结果写入缓存后共享给所有等待者
+        async def complete_and_cache():
+            content = await self._complete(model, messages, priority)
+            await self.cache.set(cache_key, content)
+            return content
+        
+        return await self.flights.do(cache_key, complete_and_cache)
+    
+    async def _stream_with(self, model: str, messages: List[Dict[str, str]], use_cache: bool, priority: str) -> AsyncIterator[str]:
+        """
+        使用指定模型流式获取回复，先查缓存，并发的相同请求共享同一个上游流
+        """
+        if not (use_cache and settings.AI_CACHE_ENABLED):
+            async for delta in self._stream(model, messages, priority):
+                yield delta
+            return
+        
+        cache_key = make_cache_key(model, messages, self.params)
+        cached = await self.cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        async def stream_and_cache():
+            chunks = []
+            async for delta in self._stream(model, messages, priority):
+                chunks.append(delta)
+                yield delta
+            await self.cache.set(cache_key, "".join(chunks))
+        
+        async for delta in self.flights.stream(cache_key, stream_and_cache):
+            yield delta
+    
+    async def _complete(self, model: str, messages: List[Dict[str, str]], priority: str) -> str:
+        """
+        调用一次上游接口：经过熔断检查，对可重试的错误按退避策略重试。
+        熔断按调用计数，全部重试都失败才记一次失败
+        """
+        breaker = self._get_breaker(model)
+        breaker.before_call()
+        try:
+            for attempt in range(self.retry_policy.max_attempts):
+                try:
+                    content = await self._hedged_call(model, messages, priority)
+                except Exception as e:
+                    final = not is_retryable(e) or attempt == self.retry_policy.max_attempts - 1
+                    self._record_error(model, e, final)
+                    if final:
+                        raise self._wrap_error(e)
+                    self.counters["retries"] += 1
+                    await asyncio.sleep(self.retry_policy.delay(attempt))
+                    continue
+                breaker.record_success()
+                return content
+        except BaseException:
+            # 被取消等情况下结束半开状态的探测；已记录成功或失败时没有影响
+            breaker.release()
+            raise
+    
+    async def _hedged_call(self, model: str, messages: List[Dict[str, str]], priority: str) -> str:
+        """
+        发起调用；启用对冲时，若超过近期P95仍未返回且还有空闲名额，再发起一次相同请求并取先成功的结果。
+        返回、出错或调用方被取消时，取消尚未完成的请求，释放它们占用的名额
+        """
+        primary = asyncio.ensure_future(self._timed_call(model, messages, priority))
+        tasks = [primary]
+        try:
+            threshold = self._hedge_threshold(model)
+            if threshold is None:
+                return await primary
+            
+            done, _ = await asyncio.wait({primary}, timeout=threshold)
+            if done or not self._get_limiter(model).has_capacity(priority):
+                return await primary
+            
+            self.counters["hedges"] += 1
+            hedge = asyncio.ensure_future(self._timed_call(model, messages, priority))
+            tasks.append(hedge)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    async def _timed_call(self, model: str, messages: List[Dict[str, str]], priority: str) -> str:
+        """
+        在并发限制内调用上游接口，并记录成功调用的耗时
+        """
+        async with self._get_limiter(model).acquire(priority):
+            start = time.monotonic()
+            provider, model_name = self.get_provider(model)
+            content = await provider.create_completion(model_name, messages, **self.params)
+            self.router.health(model).record_success(time.monotonic() - start)
+            return content
+    
+    async def _stream(self, model: str, messages: List[Dict[str, str]], priority: str) -> AsyncIterator[str]:
+        """
+        在并发限制内以流式方式调用一次上游接口，整个流式输出期间占用一个名额；
+        收到第一段内容之前出现可重试的错误时按退避策略重试，熔断与阻塞调用一样按调用计数。
+        成功后记录等待上游的总耗时（不含调用方处理每段内容的时间），与阻塞调用的耗时可比
+        """
+        breaker = self._get_breaker(model)
+        breaker.before_call()
+        try:
+            for attempt in range(self.retry_policy.max_attempts):
+                started = False
+                elapsed = 0.0
+                try:
+                    provider, model_name = self.get_provider(model)
+                    async with self._get_limiter(model).acquire(priority):
+                        # 调用方提前停止迭代或被取消时立即关闭上游流，释放连接
+                        async with contextlib.aclosing(provider.stream_completion(model_name, messages, **self.params)) as stream:
+                            while True:
+                                start = time.monotonic()
+                                try:
+                                    delta = await stream.__anext__()
+                                except StopAsyncIteration:
+                                    elapsed += time.monotonic() - start
+                                    break
+                                elapsed += time.monotonic() - start
+                                started = True
+                                yield delta
+                except Exception as e:
+                    # 已经向调用方输出内容后无法再重试
+                    final = started or not is_retryable(e) or attempt == self.retry_policy.max_attempts - 1
+                    self._record_error(model, e, final)
+                    if final:
+                        raise self._wrap_error(e)
+                    self.counters["retries"] += 1
+                    await asyncio.sleep(self.retry_policy.delay(attempt))
+                    continue
+                breaker.record_success()
+                self.router.health(model).record_success(elapsed)
+                return
+        except BaseException:
+            breaker.release()
+            raise
+    
+    def _record_error(self, model: str, error: Exception, final: bool = True):
+        """
+        可重试的错误说明上游异常，每次尝试都计入模型错误率，final（不再重试）时计入一次熔断失败；
+        其他上游错误说明服务可达
+        """
+        breaker = self._get_breaker(model)
+        if is_retryable(error):
+            self.router.health(model).record_error()
+            if final:
+                breaker.record_failure()
+        elif isinstance(error, ProviderError):
+            breaker.record_success()
+        else:
+            breaker.release()
+    
+    def _record_rejection(self, model: str, error: Exception):
+        """熔断期间被直接拒绝的调用也计入模型错误率，使路由及时切换到备用模型"""
+        if isinstance(error, CircuitOpenError):
+            self.router.health(model).record_error()
+    
+    def _wrap_error(self, error: Exception) -> Exception:
+        # 排队已满、熔断等错误原样抛出，由接口层返回503
+        if isinstance(error, AIServiceBusyError):
+            return error
+        return Exception(f"调用AI模型失败: {str(error)}")
+    
+    def _hedge_threshold(self, model: str) -> Optional[float]:
+        """发起对冲请求前的等待时间，未启用或样本不足时返回None"""
+        if not settings.AI_HEDGE_ENABLED:
+            return None
+        latency = self.router.health(model).latency
+        if latency.count() < settings.AI_HEDGE_MIN_SAMPLES:
+            return None
+        return latency.percentile(settings.AI_HEDGE_PERCENTILE)
+    
+    def resolve_model(self, model_id: Optional[str]) -> str:
+        """
+        将model_id映射为实际调用的模型名
+        """
+        return self.models.get(model_id, self.models["default"])
+    
+    def get_provider(self, model: str):
+        """
+        根据"provider:模型名"形式的模型配置获取provider实例和实际模型名
+        """
+        if ":" in model:
+            provider_name, model_name = model.split(":", 1)
+        else:
+            provider_name, model_name = settings.AI_PROVIDER, model
+        if provider_name not in self.providers:
+            self.providers[provider_name] = create_provider(provider_name)
+        return self.providers[provider_name], model_name
+    
+    def _ensure_system_message(self, messages: List[Dict[str, str]]) -> None:
+        """
+        如果消息列表中没有system消息，则在开头插入默认的system消息
+        """
         if not any(msg.get("role") == "system" for msg in messages):
             messages.insert(0, {
                 "role": "system", 
-                "content": "你是一个有用的AI助手。"
+                "content": settings.AI_SYSTEM_PROMPT
             })
-        
-        # 由于zhipuai库是同步的，我们需要使用run_in_executor来避免阻塞事件循环
-        loop = asyncio.get_event_loop()
-        try:
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=0.7
-                )
+    
+    def _get_limiter(self, model: str) -> ModelLimiter:
+        """
+        获取指定模型的并发限制器
+        """
+        if model not in self.limiters:
+            max_concurrency = settings.AI_MODEL_CONCURRENCY.get(model, settings.AI_MAX_CONCURRENCY_PER_MODEL)
+            self.limiters[model] = ModelLimiter(
+                model,
+                max_concurrency,
+                settings.AI_QUEUE_MAX_SIZE,
+                settings.AI_QUEUE_MAX_WAIT,
+                reserved=math.ceil(max_concurrency * settings.AI_INTERACTIVE_RESERVED_RATIO),
+                weights=settings.AI_PRIORITY_WEIGHTS,
+                aging=settings.AI_PRIORITY_AGING
             )
-            
-            # 返回内容 - 根据新版API调整返回内容的获取方式
-            return response.choices[0].message.content
-        except Exception as e:
-            raise Exception(f"调用智谱AI失败: {str(e)}")
+        return self.limiters[model]
+    
+    def _get_breaker(self, model: str) -> CircuitBreaker:
+        """
+        获取指定模型的熔断器
+        """
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(
+                model,
+                settings.AI_BREAKER_FAILURE_THRESHOLD,
+                settings.AI_BREAKER_RESET_TIMEOUT
+            )
+        return self.breakers[model]
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        返回AI调用相关的实时指标
+        """
+        models = {}
+        for model in set(self.limiters) | set(self.breakers):
+            models[model] = {
+                "concurrency": self._get_limiter(model).stats(),
+                "breaker": self._get_breaker(model).stats(),
+                "health": self.router.health(model).stats()
+            }
+        return {
+            "models": models,
+            "cache": self.cache.stats(),
+            "single_flight": self.flights.stats(),
+            **self.counters
+        }
+    
+    async def close(self):
+        """
+        关闭底层HTTP连接池
+        """
+        for provider in self.providers.values():
+            await provider.close()
     
     async def process_file(self, file_path: str) -> str:
         """
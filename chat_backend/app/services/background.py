@@ -0,0 +1,50 @@
+import asyncio
+import traceback
+from typing import Coroutine, Dict, Any, Optional, Set
+
+class BackgroundRunner:
+    """
+    在事件循环中运行后台任务：保留任务引用防止被回收，按key去重，并在应用关闭时统一取消
+    """
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+        self._keyed: Dict[str, asyncio.Task] = {}
+
+    def spawn(self, coro: Coroutine, key: Optional[str] = None) -> Optional[asyncio.Task]:
+        """
+        启动后台任务。指定key时，同一key已有任务在运行则不再重复启动，返回None
+        """
+        if key is not None and key in self._keyed:
+            coro.close()
+            return None
+
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        if key is not None:
+            self._keyed[key] = task
+        task.add_done_callback(lambda t: self._on_done(t, key))
+        return task
+
+    def is_running(self, key: str) -> bool:
+        return key in self._keyed
+
+    def _on_done(self, task: asyncio.Task, key: Optional[str]):
+        self._tasks.discard(task)
+        if key is not None and self._keyed.get(key) is task:
+            del self._keyed[key]
+        if not task.cancelled() and task.exception() is not None:
+            exc = task.exception()
+            print(f"Background task {key or task.get_name()} failed: {exc}")
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"running": len(self._tasks)}
+
+    async def shutdown(self):
+        """取消所有仍在运行的后台任务"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+background_runner = BackgroundRunner()
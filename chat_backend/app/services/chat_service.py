@@ -1,87 +1,408 @@
-from typing import List, Dict, Optional, Any
+import json
+import time
+import base64
+import asyncio
+import contextlib
+from typing import List, Dict, Optional, Any, AsyncIterator
 from datetime import datetime,timezone
 from bson import ObjectId
+from app.config import settings
 from app.database import db
-from app.models.chat import Chat, Message
 from app.services.ai_service import ai_service
+from app.services.concurrency import KeyedLock
+from app.services.context_builder import context_builder, estimate_tokens
+from app.services.background import background_runner
+from app.services.message_store import message_store
+from app.services.context_cache import ChatContext, ChatContextCache
+from app.services.shared_state import shared_backend, WORKER_ID
+from app.services.text_search import query_terms, score, snippet
+from app.services.title_extractor import extract_title
+
+# 对话列表使用的字段，预览信息在写入消息时维护
+CHAT_LIST_PROJECTION = {
+    "user_id": 1,
+    "title": 1,
+    "model_id": 1,
+    "created_at": 1,
+    "updated_at": 1,
+    "message_count": 1,
+    "last_message_preview": 1,
+    "last_message_at": 1,
+    "reply_pending": 1
+}
+# 处理一轮对话时需要的对话字段，messages只存在于尚未迁移的旧格式对话中
+CHAT_TURN_PROJECTION = {
+    "user_id": 1,
+    "model_id": 1,
+    "message_seq": 1,
+    "message_count": 1,
+    "title_source": 1,
+    "summary": 1,
+    "summary_until": 1,
+    "reply_pending": 1,
+    "messages": 1
+}
+# 等待其他进程写入初始回复时检查对话文档的间隔（秒）
+INITIAL_REPLY_POLL_INTERVAL = 0.2
+# 对话上下文失效消息的广播频道
+CHAT_INVALIDATION_CHANNEL = "chat-invalidate"
+# 对话列表排序，_id保证updated_at相同时顺序稳定，与(user_id, updated_at, _id)索引一致
+CHAT_LIST_SORT = [("updated_at", -1), ("_id", -1)]
 
 class ChatService:
+    def __init__(self):
+        # 活跃对话的上下文缓存，命中时不需要读取消息；预留序号的一次数据库操作仍然需要，
+        # 它同时校验归属、读取最新的对话字段，并通过序号判断缓存是否落后于其他进程的写入
+        self.context_cache = ChatContextCache(settings.CHAT_CONTEXT_CACHE_MAX_BYTES)
+        # 同一对话的多轮消息在本进程内依次处理，不同对话互不影响
+        self.turn_locks = KeyedLock()
+        self.counters = {"cancelled_turns": 0, "partial_replies_saved": 0, "titles_extracted": 0, "titles_generated": 0, "initial_reply_timeouts": 0}
+        # 其他进程修改对话后，丢弃本进程缓存的上下文
+        self.worker_id = WORKER_ID
+        shared_backend.subscribe(CHAT_INVALIDATION_CHANNEL, self._on_invalidation)
+    
     async def create_chat(self, user_id: str, title: str, model_id: str, initial_message: Optional[str] = None) -> str:
         """
-        创建新的对话
+        创建新的对话并立即返回对话ID；有初始消息时，AI对初始消息的回复在后台生成，
+        生成完成前对话文档上的reply_pending为True
         """
         chat = {
             "user_id": user_id,
             "title": title,
             "model_id": model_id,
-            "messages": [],
+            "message_seq": 0,
+            "message_count": 0,
+            "last_message_preview": "",
+            "last_message_at": None,
             "created_at": datetime.now(timezone.utc),
             "updated_at": datetime.now(timezone.utc)
         }
-        
         if initial_message:
-            # 添加用户的初始消息
-            chat["messages"].append({
-                "role": "user",
-                "content": initial_message,
-                "timestamp": datetime.now(timezone.utc),
-                "hidden":True
-            })
-            
-            # 获取AI回复
-            ai_response = await ai_service.get_response(
-                [{"role": "user", "content": initial_message}],
-                model_id
-            )
-            
-            # 添加AI回复
-            chat["messages"].append({
-                "role": "assistant",
-                "content": ai_response,
-                "timestamp": datetime.now(timezone.utc),
-                "hidden":True
-            })
+            # 初始消息和AI回复的序号在创建时一并预留，之后的消息无论何时发送都排在它们之后
+            chat["message_seq"] = 2
+            chat["reply_pending"] = True
         
         result = await db.db.chats.insert_one(chat)
-        return str(result.inserted_id)
+        chat_id = str(result.inserted_id)
+        if initial_message:
+            model = ai_service.resolve_model(model_id)
+            # 添加用户的初始消息；失败时创建失败，删除对话，避免留下永远reply_pending的对话
+            try:
+                await message_store.insert(chat_id, user_id, [{
+                    "role": "user",
+                    "content": initial_message,
+                    "timestamp": datetime.now(timezone.utc),
+                    "hidden": True,
+                    "tokens": estimate_tokens(initial_message, model),
+                    "seq": 1
+                }], touch=False)
+            except BaseException:
+                await asyncio.shield(db.db.chats.delete_one({"_id": result.inserted_id}))
+                raise
+            # 先取得该对话的轮次锁再交给后台任务，保证之后发送的消息排在初始回复之后
+            await self.turn_locks.acquire(chat_id)
+            task = background_runner.spawn(
+                self._generate_initial_reply(chat_id, user_id, model_id, initial_message),
+                key=f"initial:{chat_id}"
+            )
+            if task is None:
+                self.turn_locks.release(chat_id)
+        return chat_id
     
-    async def get_chat(self, chat_id: str) -> Optional[Dict[str, Any]]:
+    async def _generate_initial_reply(self, chat_id: str, user_id: str, model_id: str, initial_message: str):
         """
-        获取聊天详情
+        在后台获取AI对初始消息的回复并写入预留的序号2；调用前已取得该对话的轮次锁，
+        期间本进程中该对话的新消息排队等待、其他进程中的新消息等待reply_pending被清除，
+        以便它们的上下文包含这条回复，完成后释放
         """
-        chat = await db.db.chats.find_one({"_id": ObjectId(chat_id)})
-        if chat:
-            chat["_id"] = str(chat["_id"])
-            chat["messages"]=[msg for msg in chat["messages"] if not msg.get("hidden",False)]
+        try:
+            try:
+                # 初始回复只取决于初始消息，不包含用户的对话历史，且作为隐藏消息保存：
+                # 大量新对话使用相同的初始消息时共享缓存，并发的相同请求只调用一次上游
+                result = await ai_service.generate(
+                    [{"role": "user", "content": initial_message}],
+                    model_id,
+                    use_cache=True
+                )
+                # 添加AI回复，记录实际提供回复的模型
+                await message_store.insert(chat_id, user_id, [{
+                    "role": "assistant",
+                    "content": result["content"],
+                    "timestamp": datetime.now(timezone.utc),
+                    "hidden": True,
+                    "tokens": estimate_tokens(result["content"], ai_service.resolve_model(model_id)),
+                    "model": result["model"],
+                    "seq": 2
+                }], touch=False)
+                update: Dict[str, Any] = {"$unset": {"reply_pending": ""}}
+            except Exception as e:
+                # 初始回复只是隐藏的设定确认，失败时不影响继续对话，记录原因即可
+                print(f"Initial reply for chat {chat_id} failed: {e}")
+                update = {"$unset": {"reply_pending": ""}, "$set": {"reply_error": str(e)}}
+            except BaseException:
+                # 被取消（例如进程关闭时）同样清除reply_pending，否则其他进程中该对话的每条消息都要等待超时
+                await asyncio.shield(db.db.chats.update_one(
+                    {"_id": ObjectId(chat_id)},
+                    {"$unset": {"reply_pending": ""}, "$set": {"reply_error": "cancelled"}}
+                ))
+                raise
+            await db.db.chats.update_one({"_id": ObjectId(chat_id)}, update)
+            await self._invalidate_context(chat_id)
+        finally:
+            self.turn_locks.release(chat_id)
+    
+    async def get_chat(self, chat_id: str, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        获取聊天详情；指定user_id时只返回该用户的对话，对话属于其他用户时抛出PermissionError
+        """
+        chat = await db.db.chats.find_one(self._chat_filter(chat_id, user_id))
+        if not chat:
+            await self._check_owner_miss(chat_id, user_id)
+            return None
+        chat["_id"] = str(chat["_id"])
+        messages = await self._load_messages(chat)
+        chat["messages"]=[msg for msg in messages if not msg.get("hidden",False)]
         return chat
     
+    async def get_chat_page(
+        self,
+        chat_id: str,
+        limit: int,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        user_id: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        获取聊天详情和一页可见消息，按消息序号翻页，默认返回最新的一页
+        """
+        chat = await db.db.chats.find_one(self._chat_filter(chat_id, user_id))
+        if not chat:
+            await self._check_owner_miss(chat_id, user_id)
+            return None
+        chat["_id"] = str(chat["_id"])
+        
+        if "messages" in chat:
+            # 尚未迁移的旧格式对话在内存中分页
+            messages = [msg for msg in await self._load_messages(chat) if not msg.get("hidden", False)]
+            if after is not None:
+                matched = [msg for msg in messages if msg["seq"] > after]
+                page = {"messages": matched[:limit], "has_more": len(matched) > limit}
+            else:
+                matched = [msg for msg in messages if before is None or msg["seq"] < before]
+                page = {"messages": matched[-limit:], "has_more": len(matched) > limit}
+        else:
+            page = await message_store.get_page(chat_id, limit, before=before, after=after)
+        
+        chat.update(page)
+        return chat
+    
+    def _chat_filter(self, chat_id: str, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        按对话ID查询的条件，指定user_id时在同一次查询中完成归属校验
+        """
+        query: Dict[str, Any] = {"_id": ObjectId(chat_id)}
+        if user_id is not None:
+            query["user_id"] = user_id
+        return query
+    
+    async def _check_owner_miss(self, chat_id: str, user_id: Optional[str] = None):
+        """
+        带user_id的查询或更新没有匹配到对话时调用：对话存在但属于其他用户则抛出PermissionError。
+        只在未命中时多查一次，正常请求仍是一次查询
+        """
+        if user_id is not None and await db.db.chats.find_one({"_id": ObjectId(chat_id)}, {"_id": 1}):
+            raise PermissionError("You don't have permission to access this chat")
+    
     async def get_user_chats(self, user_id: str) -> List[Dict[str, Any]]:
         """
         获取用户的所有聊天
         """
-        cursor = db.db.chats.find({"user_id": user_id}).sort("updated_at", -1)
-        chats = []
+        # 只读取列表需要的字段，不读取任何消息内容
+        cursor = db.db.chats.find({"user_id": user_id}, CHAT_LIST_PROJECTION).sort(CHAT_LIST_SORT)
+        return [self._list_item(chat) async for chat in cursor]
+    
+    async def get_user_chats_page(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        按(updated_at, _id)倒序分页获取用户的聊天，cursor为上一页返回的next_cursor；
+        next_cursor为None表示没有更多
+        """
+        query: Dict[str, Any] = {"user_id": user_id}
+        if cursor:
+            updated_at, last_id = self._decode_cursor(cursor)
+            # 从上一页最后一条之后继续，走(user_id, updated_at, _id)索引，不跳过前面的文档
+            query["$or"] = [
+                {"updated_at": {"$lt": updated_at}},
+                {"updated_at": updated_at, "_id": {"$lt": last_id}}
+            ]
         
-        async for chat in cursor:
-            chat["_id"] = str(chat["_id"])
-            # 只包含最后一条消息作为预览
-            if chat["messages"]:
-                chat["last_message"] = chat["messages"][-1]["content"]
-            else:
-                chat["last_message"] = ""
-            del chat["messages"]  # 不返回完整的消息历史
-            chats.append(chat)
+        # 多取一条判断是否还有更多
+        chats = await db.db.chats.find(query, CHAT_LIST_PROJECTION).sort(CHAT_LIST_SORT).limit(limit + 1).to_list(length=None)
+        next_cursor = None
+        if len(chats) > limit:
+            chats = chats[:limit]
+            next_cursor = self._encode_cursor(chats[-1])
+        return {"chats": [self._list_item(chat) for chat in chats], "next_cursor": next_cursor}
+    
+    async def search_messages(self, user_id: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        """
+        在用户的全部聊天记录中搜索，返回按相关度排序的消息及所在对话和摘录片段
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        
+        candidates = await message_store.search(user_id, terms, settings.SEARCH_MAX_CANDIDATES)
+        for message in candidates:
+            message["score"] = score(message["content"], query, terms)
+        candidates.sort(key=lambda m: (m["score"], m.get("timestamp") or datetime.min), reverse=True)
+        hits = candidates[:limit]
+        
+        # 一次查询取回命中对话的标题
+        chat_ids = list({hit["chat_id"] for hit in hits})
+        titles = {
+            str(chat["_id"]): chat.get("title")
+            async for chat in db.db.chats.find(
+                {"_id": {"$in": [ObjectId(chat_id) for chat_id in chat_ids]}, "user_id": user_id},
+                {"title": 1}
+            )
+        }
+        return [
+            {
+                "chat_id": hit["chat_id"],
+                "chat_title": titles.get(hit["chat_id"]),
+                "seq": hit["seq"],
+                "role": hit["role"],
+                "timestamp": hit.get("timestamp"),
+                "snippet": snippet(hit["content"], query, terms),
+                "score": round(hit["score"], 3)
+            }
+            for hit in hits if hit["chat_id"] in titles
+        ]
+    
+    def _list_item(self, chat: Dict[str, Any]) -> Dict[str, Any]:
+        chat["_id"] = str(chat["_id"])
+        # 只包含最后一条消息作为预览
+        chat["last_message"] = chat.get("last_message_preview") or ""
+        return chat
+    
+    def _encode_cursor(self, chat: Dict[str, Any]) -> str:
+        raw = json.dumps({"u": chat["updated_at"].isoformat(), "i": str(chat["_id"])})
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+    
+    def _decode_cursor(self, cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            data = json.loads(raw)
+            return datetime.fromisoformat(data["u"]), ObjectId(data["i"])
+        except Exception:
+            raise ValueError("Invalid cursor")
+    
+    async def add_message(
+        self,
+        chat_id: str,
+        content: str,
+        files: Optional[List[str]] = None,
+        routing_policy: Optional[str] = None,
+        user_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        添加新消息并获取AI回复，routing_policy为空时使用默认的模型路由策略；
+        指定user_id时只允许向该用户的对话添加消息；同一对话并发发送的消息排队依次处理
+        """
+        async with self.turn_locks.hold(chat_id):
+            chat, user_message, message_history = await self._prepare_turn(chat_id, content, files, user_id)
+            
+            # 获取AI回复；客户端断开时请求被取消，上游调用随之取消，本轮不写入数据库
+            try:
+                result = await ai_service.generate(
+                    message_history,
+                    chat["model_id"],
+                    policy=routing_policy
+                )
+            except asyncio.CancelledError:
+                self.counters["cancelled_turns"] += 1
+                raise
+            
+            return await self._save_turn(chat, user_message, result["content"], result["model"])
+    
+    async def add_message_stream(
+        self,
+        chat_id: str,
+        content: str,
+        files: Optional[List[str]] = None,
+        routing_policy: Optional[str] = None,
+        user_id: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        添加新消息并以流式方式获取AI回复，回复完成后一次性写入数据库；
+        对话校验通过后先产生start事件，之后才开始调用AI；同一对话并发发送的消息排队依次处理
+        """
+        await self.turn_locks.acquire(chat_id)
+        release_lock = True
+        try:
+            chat, user_message, message_history = await self._prepare_turn(chat_id, content, files, user_id)
+            yield {"type": "start", "chat_id": chat_id}
+            
+            # 逐段转发AI回复的增量内容；提前退出时立即关闭上游的流
+            chunks = []
+            served_model = None
+            try:
+                async with contextlib.aclosing(
+                    ai_service.stream_generate(message_history, chat["model_id"], policy=routing_policy)
+                ) as events:
+                    async for event in events:
+                        if "model" in event:
+                            served_model = event["model"]
+                            continue
+                        chunks.append(event["delta"])
+                        yield {"type": "delta", "content": event["delta"]}
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开连接：上游调用随之取消，按配置保存或丢弃已生成的部分回复。
+                # 当前任务已被取消，写入放到后台任务中进行，轮次锁一并交给它，
+                # 保证下一轮消息的上下文包含这条部分回复
+                self.counters["cancelled_turns"] += 1
+                if settings.CHAT_SAVE_PARTIAL_ON_DISCONNECT and chunks:
+                    self.counters["partial_replies_saved"] += 1
+                    background_runner.spawn(self._save_partial_turn(chat, user_message, "".join(chunks), served_model))
+                    release_lock = False
+                raise
             
-        return chats
+            result = await self._save_turn(chat, user_message, "".join(chunks), served_model)
+            yield {"type": "done", **result}
+        finally:
+            if release_lock:
+                self.turn_locks.release(chat_id)
+    
+    async def _save_partial_turn(self, chat: Dict[str, Any], user_message: Dict[str, Any], ai_response: str, served_model: Optional[str]):
+        """
+        在后台保存客户端断开时已生成的部分回复；调用前已取得该对话的轮次锁，写入完成后释放
+        """
+        try:
+            await self._save_turn(chat, user_message, ai_response, served_model, partial=True)
+        finally:
+            self.turn_locks.release(chat["_id"])
     
-    async def add_message(self, chat_id: str, content: str, files: Optional[List[str]] = None) -> Dict[str, Any]:
+    async def _prepare_turn(self, chat_id: str, content: str, files: Optional[List[str]] = None, user_id: Optional[str] = None):
         """
-        添加新消息并获取AI回复
+        为本轮的用户消息和AI回复预留序号，并构造用户消息和发送给AI的消息历史；调用方需持有该对话的轮次锁
         """
-        # 获取现有对话
-        chat = await self.get_chat_with_hidden(chat_id)  # 使用get_chat_with_hidden而不是get_chat
+        # 预留序号的同一次操作中校验归属并读取需要的字段；旧格式的对话先迁移到messages集合，再重新预留
+        chat = await message_store.reserve(chat_id, user_id, 2, CHAT_TURN_PROJECTION)
+        if chat and "messages" in chat:
+            await message_store.migrate_chat(chat)
+            chat = await message_store.reserve(chat_id, user_id, 2, CHAT_TURN_PROJECTION)
         if not chat:
+            await self._check_owner_miss(chat_id, user_id)
             raise ValueError("Chat not found")
+        chat["_id"] = str(chat["_id"])
+        user_seq = chat["message_seq"] - 1
+        
+        # 初始回复在创建对话的进程中生成，本进程的轮次锁无法让这条消息排在它之后，等它写入后再读取上下文
+        if chat.pop("reply_pending", False):
+            await self._wait_for_initial_reply(chat_id)
+        
+        # 缓存的序号紧接在本次预留之前时，缓存中的消息是完整的，不需要再读取消息
+        cached = self.context_cache.reserve(chat_id, user_seq, chat["message_seq"]) if settings.CHAT_CONTEXT_CACHE_ENABLED else None
         
         # 处理文件内容
         file_contents = ""
@@ -94,110 +415,267 @@ class ChatService:
             if file_contents:
                 content += file_contents
         
-        # 添加用户消息
+        # 添加用户消息，写入时记录token数供后续构造上下文使用
+        model = ai_service.resolve_model(chat["model_id"])
         user_message = {
             "role": "user",
             "content": content,
-            "timestamp": datetime.utcnow()
+            "timestamp": datetime.utcnow(),
+            "tokens": estimate_tokens(content, model),
+            "seq": user_seq
         }
         
-        # 准备AI请求的消息历史
-        message_history = [
-            {"role": m["role"], "content": m["content"]}
-            for m in chat["messages"]
-        ]
-        message_history.append({"role": "user", "content": content})
+        # 只读取设定消息和摘要之后最新的若干条消息，读取量与对话总长度无关
+        summary_until = chat.get("summary_until") or 0
+        if cached:
+            pinned = cached.pinned
+            after_seq = max(summary_until, pinned[-1]["seq"] if pinned else 0)
+            recent = [msg for msg in cached.recent if msg["seq"] > after_seq]
+        else:
+            pinned, recent = await message_store.get_context(chat_id, settings.AI_CONTEXT_MAX_MESSAGES, after_seq=summary_until)
+            after_seq = max(summary_until, pinned[-1]["seq"] if pinned else 0)
+            recent = [msg for msg in recent if msg["seq"] > after_seq]
+            if settings.CHAT_CONTEXT_CACHE_ENABLED:
+                self.context_cache.put(chat_id, ChatContext(dict(chat), pinned, recent, settings.AI_CONTEXT_MAX_MESSAGES))
         
-        # 获取AI回复
-        ai_response = await ai_service.get_response(
-            message_history,
-            chat["model_id"]
+        # 在token预算内准备AI请求的消息历史，较早的轮次以摘要形式发送
+        context = context_builder.build(
+            pinned + recent + [user_message],
+            model,
+            summary=chat.get("summary"),
+            summary_until=summary_until
         )
+        message_history = context["messages"]
+        
+        # 有足够多的消息滑出窗口时，在后台把它们合并进摘要
+        summarized = max(context["pinned_until"], summary_until)
+        if settings.AI_SUMMARY_ENABLED and context["window_start"] - 1 - summarized >= settings.AI_SUMMARY_MIN_MESSAGES:
+            background_runner.spawn(
+                self._update_summary(chat_id, context["window_start"] - 1),
+                key=f"summary:{chat_id}"
+            )
         
+        return chat, user_message, message_history
+    
+    async def _wait_for_initial_reply(self, chat_id: str):
+        """
+        等待其他进程清除对话的reply_pending；超过CHAT_INITIAL_REPLY_WAIT秒（例如生成回复的进程已退出）后不再等待，
+        并清除仍未清除的reply_pending，之后的消息不再等待
+        """
+        deadline = time.monotonic() + settings.CHAT_INITIAL_REPLY_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(INITIAL_REPLY_POLL_INTERVAL)
+            chat = await db.db.chats.find_one({"_id": ObjectId(chat_id)}, {"reply_pending": 1})
+            if not chat or not chat.get("reply_pending"):
+                return
+        self.counters["initial_reply_timeouts"] += 1
+        print(f"Initial reply for chat {chat_id} still pending after {settings.CHAT_INITIAL_REPLY_WAIT}s, continuing without it")
+        # 只在仍未清除时清除，生成回复的进程恰好在此时完成则不记录错误
+        await db.db.chats.update_one(
+            {"_id": ObjectId(chat_id), "reply_pending": True},
+            {"$unset": {"reply_pending": ""}, "$set": {"reply_error": "timed out"}}
+        )
+    
+    async def _save_turn(
+        self,
+        chat: Dict[str, Any],
+        user_message: Dict[str, Any],
+        ai_response: str,
+        served_model: Optional[str] = None,
+        partial: bool = False
+    ) -> Dict[str, Any]:
+        """
+        将用户消息和AI回复写入数据库，served_model为实际提供回复的模型，
+        partial表示回复因客户端断开而不完整
+        """
         # 添加AI回复
         ai_message = {
             "role": "assistant",
             "content": ai_response,
-            "timestamp": datetime.now(timezone.utc)
+            "timestamp": datetime.now(timezone.utc),
+            "tokens": estimate_tokens(ai_response, ai_service.resolve_model(chat["model_id"])),
+            "model": served_model,
+            "seq": user_message["seq"] + 1
         }
+        if partial:
+            ai_message["partial"] = True
         
-        # 更新数据库
-        await db.db.chats.update_one(
-            {"_id": ObjectId(chat_id)},
-            {
-                "$push": {
-                    "messages": {
-                        "$each": [user_message, ai_message]
-                    }
-                },
-                "$set": {
-                    "updated_at": datetime.now(timezone.utc)
-                }
-            }
-        )
+        # 更新数据库，两条消息的序号已在本轮开始时预留
+        await message_store.insert(chat["_id"], chat["user_id"], [user_message, ai_message])
+        self.context_cache.append(chat["_id"], [user_message, ai_message])
+        await self._broadcast_invalidation(chat["_id"])
+        
+        # 第一轮对话完成后在后台生成标题，用户已手动设置过标题时不生成
+        if settings.CHAT_TITLE_AUTO_GENERATE and not chat.get("message_count") and not chat.get("title_source"):
+            self.schedule_title(chat["_id"])
         
         return {
             "user_message": user_message,
             "ai_message": ai_message
         }
     
-    async def delete_chat(self, chat_id: str) -> bool:
+    async def _update_summary(self, chat_id: str, upto_seq: int):
+        """
+        将序号不超过upto_seq、已滑出上下文窗口且尚未摘要的消息增量合并到对话的滚动摘要中
+        """
+        chat = await db.db.chats.find_one(
+            {"_id": ObjectId(chat_id)},
+            {"summary": 1, "summary_until": 1}
+        )
+        if not chat:
+            return
+        
+        # 只合并上次摘要之后的可见消息，每次最多处理一批
+        previous_until = chat.get("summary_until")
+        messages = await message_store.get_messages(
+            chat_id,
+            include_hidden=False,
+            after_seq=previous_until or 0,
+            limit=settings.AI_SUMMARY_BATCH_MESSAGES
+        )
+        messages = [msg for msg in messages if msg["seq"] <= upto_seq]
+        if not messages:
+            return
+        
+        prompt = f"请将新增的对话内容合并到已有摘要中，生成一份新的摘要（不超过{settings.AI_SUMMARY_MAX_CHARS}字），保留关键事实、用户的偏好和尚未解决的问题，只回复摘要内容：\n\n"
+        prompt += f"已有摘要：\n{chat.get('summary') or '无'}\n\n新增对话：\n"
+        for msg in messages:
+            role = "用户" if msg["role"] == "user" else "助手"
+            prompt += f"{role}: {msg['content'][:500]}{'...' if len(msg['content']) > 500 else ''}\n"
+        
+        summary = await ai_service.get_response(
+            [{"role": "user", "content": prompt}],
+            settings.AI_SUMMARY_MODEL_ID,
+            use_cache=True,
+            policy=settings.AI_BACKGROUND_ROUTING_POLICY,
+            priority="background"
+        )
+        
+        # 以原摘要位置作为条件更新，避免并发任务相互覆盖
+        result = await db.db.chats.update_one(
+            {"_id": ObjectId(chat_id), "summary_until": previous_until},
+            {"$set": {"summary": summary.strip(), "summary_until": messages[-1]["seq"]}}
+        )
+        if result.modified_count:
+            self.context_cache.update_summary(chat_id, previous_until, summary.strip(), messages[-1]["seq"])
+            await self._broadcast_invalidation(chat_id)
+    
+    async def delete_chat(self, chat_id: str, user_id: Optional[str] = None) -> bool:
         """
-        删除聊天
+        删除聊天；指定user_id时只删除该用户的对话
         """
-        result = await db.db.chats.delete_one({"_id": ObjectId(chat_id)})
-        return result.deleted_count > 0
+        result = await db.db.chats.delete_one(self._chat_filter(chat_id, user_id))
+        await self._invalidate_context(chat_id)
+        if result.deleted_count == 0:
+            await self._check_owner_miss(chat_id, user_id)
+            return False
+        await message_store.delete_chat_messages(chat_id)
+        return True
     
-    async def generate_title(self, chat_id: str) -> str:
+    async def request_title(self, chat_id: str, user_id: Optional[str] = None) -> Dict[str, Any]:
         """
-        使用AI生成聊天标题，但不将提示和回答添加到message中
+        用户请求重新生成标题：校验对话后安排后台任务并立即返回当前标题，新标题在对话列表下次刷新时可见；
+        用户手动设置过的标题同样会被替换
         """
-        # 获取聊天记录
-        chat = await self.get_chat_with_hidden(chat_id)
+        chat = await db.db.chats.find_one(self._chat_filter(chat_id, user_id), {"title": 1})
         if not chat:
+            await self._check_owner_miss(chat_id, user_id)
             raise ValueError("Chat not found")
-        
-        # 过滤掉隐藏消息，只使用可见消息生成标题
-        visible_messages = [msg for msg in chat["messages"] if not msg.get("hidden", False)]
-        
-        # 如果没有可见消息，使用默认标题
-        if not visible_messages:
-            return "New Chat"
-        
-        # 准备提示词
-        prompt = "请主要参考用户的意图，为以下对话生成一个简短的标题（不超过20个字），只回复标题内容，不要包含其他解释：\n\n"
+        self.schedule_title(chat_id, force=True)
+        return {"title": chat.get("title"), "pending": background_runner.is_running(f"title:{chat_id}")}
+    
+    def schedule_title(self, chat_id: str, force: bool = False) -> bool:
+        """
+        在后台生成标题，同一对话同时只有一个任务；返回是否新安排了任务
+        """
+        return background_runner.spawn(self.generate_title(chat_id, force=force), key=f"title:{chat_id}") is not None
+    
+    @staticmethod
+    def title_prompt(visible_messages: List[Dict[str, Any]]) -> str:
+        """
+        AI生成标题的提示词
+        """
+        prompt = f"请主要参考用户的意图，为以下对话生成一个简短的标题（不超过{settings.CHAT_TITLE_MAX_LENGTH}个字），只回复标题内容，不要包含其他解释：\n\n"
         
         # 添加对话内容（最多取前5条消息避免过长）
         for i, msg in enumerate(visible_messages[:5]):
             role = "用户" if msg["role"] == "user" else "助手"
             prompt += f"{role}: {msg['content'][:100]}{'...' if len(msg['content']) > 100 else ''}\n"
+        return prompt
+    
+    async def generate_title(self, chat_id: str, user_id: Optional[str] = None, force: bool = False) -> str:
+        """
+        生成聊天标题，但不将提示和回答添加到message中。
+        首次生成时先从用户的第一条消息中本地抽取（title_source=local），抽取不出或再次生成时才使用较便宜的模型（title_source=auto）；
+        用户手动设置的标题不会被覆盖，AI生成后没有新消息时直接返回现有标题。
+        force表示用户明确要求重新生成，以上两种情况都重新生成
+        """
+        # 获取聊天记录
+        chat = await db.db.chats.find_one(
+            self._chat_filter(chat_id, user_id),
+            {"messages": 1, "title": 1, "title_source": 1, "title_message_count": 1, "message_count": 1}
+        )
+        if not chat:
+            await self._check_owner_miss(chat_id, user_id)
+            raise ValueError("Chat not found")
+        if not force and chat.get("title_source") == "user":
+            return chat["title"]
+        if not force and chat.get("title_source") == "auto" and chat.get("title_message_count") == chat.get("message_count"):
+            return chat["title"]
         
-        # 调用AI生成标题，但不添加到消息历史中
-        model_id = chat["model_id"]
+        # 过滤掉隐藏消息，只使用可见消息生成标题（最多取前5条消息避免过长）
+        if "messages" in chat:
+            visible_messages = [msg for msg in chat["messages"] if not msg.get("hidden", False)]
+        else:
+            visible_messages = await message_store.get_messages(chat_id, include_hidden=False, limit=5)
         
-        # 直接调用AI服务，获取生成的标题
-        title_response = await ai_service.get_response(
-            [{"role": "user", "content": prompt}],
-            model_id
-        )
+        # 如果没有可见消息，使用默认标题
+        if not visible_messages:
+            return "New Chat"
         
-        # 清理回复，去除可能的引号和多余空格
-        title = title_response.strip().strip('"\'').strip()
+        title, title_source = None, "local"
+        if settings.CHAT_TITLE_LOCAL_ENABLED and not chat.get("title_source"):
+            first_question = next((msg["content"] for msg in visible_messages if msg["role"] == "user"), "")
+            title = extract_title(first_question, settings.CHAT_TITLE_MAX_LENGTH)
         
-        # 如果标题为空或过长，使用默认值
-        if not title or len(title) > 50:
-            title = "New Chat"
+        if title:
+            self.counters["titles_extracted"] += 1
+        else:
+            title_source = "auto"
+            self.counters["titles_generated"] += 1
+            # 直接调用AI服务，获取生成的标题，但不添加到消息历史中
+            title_response = await ai_service.get_response(
+                [{"role": "user", "content": self.title_prompt(visible_messages)}],
+                settings.CHAT_TITLE_MODEL_ID,
+                use_cache=True,
+                policy=settings.AI_BACKGROUND_ROUTING_POLICY,
+                priority="background"
+            )
+            
+            # 清理回复，去除可能的引号和多余空格
+            title = title_response.strip().strip('"\'').strip()
+            
+            # 如果标题为空或过长，使用默认值
+            if not title or len(title) > 50:
+                title = "New Chat"
         
-        # 仅更新聊天标题，不添加任何消息
+        # 仅更新聊天标题，不添加任何消息；生成期间用户手动改了标题时以用户的为准。
+        # 用户要求重新生成时可以替换手动设置的标题，但不替换生成期间新设置的标题
+        condition: Dict[str, Any] = {"title_source": {"$ne": "user"}}
+        if force:
+            condition = {"$or": [condition, {"title": chat.get("title")}]}
         await db.db.chats.update_one(
-            {"_id": ObjectId(chat_id)},
+            {"_id": ObjectId(chat_id), **condition},
             {
                 "$set": {
                     "title": title, 
+                    "title_source": title_source,
+                    "title_message_count": chat.get("message_count"),
                     "updated_at": datetime.now(timezone.utc)
                 }
             }
         )
+        await self._invalidate_context(chat_id)
     
         return title
 
@@ -208,18 +686,59 @@ class ChatService:
         chat = await db.db.chats.find_one({"_id": ObjectId(chat_id)})
         if chat:
             chat["_id"] = str(chat["_id"])
+            chat["messages"] = await self._load_messages(chat)
         return chat
+    
+    async def _load_messages(self, chat: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        读取对话的全部消息；尚未迁移的旧格式对话直接使用内嵌的messages数组
+        """
+        if "messages" in chat:
+            return [{**msg, "seq": index + 1} for index, msg in enumerate(chat["messages"])]
+        return await message_store.get_messages(chat["_id"])
 
-
-
-    async def update_chat_title(self, chat_id: str, title: str) -> bool:
+    async def update_chat_title(self, chat_id: str, title: str, user_id: Optional[str] = None) -> bool:
         """
-        更新聊天标题
+        更新聊天标题；指定user_id时只更新该用户的对话
         """
         result = await db.db.chats.update_one(
-            {"_id": ObjectId(chat_id)},
-            {"$set": {"title": title, "updated_at": datetime.utcnow()}}
+            self._chat_filter(chat_id, user_id),
+            {"$set": {"title": title, "title_source": "user", "updated_at": datetime.utcnow()}}
         )
-        return result.modified_count > 0
+        await self._invalidate_context(chat_id)
+        if result.matched_count == 0:
+            await self._check_owner_miss(chat_id, user_id)
+            return False
+        return True
+
+    async def _invalidate_context(self, chat_id: str):
+        """
+        使所有进程中该对话的上下文缓存失效
+        """
+        self.context_cache.invalidate(chat_id)
+        await self._broadcast_invalidation(chat_id)
+    
+    async def _broadcast_invalidation(self, chat_id: str):
+        """
+        通知其他进程丢弃该对话的上下文缓存；只有一个进程时没有接收方
+        """
+        if settings.CHAT_CONTEXT_CACHE_ENABLED and shared_backend.distributed:
+            await shared_backend.publish(CHAT_INVALIDATION_CHANNEL, {"chat_id": chat_id, "origin": self.worker_id})
+    
+    async def _on_invalidation(self, message: Dict[str, Any]):
+        if message.get("reset"):
+            self.context_cache.clear()
+        elif message.get("origin") != self.worker_id:
+            self.context_cache.invalidate(message["chat_id"])
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        返回对话上下文缓存的指标
+        """
+        return {
+            "context_cache": self.context_cache.stats(),
+            "turn_locks": self.turn_locks.stats(),
+            **self.counters
+        }
 
 chat_service = ChatService()
\ No newline at end of file
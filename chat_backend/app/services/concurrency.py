@@ -0,0 +1,247 @@
+import time
+import asyncio
+import contextlib
+from collections import deque
+from typing import Dict, Any, AsyncIterator, Optional
+
+class AIServiceBusyError(Exception):
+    """AI服务繁忙：排队已满或等待超时，应返回503"""
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# 调用的优先级，按先后顺序：用户正在等待的对话回复、标题和摘要等后台任务、批量任务
+PRIORITIES = ("interactive", "background", "batch")
+
+class ModelLimiter:
+    """
+    单个模型的并发限制器：同时进行的调用数不超过上限，超出部分按优先级分别在有界队列中等待。
+    名额空出时优先交给interactive；后台（background、batch）只能使用保留给interactive之外的名额，
+    在两者之间按权重分配。后台请求等待超过aging秒后与interactive按到达先后竞争非保留名额，避免饿死
+    """
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int,
+        max_wait: float,
+        reserved: int = 0,
+        weights: Optional[Dict[str, float]] = None,
+        aging: float = float("inf")
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        # 只给interactive使用的名额数
+        self.reserved = min(reserved, max_concurrency - 1)
+        self.weights = {priority: 1.0 for priority in PRIORITIES[1:]}
+        self.weights.update(weights or {})
+        self.aging = aging
+        self._active = {priority: 0 for priority in PRIORITIES}
+        self._waiters: Dict[str, deque] = {priority: deque() for priority in PRIORITIES}
+        # 后台各类别的虚拟时间，每获得一个名额增加1/权重，名额空出时交给虚拟时间最小的类别
+        self._pass = {priority: 0.0 for priority in PRIORITIES[1:]}
+        # 统计数据
+        self._admitted = {priority: 0 for priority in PRIORITIES}
+        self._rejected = 0
+        self._timeouts = 0
+        self._aged = 0
+        self._wait_time_total = {priority: 0.0 for priority in PRIORITIES}
+        self._wait_time_max = {priority: 0.0 for priority in PRIORITIES}
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, priority: str = "interactive") -> AsyncIterator[None]:
+        """获取一个调用名额，退出上下文时释放"""
+        if priority not in self._waiters:
+            raise ValueError(f"Unknown priority: {priority}")
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    async def _acquire(self, priority: str):
+        start = time.monotonic()
+        if priority in self._pass and not self._waiters[priority] and not self._active[priority]:
+            # 空闲过的类别从其他繁忙类别中最小的虚拟时间开始，不能积攒空闲期间的份额
+            busy = [self._pass[other] for other in self._pass if self._waiters[other] or self._active[other]]
+            self._pass[priority] = max(self._pass[priority], min(busy, default=0.0))
+        if self.has_capacity(priority):
+            self._admit(priority, 0.0)
+            return
+
+        # 队列已满时立即拒绝，避免请求无限堆积；各优先级分别计数，后台任务不会挤占对话请求的队列
+        queue = self._waiters[priority]
+        if len(queue) >= self.max_queue:
+            self._rejected += 1
+            raise AIServiceBusyError(f"模型 {self.name} 当前请求过多，请稍后重试")
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (start, waiter)
+        queue.append(entry)
+        try:
+            # 不用wait_for：它在名额已转交时会吞掉取消（Python 3.11），被取消的请求仍会继续调用上游
+            await asyncio.wait((waiter,), timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._remove_waiter(queue, entry)
+            # 名额已经转交给当前请求但请求被取消，需要归还
+            if waiter.done() and not waiter.cancelled():
+                self._release(priority)
+            raise
+        if not waiter.done():
+            waiter.cancel()
+            self._remove_waiter(queue, entry)
+            self._timeouts += 1
+            raise AIServiceBusyError(f"模型 {self.name} 排队等待超时，请稍后重试")
+
+        self._record_wait(priority, time.monotonic() - start)
+
+    def has_capacity(self, priority: str = "interactive") -> bool:
+        """当前是否有该优先级可用的空闲名额（无需排队）"""
+        return self._eligible(priority) and not self._waiters[priority]
+
+    def _eligible(self, priority: str) -> bool:
+        active = sum(self._active.values())
+        if priority == "interactive":
+            return active < self.max_concurrency
+        background = active - self._active["interactive"]
+        return active < self.max_concurrency and background < self.max_concurrency - self.reserved
+
+    def _admit(self, priority: str, wait_time: Optional[float] = None):
+        self._active[priority] += 1
+        if priority in self._pass:
+            self._pass[priority] += 1.0 / self.weights[priority]
+        if wait_time is not None:
+            self._record_wait(priority, wait_time)
+
+    def _release(self, priority: str):
+        self._active[priority] -= 1
+        # 名额依次转交给等待中的请求
+        while True:
+            entry = self._next_waiter()
+            if entry is None:
+                return
+            next_priority, queue = entry
+            _, waiter = queue.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._admit(next_priority)
+
+    def _next_waiter(self):
+        """选出下一个获得名额的队列：超过aging的后台请求与interactive按到达先后，其余后台请求按权重"""
+        interactive = self._waiters["interactive"]
+        candidates = []
+        if interactive and self._eligible("interactive"):
+            candidates.append((interactive[0][0], "interactive"))
+        background = [p for p in PRIORITIES[1:] if self._waiters[p] and self._eligible(p)]
+        if not background:
+            return (candidates[0][1], interactive) if candidates else None
+
+        now = time.monotonic()
+        aged = [(self._waiters[p][0][0], p) for p in background if now - self._waiters[p][0][0] >= self.aging]
+        if aged:
+            candidates.extend(aged)
+        if candidates:
+            _, priority = min(candidates)
+            if priority != "interactive" and interactive:
+                self._aged += 1
+            return priority, self._waiters[priority]
+
+        priority = min(background, key=lambda p: self._pass[p])
+        return priority, self._waiters[priority]
+
+    def _remove_waiter(self, queue: deque, entry):
+        try:
+            queue.remove(entry)
+        except ValueError:
+            pass
+
+    def _record_wait(self, priority: str, wait_time: float):
+        self._admitted[priority] += 1
+        self._wait_time_total[priority] += wait_time
+        self._wait_time_max[priority] = max(self._wait_time_max[priority], wait_time)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回实时的并发、排队与等待时间指标，priorities中按优先级分别统计"""
+        now = time.monotonic()
+        heads = [queue[0][0] for queue in self._waiters.values() if queue]
+        admitted = sum(self._admitted.values())
+        priorities = {}
+        for priority in PRIORITIES:
+            queue = self._waiters[priority]
+            priorities[priority] = {
+                "active": self._active[priority],
+                "queue_depth": len(queue),
+                "oldest_wait_seconds": round(now - queue[0][0], 3) if queue else 0.0,
+                "admitted": self._admitted[priority],
+                "avg_wait_seconds": round(self._wait_time_total[priority] / self._admitted[priority], 3) if self._admitted[priority] else 0.0,
+                "max_wait_seconds": round(self._wait_time_max[priority], 3)
+            }
+        return {
+            "max_concurrency": self.max_concurrency,
+            "reserved_for_interactive": self.reserved,
+            "active": sum(self._active.values()),
+            "queue_depth": sum(len(queue) for queue in self._waiters.values()),
+            "max_queue": self.max_queue,
+            "oldest_wait_seconds": round(now - min(heads), 3) if heads else 0.0,
+            "admitted": admitted,
+            "rejected": self._rejected,
+            "timeouts": self._timeouts,
+            "aged": self._aged,
+            "avg_wait_seconds": round(sum(self._wait_time_total.values()) / admitted, 3) if admitted else 0.0,
+            "max_wait_seconds": round(max(self._wait_time_max.values()), 3),
+            "priorities": priorities
+        }
+
+class KeyedLock:
+    """
+    按key互斥：同一key的操作按到达顺序依次执行，不同key之间互不影响；
+    没有持有者和等待者的锁会被移除，不会随key的数量增长
+    """
+    def __init__(self):
+        # key -> [锁, 持有和等待的数量]
+        self._locks: Dict[str, list] = {}
+        self._contended = 0
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    async def acquire(self, key: str):
+        """获取锁；可以在另一个任务中调用release释放，用于把锁交给后台任务"""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        if entry[1] > 0:
+            self._contended += 1
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._leave(key, entry)
+            raise
+
+    def release(self, key: str):
+        entry = self._locks[key]
+        entry[0].release()
+        self._leave(key, entry)
+
+    def _leave(self, key: str, entry: list):
+        entry[1] -= 1
+        if entry[1] == 0 and self._locks.get(key) is entry:
+            del self._locks[key]
+
+    def queued(self, key: str) -> int:
+        """正在等待该key的操作数"""
+        entry = self._locks.get(key)
+        return max(entry[1] - 1, 0) if entry else 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._locks),
+            "waiting": sum(max(entry[1] - 1, 0) for entry in self._locks.values()),
+            "contended": self._contended
+        }
@@ -0,0 +1,118 @@
+from typing import List, Dict, Optional, Any
+from app.config import settings
+
+# 每条消息在请求中的固定开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+ELISION_MARKER = "\n……（中间内容过长，已省略）……\n"
+
+def _is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (
+        0x4E00 <= code <= 0x9FFF      # 中日韩统一表意文字
+        or 0x3400 <= code <= 0x4DBF   # 扩展A
+        or 0x3000 <= code <= 0x303F   # 中文标点
+        or 0xFF00 <= code <= 0xFFEF   # 全角字符
+        or 0x3040 <= code <= 0x30FF   # 日文假名
+        or 0xAC00 <= code <= 0xD7AF   # 韩文
+    )
+
+def estimate_tokens(text: str, model: str) -> int:
+    """
+    估算文本在指定模型下的token数：中日韩字符和其他字符分别按模型的系数折算
+    """
+    rates = settings.AI_TOKEN_RATES.get(model, settings.AI_TOKEN_RATES["default"])
+    cjk = sum(1 for char in text if _is_cjk(char))
+    other = len(text) - cjk
+    return int(cjk * rates["cjk"] + other * rates["other"]) + 1
+
+def message_tokens(message: Dict[str, Any], model: str) -> int:
+    """
+    获取消息的token数，优先使用写入时缓存的值
+    """
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(message["content"], model)
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+class ContextBuilder:
+    """
+    在token预算内构造发送给模型的上下文：
+    system提示词（含滚动摘要）和开头的隐藏设定消息始终保留，其余按从新到旧的顺序尽量放入，更早的轮次被丢弃
+    """
+    def get_budget(self, model: str) -> int:
+        """模型可用于输入上下文的token数（已扣除为回复预留的部分）"""
+        window = settings.AI_CONTEXT_TOKEN_BUDGET.get(model, settings.AI_CONTEXT_TOKEN_BUDGET["default"])
+        return max(window - settings.AI_CONTEXT_RESPONSE_RESERVE, 0)
+
+    def build(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str,
+        system_prompt: Optional[str] = None,
+        summary: Optional[str] = None,
+        summary_until: int = 0
+    ) -> Dict[str, Any]:
+        """
+        构造上下文，返回{"messages": 发送给模型的消息, "window_start": 窗口内第一条消息的序号, "pinned_until": 最后一条设定消息的序号}
+
+        messages为按序号排列的消息（开头可以是隐藏的设定消息），最后一条是本轮的用户消息；
+        序号不大于summary_until的消息已包含在摘要summary中，不再逐条发送
+        """
+        system_prompt = system_prompt or settings.AI_SYSTEM_PROMPT
+        if summary:
+            system_prompt += f"\n\n以下是此前对话内容的摘要：\n{summary}"
+        budget = self.get_budget(model) - estimate_tokens(system_prompt, model) - MESSAGE_OVERHEAD_TOKENS
+
+        # 开头连续的隐藏消息是创建对话时的角色设定，始终保留
+        pinned_count = self.count_pinned(messages)
+        pinned = [self._fit(m, model) for m in messages[:pinned_count]]
+        pinned_until = messages[pinned_count - 1]["seq"] if pinned_count else 0
+        budget -= sum(message_tokens(m, model) for m in pinned)
+
+        # 从最新的消息开始向前填充，本轮用户消息必定保留；已被摘要覆盖的消息不再考虑
+        earliest = max(pinned_until, summary_until)
+        history = [m for m in messages[pinned_count:] if m["seq"] > earliest]
+        window: List[Dict[str, Any]] = []
+        for message in reversed(history):
+            message = self._fit(message, model)
+            tokens = message_tokens(message, model)
+            if window and tokens > budget:
+                break
+            window.append(message)
+            budget -= tokens
+        window.reverse()
+
+        # 窗口不以助手回复开头，保证每一轮问答完整
+        while len(window) > 1 and window[0]["role"] == "assistant":
+            window.pop(0)
+
+        result = [{"role": "system", "content": system_prompt}]
+        result += [{"role": m["role"], "content": m["content"]} for m in pinned + window]
+        return {
+            "messages": result,
+            "window_start": window[0]["seq"] if window else earliest + 1,
+            "pinned_until": pinned_until
+        }
+
+    def count_pinned(self, messages: List[Dict[str, Any]]) -> int:
+        """开头连续的隐藏设定消息数"""
+        count = 0
+        while count < len(messages) and messages[count].get("hidden", False):
+            count += 1
+        return count
+
+    def _fit(self, message: Dict[str, Any], model: str) -> Dict[str, Any]:
+        """单条消息超过上限时保留首尾、省略中间部分"""
+        limit = settings.AI_CONTEXT_MAX_MESSAGE_TOKENS
+        tokens = message.get("tokens")
+        if tokens is None:
+            tokens = estimate_tokens(message["content"], model)
+        if tokens <= limit:
+            return message
+
+        content = message["content"]
+        keep = max(int(len(content) * limit / tokens) // 2, 1)
+        elided = content[:keep] + ELISION_MARKER + content[-keep:]
+        return {**message, "content": elided, "tokens": estimate_tokens(elided, model)}
+
+context_builder = ContextBuilder()
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from typing import List, Dict, Optional, Any
+
+# 每条消息和每个缓存项除文本外的估算开销（字节）
+MESSAGE_OVERHEAD = 256
+ENTRY_OVERHEAD = 512
+
+class ChatContext:
+    """
+    一个对话构造上下文所需的全部数据：对话字段、隐藏的设定消息和最新的若干条消息
+    """
+    def __init__(self, chat: Dict[str, Any], pinned: List[Dict[str, Any]], recent: List[Dict[str, Any]], max_recent: int):
+        self.chat = chat
+        self.pinned = pinned
+        self.recent = recent[-max_recent:]
+        self.max_recent = max_recent
+        self.size = self._measure()
+
+    @property
+    def message_seq(self) -> int:
+        return self.chat.get("message_seq", 0)
+
+    def append(self, messages: List[Dict[str, Any]]):
+        """追加已写入数据库的消息，只保留最新的max_recent条"""
+        self.recent = (self.recent + messages)[-self.max_recent:]
+        self.chat["message_seq"] = max(self.message_seq, messages[-1]["seq"])
+        self.size = self._measure()
+
+    def _measure(self) -> int:
+        size = ENTRY_OVERHEAD + len((self.chat.get("summary") or "").encode("utf-8"))
+        for message in self.pinned + self.recent:
+            size += MESSAGE_OVERHEAD + len(message.get("content", "").encode("utf-8"))
+        return size
+
+class ChatContextCache:
+    """
+    进程内对话上下文LRU缓存，按估算的内存占用限制总大小，超出时淘汰最久未使用的对话
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, ChatContext]" = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        self._stale_writes = 0
+
+    def get(self, chat_id: str) -> Optional[ChatContext]:
+        """查找缓存，未命中返回None"""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(chat_id)
+        self._hits += 1
+        return entry
+
+    def put(self, chat_id: str, entry: ChatContext):
+        """写入或替换缓存项"""
+        self._remove(chat_id)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[chat_id] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def reserve(self, chat_id: str, first_seq: int, last_seq: int) -> Optional[ChatContext]:
+        """
+        本进程为一轮对话预留了first_seq到last_seq的序号后查找缓存。
+        缓存记录的序号与预留的序号不连续，说明期间有其他进程预留或写入过，此时失效并按未命中处理
+        """
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry.message_seq != first_seq - 1:
+            self._stale_writes += 1
+            self.invalidate(chat_id)
+            entry = None
+        if entry is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(chat_id)
+        self._hits += 1
+        entry.chat["message_seq"] = last_seq
+        return entry
+
+    def append(self, chat_id: str, messages: List[Dict[str, Any]]):
+        """
+        写穿：把刚写入数据库的消息追加到缓存。
+        消息不在缓存已知的序号范围内或早于缓存中的消息，说明期间有其他写入，此时直接失效
+        """
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return
+        last_cached = entry.recent[-1]["seq"] if entry.recent else 0
+        if messages[-1]["seq"] > entry.message_seq or messages[0]["seq"] <= last_cached:
+            self._stale_writes += 1
+            self.invalidate(chat_id)
+            return
+        self._bytes -= entry.size
+        entry.append(messages)
+        self._bytes += entry.size
+        self._evict()
+
+    def update_summary(self, chat_id: str, previous_until: Optional[int], summary: str, summary_until: int):
+        """写穿：摘要更新成功后同步到缓存，缓存中的摘要位置与预期不一致时直接失效"""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return
+        if entry.chat.get("summary_until") != previous_until:
+            self.invalidate(chat_id)
+            return
+        self._bytes -= entry.size
+        entry.chat["summary"] = summary
+        entry.chat["summary_until"] = summary_until
+        entry.size = entry._measure()
+        self._bytes += entry.size
+        self._evict()
+
+    def invalidate(self, chat_id: str):
+        if self._remove(chat_id):
+            self._invalidations += 1
+
+    def clear(self):
+        self._invalidations += len(self._entries)
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, chat_id: str) -> bool:
+        entry = self._entries.pop(chat_id, None)
+        if entry is None:
+            return False
+        self._bytes -= entry.size
+        return True
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._hits + self._misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+            "evictions": self._evictions,
+            "invalidations": self._invalidations,
+            "stale_writes": self._stale_writes
+        }
@@ -0,0 +1,246 @@
+from typing import List, Dict, Optional, Any, Tuple
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from app.config import settings
+from app.database import db
+from app.services.text_search import tokenize
+
+# 返回给调用方的消息字段，不包含内部字段
+MESSAGE_PROJECTION = {"_id": 0, "chat_id": 0, "user_id": 0, "terms": 0}
+
+class MessageStore:
+    """
+    对话消息存储：每条消息是messages集合中的一个文档，按(chat_id, seq)索引，
+    对话文档上的message_seq记录已分配的最大序号（序号先预留再写入，写入失败时序号会留空），
+    message_count、last_message_preview、last_message_at在写入时同步更新，供对话列表使用
+    """
+    async def append(self, chat_id: str, user_id: str, messages: List[Dict[str, Any]], touch: bool = True) -> List[Dict[str, Any]]:
+        """
+        追加消息：原子地为消息分配连续的序号并写入，返回带序号的消息；
+        更新条件包含user_id，对话不属于该用户时不会写入
+        """
+        chat = await self.reserve(chat_id, user_id, len(messages))
+        if not chat:
+            raise ValueError("Chat not found")
+
+        first_seq = chat["message_seq"] - len(messages) + 1
+        saved = [{**message, "seq": first_seq + index} for index, message in enumerate(messages)]
+        await self.insert(chat_id, user_id, saved, touch=touch)
+        return saved
+
+    async def reserve(
+        self,
+        chat_id: str,
+        user_id: Optional[str],
+        count: int,
+        projection: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        原子地为接下来的count条消息预留序号（多个进程同时预留也不会重复），
+        返回更新后的对话文档，其中message_seq为预留的最后一个序号；
+        对话不存在或不属于user_id（为None时不校验）时返回None
+        """
+        query: Dict[str, Any] = {"_id": ObjectId(chat_id)}
+        if user_id is not None:
+            query["user_id"] = user_id
+        return await db.db.chats.find_one_and_update(
+            query,
+            {"$inc": {"message_seq": count}},
+            projection=projection or {"message_seq": 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def insert(self, chat_id: str, user_id: str, messages: List[Dict[str, Any]], touch: bool = True):
+        """
+        写入已经预留了序号的消息，并更新对话的消息数和预览
+        """
+        await db.db.messages.insert_many([
+            {**message, "chat_id": chat_id, "user_id": user_id, **self.search_fields(message)}
+            for message in messages
+        ])
+
+        visible = [m for m in messages if not m.get("hidden", False)]
+        update: Dict[str, Any] = {
+            "$inc": {"message_count": len(visible)},
+            "$set": self.preview_fields(messages[-1])
+        }
+        if touch:
+            update["$set"]["updated_at"] = datetime.now(timezone.utc)
+        await db.db.chats.update_one({"_id": ObjectId(chat_id), "user_id": user_id}, update)
+
+    def search_fields(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        生成全文搜索使用的terms字段，隐藏的设定消息不参与搜索
+        """
+        if message.get("hidden", False):
+            return {}
+        return {"terms": tokenize(message.get("content", ""), settings.SEARCH_MAX_TERMS)}
+
+    def preview_fields(self, last_message: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        根据最后一条消息生成对话文档上的预览字段
+        """
+        if not last_message:
+            return {"last_message_preview": "", "last_message_at": None}
+        return {
+            "last_message_preview": last_message["content"][:settings.CHAT_PREVIEW_LENGTH],
+            "last_message_at": last_message.get("timestamp")
+        }
+
+    async def get_messages(
+        self,
+        chat_id: str,
+        include_hidden: bool = True,
+        after_seq: int = 0,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        按序号顺序获取after_seq之后的消息
+        """
+        query: Dict[str, Any] = {"chat_id": chat_id, "seq": {"$gt": after_seq}}
+        if not include_hidden:
+            query["hidden"] = {"$ne": True}
+        cursor = db.db.messages.find(query, MESSAGE_PROJECTION).sort("seq", 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(length=None)
+
+    async def get_page(
+        self,
+        chat_id: str,
+        limit: int,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        include_hidden: bool = False
+    ) -> Dict[str, Any]:
+        """
+        分页获取消息：指定after时返回该序号之后最早的一页，否则返回before之前（未指定则为全部）最新的一页；
+        页内按时间顺序排列，has_more表示翻页方向上是否还有更多消息
+        """
+        query: Dict[str, Any] = {"chat_id": chat_id}
+        if not include_hidden:
+            query["hidden"] = {"$ne": True}
+        if after is not None:
+            query["seq"] = {"$gt": after}
+            direction = 1
+        else:
+            if before is not None:
+                query["seq"] = {"$lt": before}
+            direction = -1
+
+        # 多取一条判断是否还有更多
+        cursor = db.db.messages.find(query, MESSAGE_PROJECTION).sort("seq", direction).limit(limit + 1)
+        messages = await cursor.to_list(length=None)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if direction == -1:
+            messages.reverse()
+        return {"messages": messages, "has_more": has_more}
+
+    async def get_recent(self, chat_id: str, limit: int, after_seq: int = 0) -> List[Dict[str, Any]]:
+        """
+        获取after_seq之后最新的limit条消息，按时间顺序返回
+        """
+        cursor = db.db.messages.find(
+            {"chat_id": chat_id, "seq": {"$gt": after_seq}},
+            MESSAGE_PROJECTION
+        ).sort("seq", -1).limit(limit)
+        messages = await cursor.to_list(length=None)
+        messages.reverse()
+        return messages
+
+    async def get_pinned(self, chat_id: str) -> List[Dict[str, Any]]:
+        """
+        获取创建对话时写入的隐藏设定消息
+        """
+        cursor = db.db.messages.find({"chat_id": chat_id, "hidden": True}, MESSAGE_PROJECTION).sort("seq", 1)
+        return await cursor.to_list(length=None)
+
+    async def get_context(self, chat_id: str, limit: int, after_seq: int = 0) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        构造上下文时使用：一次查询同时读取隐藏的设定消息和after_seq之后最新的limit条可见消息，
+        两部分各自走(chat_id, seq)索引，用$unionWith合并（需要MongoDB 4.4+），按时间顺序返回(pinned, recent)
+        """
+        cursor = db.db.messages.aggregate([
+            {"$match": {"chat_id": chat_id, "hidden": True}},
+            {"$unionWith": {"coll": "messages", "pipeline": [
+                {"$match": {"chat_id": chat_id, "seq": {"$gt": after_seq}}},
+                {"$sort": {"seq": -1}},
+                {"$limit": limit}
+            ]}},
+            {"$project": MESSAGE_PROJECTION}
+        ])
+        pinned: Dict[int, Dict[str, Any]] = {}
+        recent: List[Dict[str, Any]] = []
+        async for message in cursor:
+            if message.get("hidden"):
+                # 对话较短时设定消息也会出现在最新消息中
+                pinned[message["seq"]] = message
+            else:
+                recent.append(message)
+        recent.sort(key=lambda message: message["seq"])
+        return [pinned[seq] for seq in sorted(pinned)], recent
+
+    async def get_last(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        """
+        获取对话的最后一条消息
+        """
+        return await db.db.messages.find_one({"chat_id": chat_id}, MESSAGE_PROJECTION, sort=[("seq", -1)])
+
+    async def search(self, user_id: str, terms: List[str], limit: int) -> List[Dict[str, Any]]:
+        """
+        查找包含全部索引词的可见消息，最多返回最新的limit条候选；
+        走(user_id, terms, timestamp)索引，按时间倒序读取不需要在内存中排序
+        """
+        cursor = db.db.messages.find(
+            {"user_id": user_id, "terms": {"$all": terms}, "hidden": {"$ne": True}},
+            {"_id": 0, "chat_id": 1, "seq": 1, "role": 1, "content": 1, "timestamp": 1}
+        ).sort("timestamp", -1).limit(limit)
+        return await cursor.to_list(length=None)
+
+    async def delete_chat_messages(self, chat_id: str) -> int:
+        """
+        删除对话的全部消息
+        """
+        result = await db.db.messages.delete_many({"chat_id": chat_id})
+        return result.deleted_count
+
+    async def migrate_chat(self, chat: Dict[str, Any]) -> int:
+        """
+        将旧格式对话中内嵌的messages数组迁移到messages集合，可重复执行；返回迁移的消息数
+        """
+        embedded = chat.get("messages")
+        if embedded is None:
+            return 0
+
+        chat_id = str(chat["_id"])
+        if embedded:
+            # 以(chat_id, seq)为键upsert，重复执行不会产生重复消息
+            await db.db.messages.bulk_write([
+                UpdateOne(
+                    {"chat_id": chat_id, "seq": index + 1},
+                    {"$setOnInsert": {
+                        **message,
+                        "chat_id": chat_id,
+                        "user_id": chat["user_id"],
+                        "seq": index + 1,
+                        **self.search_fields(message)
+                    }},
+                    upsert=True
+                )
+                for index, message in enumerate(embedded)
+            ], ordered=False)
+
+        # 使用$max更新序号和计数，避免覆盖迁移期间已经写入的新消息
+        visible_count = len([m for m in embedded if not m.get("hidden", False)])
+        update: Dict[str, Any] = {
+            "$max": {"message_seq": len(embedded), "message_count": visible_count},
+            "$unset": {"messages": ""}
+        }
+        if "last_message_preview" not in chat:
+            update["$set"] = self.preview_fields(embedded[-1] if embedded else None)
+        await db.db.chats.update_one({"_id": ObjectId(chat_id)}, update)
+        return len(embedded)
+
+message_store = MessageStore()
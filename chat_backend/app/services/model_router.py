@@ -0,0 +1,79 @@
+from collections import deque
+from typing import List, Dict, Optional, Any
+from app.config import settings
+from app.services.resilience import LatencyTracker
+
+# 路由策略
+PINNED = "pinned"  # 只使用指定的模型
+PREFER_FAST = "prefer_fast"  # 指定模型延迟或错误率过高时优先使用备用模型
+FALLBACK_ON_ERROR = "fallback_on_error"  # 优先使用指定模型，失败后改用备用模型
+ROUTING_POLICIES = (PINNED, PREFER_FAST, FALLBACK_ON_ERROR)
+
+class ModelHealth:
+    """单个模型最近的延迟和成功/失败记录"""
+    def __init__(self, latency_window: int, error_window: int):
+        self.latency = LatencyTracker(latency_window)
+        self._outcomes: deque = deque(maxlen=error_window)
+        self.served = 0
+
+    def record_success(self, latency: Optional[float] = None):
+        self.served += 1
+        self._outcomes.append(True)
+        if latency is not None:
+            self.latency.record(latency)
+
+    def record_error(self):
+        self._outcomes.append(False)
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def is_degraded(self) -> bool:
+        """样本足够时，P95延迟或错误率超过阈值即认为模型性能下降"""
+        if len(self._outcomes) < settings.AI_ROUTER_MIN_SAMPLES:
+            return False
+        if self.error_rate() > settings.AI_ROUTER_MAX_ERROR_RATE:
+            return True
+        p95 = self.latency.percentile(95)
+        return p95 is not None and self.latency.count() >= settings.AI_ROUTER_MIN_SAMPLES and p95 > settings.AI_ROUTER_SLOW_P95
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.latency.stats(),
+            "error_rate": round(self.error_rate(), 3),
+            "degraded": self.is_degraded(),
+            "served": self.served
+        }
+
+class ModelRouter:
+    """
+    根据路由策略和各模型近期的延迟、错误率，决定一次调用依次尝试哪些模型
+    """
+    def __init__(self):
+        self._health: Dict[str, ModelHealth] = {}
+
+    def health(self, model: str) -> ModelHealth:
+        if model not in self._health:
+            self._health[model] = ModelHealth(settings.AI_LATENCY_WINDOW, settings.AI_ROUTER_ERROR_WINDOW)
+        return self._health[model]
+
+    def candidates(self, model: str, policy: Optional[str] = None) -> List[str]:
+        """返回按尝试顺序排列的模型列表"""
+        policy = policy or settings.AI_ROUTING_POLICY
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy: {policy}")
+
+        fallbacks = [m for m in settings.AI_FALLBACK_MODELS.get(model, []) if m != model]
+        if policy == PINNED or not fallbacks:
+            return [model]
+
+        if policy == PREFER_FAST and self.health(model).is_degraded():
+            healthy = [m for m in fallbacks if not self.health(m).is_degraded()]
+            if healthy:
+                return healthy + [model] + [m for m in fallbacks if m not in healthy]
+        return [model] + fallbacks
+
+    def stats(self) -> Dict[str, Any]:
+        return {model: health.stats() for model, health in self._health.items()}
@@ -0,0 +1,16 @@
+from typing import Callable, Dict
+from app.services.providers.base import LLMProvider, ProviderError
+from app.services.providers.zhipu import ZhipuProvider, ZhipuAPIError, create_zhipu_provider
+from app.services.providers.mock import MockProvider, create_mock_provider
+
+# provider名称到构造函数的映射，新增provider时在此注册
+PROVIDER_FACTORIES: Dict[str, Callable[[], LLMProvider]] = {
+    "zhipu": create_zhipu_provider,
+    "mock": create_mock_provider,
+}
+
+def create_provider(name: str) -> LLMProvider:
+    """按名称创建provider"""
+    if name not in PROVIDER_FACTORIES:
+        raise ValueError(f"Unknown AI provider: {name}")
+    return PROVIDER_FACTORIES[name]()
@@ -0,0 +1,28 @@
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, Any, AsyncIterator
+
+class ProviderError(Exception):
+    """模型服务调用失败，status为上游返回的HTTP状态码，网络错误或超时时为None"""
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+class LLMProvider(ABC):
+    """
+    模型服务接口，所有provider都需要实现对话补全的阻塞调用和流式调用，缺少任一实现时无法实例化
+    """
+    name = "base"
+
+    @abstractmethod
+    async def create_completion(self, model: str, messages: List[Dict[str, str]], **params: Any) -> str:
+        """调用对话补全接口并返回完整回复内容"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def stream_completion(self, model: str, messages: List[Dict[str, str]], **params: Any) -> AsyncIterator[str]:
+        """以流式方式调用对话补全接口，逐段返回增量内容"""
+        raise NotImplementedError
+        yield  # 声明为异步生成器
+
+    async def close(self):
+        """释放连接等资源"""
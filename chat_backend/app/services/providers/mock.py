@@ -0,0 +1,78 @@
+import math
+import random
+import asyncio
+from typing import List, Dict, Optional, Any, AsyncIterator
+from app.config import settings
+from app.services.providers.base import LLMProvider, ProviderError
+
+class MockProvider(LLMProvider):
+    """
+    本地模拟的模型服务，不访问网络，用于压测和离线开发：
+    首个token延迟服从对数正态分布，之后按固定速率输出token，并可按比例注入错误
+    """
+    name = "mock"
+
+    def __init__(
+        self,
+        ttft_median: float = 0.3,
+        ttft_sigma: float = 0.5,
+        tokens_per_second: float = 50,
+        response_tokens: int = 120,
+        error_rate: float = 0.0,
+        error_status: Optional[int] = 503,
+        seed: Optional[int] = None
+    ):
+        self.ttft_median = ttft_median
+        self.ttft_sigma = ttft_sigma
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+
+    def _first_token_delay(self) -> float:
+        return self._random.lognormvariate(math.log(self.ttft_median), self.ttft_sigma) if self.ttft_median > 0 else 0.0
+
+    def _tokens(self, model: str, messages: List[Dict[str, str]]) -> List[str]:
+        """生成回复内容：回显最后一条消息的开头，再补足到指定的token数"""
+        prompt = messages[-1]["content"] if messages else ""
+        tokens = [f"[{model}] ", *list(prompt[:20])]
+        while len(tokens) < self.response_tokens:
+            tokens.append("模拟")
+        return tokens
+
+    def _maybe_fail(self):
+        if self.error_rate > 0 and self._random.random() < self.error_rate:
+            raise ProviderError("模拟的上游错误", self.error_status)
+
+    async def create_completion(self, model: str, messages: List[Dict[str, str]], **params: Any) -> str:
+        tokens = self._tokens(model, messages)
+        # 阻塞调用的耗时 = 首个token延迟 + 全部token的生成时间
+        delay = self._first_token_delay()
+        if self.tokens_per_second > 0:
+            delay += len(tokens) / self.tokens_per_second
+        await asyncio.sleep(delay)
+        self._maybe_fail()
+        return "".join(tokens)
+
+    async def stream_completion(self, model: str, messages: List[Dict[str, str]], **params: Any) -> AsyncIterator[str]:
+        tokens = self._tokens(model, messages)
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail()
+        interval = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for index, token in enumerate(tokens):
+            if index and interval:
+                await asyncio.sleep(interval)
+            yield token
+
+def create_mock_provider() -> MockProvider:
+    """根据配置创建模拟provider"""
+    return MockProvider(
+        ttft_median=settings.MOCK_AI_TTFT_MEDIAN,
+        ttft_sigma=settings.MOCK_AI_TTFT_SIGMA,
+        tokens_per_second=settings.MOCK_AI_TOKENS_PER_SECOND,
+        response_tokens=settings.MOCK_AI_RESPONSE_TOKENS,
+        error_rate=settings.MOCK_AI_ERROR_RATE,
+        error_status=settings.MOCK_AI_ERROR_STATUS or None,
+        seed=settings.MOCK_AI_SEED
+    )
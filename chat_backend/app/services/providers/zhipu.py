@@ -0,0 +1,167 @@
+import json
+import time
+import asyncio
+from typing import List, Dict, Optional, Any, AsyncIterator
+import aiohttp
+import jwt
+from app.config import settings
+from app.services.providers.base import LLMProvider, ProviderError
+
+# 鉴权令牌有效期（秒），提前30秒刷新
+TOKEN_TTL_SECONDS = 3 * 60
+TOKEN_REFRESH_MARGIN = 30
+
+class ZhipuAPIError(ProviderError):
+    """智谱AI接口调用失败"""
+
+class ZhipuProvider(LLMProvider):
+    """
+    基于aiohttp连接池的智谱AI异步客户端，复用长连接，并发只受连接数限制而不占用线程
+    """
+    name = "zhipu"
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        base_url: str,
+        max_connections: int = 100,
+        max_connections_per_host: int = 50,
+        keepalive_timeout: float = 60,
+        connect_timeout: float = 10,
+        read_timeout: float = 60,
+        timeout: float = 120
+    ):
+        self.api_key = api_key or ""
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._token: Optional[str] = None
+        self._token_expire_at = 0.0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """懒加载共享会话，必须在事件循环中调用"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _get_token(self) -> str:
+        """
+        生成鉴权令牌。标准的"id.secret"格式密钥签发JWT并缓存，其他格式（如本地桩服务）直接使用原始密钥
+        """
+        if "." not in self.api_key:
+            return self.api_key
+
+        now = time.time()
+        if self._token and now < self._token_expire_at:
+            return self._token
+
+        api_key_id, secret = self.api_key.split(".", 1)
+        now_ms = int(now * 1000)
+        self._token = jwt.encode(
+            {
+                "api_key": api_key_id,
+                "exp": now_ms + TOKEN_TTL_SECONDS * 1000,
+                "timestamp": now_ms
+            },
+            secret,
+            algorithm="HS256",
+            headers={"alg": "HS256", "sign_type": "SIGN"}
+        )
+        self._token_expire_at = now + TOKEN_TTL_SECONDS - TOKEN_REFRESH_MARGIN
+        return self._token
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self._get_token()}",
+            "Content-Type": "application/json"
+        }
+
+    async def create_completion(self, model: str, messages: List[Dict[str, str]], **params: Any) -> str:
+        """
+        调用对话补全接口并返回完整回复内容
+        """
+        payload = {"model": model, "messages": messages, **params}
+        timeout = aiohttp.ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout)
+        try:
+            async with self._get_session().post(
+                f"{self.base_url}/chat/completions",
+                json=payload,
+                headers=self._headers(),
+                timeout=timeout
+            ) as response:
+                if response.status >= 400:
+                    raise ZhipuAPIError(await response.text(), response.status)
+                data = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            raise ZhipuAPIError("请求超时")
+        except aiohttp.ClientError as e:
+            raise ZhipuAPIError(str(e))
+
+        try:
+            return data["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            raise ZhipuAPIError(f"无法解析的响应: {data}")
+
+    async def stream_completion(self, model: str, messages: List[Dict[str, str]], **params: Any) -> AsyncIterator[str]:
+        """
+        以流式方式调用对话补全接口，逐段返回增量内容
+        """
+        payload = {"model": model, "messages": messages, "stream": True, **params}
+        # 流式响应没有整体超时，只限制两个数据块之间的等待时间
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        try:
+            async with self._get_session().post(
+                f"{self.base_url}/chat/completions",
+                json=payload,
+                headers=self._headers(),
+                timeout=timeout
+            ) as response:
+                if response.status >= 400:
+                    raise ZhipuAPIError(await response.text(), response.status)
+
+                # 解析SSE数据行："data: {...}"，以"data: [DONE]"结束
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    choices = chunk.get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        yield delta
+        except asyncio.TimeoutError:
+            raise ZhipuAPIError("请求超时")
+        except aiohttp.ClientError as e:
+            raise ZhipuAPIError(str(e))
+
+    async def close(self):
+        """关闭连接池"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+def create_zhipu_provider() -> ZhipuProvider:
+    """根据配置创建智谱AI provider"""
+    return ZhipuProvider(
+        api_key=settings.AI_API_KEY,
+        base_url=settings.AI_BASE_URL,
+        max_connections=settings.AI_HTTP_MAX_CONNECTIONS,
+        max_connections_per_host=settings.AI_HTTP_MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=settings.AI_HTTP_KEEPALIVE_TIMEOUT,
+        connect_timeout=settings.AI_HTTP_CONNECT_TIMEOUT,
+        read_timeout=settings.AI_HTTP_READ_TIMEOUT,
+        timeout=settings.AI_HTTP_TIMEOUT
+    )
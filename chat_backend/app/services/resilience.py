@@ -0,0 +1,119 @@
+import time
+import random
+from collections import deque
+from typing import Dict, Any, Optional
+from app.services.concurrency import AIServiceBusyError
+from app.services.providers import ProviderError
+
+class CircuitOpenError(AIServiceBusyError):
+    """熔断器处于打开状态，快速失败"""
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    判断上游错误是否值得重试：网络错误、超时、限流(429)和服务端错误(5xx)
+    """
+    if not isinstance(error, ProviderError):
+        return False
+    return error.status is None or error.status == 429 or error.status >= 500
+
+class RetryPolicy:
+    """带随机抖动的指数退避重试策略"""
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """第attempt次（从0开始）失败后的等待时间，采用full jitter"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+class LatencyTracker:
+    """记录最近若干次调用的耗时，用于计算分位数"""
+    def __init__(self, window: int):
+        self._samples: deque = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def count(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(int(len(ordered) * p / 100), len(ordered) - 1)
+        return ordered[index]
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        return {
+            "samples": self.count(),
+            "p50_seconds": round(p50, 3) if p50 is not None else None,
+            "p95_seconds": round(p95, 3) if p95 is not None else None
+        }
+
+class CircuitBreaker:
+    """
+    单个模型的熔断器：连续失败达到阈值后打开，在冷却时间内直接拒绝调用；
+    冷却结束后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._open_count = 0
+        self._rejected = 0
+
+    def before_call(self):
+        """调用前检查，熔断时抛出CircuitOpenError"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self._rejected += 1
+                raise CircuitOpenError(
+                    f"模型 {self.name} 暂时不可用，请稍后重试",
+                    retry_after=max(int(self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+                )
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self._rejected += 1
+                raise CircuitOpenError(f"模型 {self.name} 正在恢复中，请稍后重试")
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self._open_count += 1
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def release(self):
+        """调用因与上游无关的原因结束（如被取消），不计入成功或失败"""
+        self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "open_count": self._open_count,
+            "rejected": self._rejected
+        }
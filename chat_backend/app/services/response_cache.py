@@ -0,0 +1,100 @@
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Any
+from app.database import db
+
+def make_cache_key(model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+    """
+    根据模型、消息和采样参数计算缓存键
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    AI回复缓存：进程内LRU+TTL一级缓存，可选MongoDB共享二级缓存（多个进程共用）
+    """
+    def __init__(self, max_entries: int, ttl: float, shared: bool = False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._hits = 0
+        self._shared_hits = 0
+        self._misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        """查找缓存，未命中返回None"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expire_at, value = entry
+            if expire_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return value
+            del self._entries[key]
+
+        if self.shared:
+            value = await self._get_shared(key)
+            if value is not None:
+                self._set_local(key, value)
+                self._shared_hits += 1
+                return value
+
+        self._misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        """写入缓存"""
+        self._set_local(key, value)
+        if self.shared:
+            await self._set_shared(key, value)
+
+    def _set_local(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _get_shared(self, key: str) -> Optional[str]:
+        try:
+            doc = await db.db.ai_cache.find_one({
+                "_id": key,
+                "expires_at": {"$gt": datetime.now(timezone.utc)}
+            })
+            return doc["value"] if doc else None
+        except Exception as e:
+            # 共享缓存不可用时退化为只使用进程内缓存
+            print(f"AI cache lookup failed: {e}")
+            return None
+
+    async def _set_shared(self, key: str, value: str):
+        try:
+            await db.db.ai_cache.update_one(
+                {"_id": key},
+                {"$set": {
+                    "value": value,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"AI cache write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._hits + self._shared_hits + self._misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self._hits,
+            "shared_hits": self._shared_hits,
+            "misses": self._misses,
+            "hit_rate": round((self._hits + self._shared_hits) / lookups, 3) if lookups else 0.0
+        }
@@ -0,0 +1,320 @@
+"""
+多个worker进程之间共享的缓存与协调状态：键值缓存、计数器（限流）、互斥锁（跨进程single-flight）和失效广播。
+配置SHARED_BACKEND_URL（redis://...）时使用Redis，否则使用进程内实现，行为相同但只在当前进程内有效。
+"""
+import json
+import time
+import uuid
+import asyncio
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Callable, Awaitable, Dict, List, Optional, Any
+from app.config import settings
+
+# 当前进程的标识，广播消息带上它，收到自己发出的消息时忽略
+WORKER_ID = uuid.uuid4().hex
+
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+def dumps(value: Any) -> str:
+    """序列化为JSON，datetime会被标记以便原样还原"""
+    def default(obj):
+        if isinstance(obj, datetime):
+            return {"__datetime__": obj.isoformat()}
+        return str(obj)
+    return json.dumps(value, ensure_ascii=False, default=default)
+
+def loads(raw: str) -> Any:
+    def object_hook(obj):
+        if len(obj) == 1 and "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        return obj
+    return json.loads(raw, object_hook=object_hook)
+
+class SharedBackend(ABC):
+    """共享状态的接口，值均为字符串；缺少任一存取方法的实现时无法实例化"""
+    name = "base"
+    # 是否真正跨进程共享
+    distributed = False
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._published = 0
+        self._received = 0
+        self._errors = 0
+
+    async def start(self):
+        """建立连接并开始接收广播"""
+
+    async def close(self):
+        """关闭连接"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr(self, key: str, ttl: float) -> int:
+        """计数加一并返回新值，计数在首次创建ttl秒后过期"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        """键不存在时以token加锁，ttl秒后自动释放，返回是否加锁成功；无法确认加锁成功时返回False"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release_lock(self, key: str, token: str):
+        """只释放自己持有的锁"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def publish(self, channel: str, message: Dict[str, Any]):
+        """向所有进程广播消息（包括自己，由订阅方按origin过滤）"""
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, handler: Handler):
+        """
+        注册广播消息的处理函数，需在start之前调用。
+        订阅中断后可能错过消息，恢复时会向处理函数发送{"reset": True}，收到后应丢弃全部本地缓存
+        """
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def _dispatch(self, channel: str, message: Dict[str, Any]):
+        self._received += 1
+        for handler in self._handlers.get(channel, []):
+            try:
+                await handler(message)
+            except Exception as e:
+                self._errors += 1
+                print(f"Shared state handler for {channel} failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "distributed": self.distributed,
+            "published": self._published,
+            "received": self._received,
+            "errors": self._errors
+        }
+
+class MemoryStore:
+    """
+    进程内的存储。多个MemoryBackend共用一个MemoryStore时相当于连接到同一个Redis，
+    可以在测试中模拟多个worker
+    """
+    # 每写入这么多次清理一遍已过期的键
+    SWEEP_INTERVAL = 1000
+
+    def __init__(self):
+        self.values: Dict[str, tuple] = {}
+        self.backends: List["MemoryBackend"] = []
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at is not None and expire_at <= time.monotonic():
+            del self.values[key]
+            return None
+        return value
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self.values[key] = (time.monotonic() + ttl if ttl else None, value)
+        self._writes += 1
+        if self._writes % self.SWEEP_INTERVAL == 0:
+            now = time.monotonic()
+            for expired in [k for k, (expire_at, _) in self.values.items() if expire_at is not None and expire_at <= now]:
+                del self.values[expired]
+
+class MemoryBackend(SharedBackend):
+    """进程内实现：未配置共享后端时使用，也用作测试中的替身"""
+    name = "memory"
+
+    def __init__(self, store: Optional[MemoryStore] = None):
+        super().__init__()
+        self.store = store or MemoryStore()
+        self.store.backends.append(self)
+        # 共用store的实例之间可以互相广播
+        self.distributed = store is not None
+
+    async def get(self, key: str) -> Optional[str]:
+        return self.store.get(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self.store.set(key, value, ttl)
+
+    async def delete(self, key: str):
+        self.store.values.pop(key, None)
+
+    async def incr(self, key: str, ttl: float) -> int:
+        current = self.store.get(key)
+        if current is None:
+            self.store.set(key, "1", ttl)
+            return 1
+        expire_at, _ = self.store.values[key]
+        value = int(current) + 1
+        self.store.values[key] = (expire_at, str(value))
+        return value
+
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        if self.store.get(key) is not None:
+            return False
+        self.store.set(key, token, ttl)
+        return True
+
+    async def release_lock(self, key: str, token: str):
+        if self.store.get(key) == token:
+            del self.store.values[key]
+
+    async def publish(self, channel: str, message: Dict[str, Any]):
+        self._published += 1
+        for backend in list(self.store.backends):
+            await backend._dispatch(channel, message)
+
+    async def close(self):
+        if self in self.store.backends:
+            self.store.backends.remove(self)
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+# 订阅中断后重新订阅的退避时间（秒）
+SUBSCRIBE_RETRY_BASE_DELAY = 1
+SUBSCRIBE_RETRY_MAX_DELAY = 30
+
+# 只删除值等于token的锁，避免误删其他进程在锁过期后重新加的锁
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+class RedisBackend(SharedBackend):
+    """
+    Redis实现（需要安装redis包）。Redis不可用时读操作返回未命中、计数视为成功，保证应用仍可继续服务；
+    加锁视为失败，由调用方决定是否在没有锁的情况下继续（例如SingleFlight改为自己调用）
+    """
+    name = "redis"
+    distributed = True
+
+    def __init__(self, url: str):
+        super().__init__()
+        if redis is None:
+            raise RuntimeError("SHARED_BACKEND_URL requires the redis package (pip install redis)")
+        self.client = redis.from_url(url, decode_responses=True)
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self._handlers:
+            return
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(*self._handlers)
+        self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self):
+        delay = SUBSCRIBE_RETRY_BASE_DELAY
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    await self._pubsub.subscribe(*self._handlers)
+                async for item in self._pubsub.listen():
+                    delay = SUBSCRIBE_RETRY_BASE_DELAY
+                    await self._dispatch(item["channel"], json.loads(item["data"]))
+                # listen()在订阅被取消时正常结束
+                print("Shared state subscription ended, resubscribing")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._errors += 1
+                print(f"Shared state subscription failed: {e}")
+            # 订阅结束或中断后按指数退避重新订阅，期间可能错过了失效消息，通知订阅方丢弃本地缓存
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SUBSCRIBE_RETRY_MAX_DELAY)
+            for channel in self._handlers:
+                await self._dispatch(channel, {"reset": True})
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+        if self._pubsub:
+            await self._pubsub.close()
+        await self.client.close()
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            return await self.client.get(key)
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state get failed: {e}")
+            return None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        try:
+            await self.client.set(key, value, px=int(ttl * 1000) if ttl else None)
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state set failed: {e}")
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(key)
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state delete failed: {e}")
+
+    async def incr(self, key: str, ttl: float) -> int:
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.incr(key)
+                pipe.pexpire(key, int(ttl * 1000), nx=True)
+                value, _ = await pipe.execute()
+            return value
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state incr failed: {e}")
+            return 0
+
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        try:
+            return bool(await self.client.set(key, token, nx=True, px=int(ttl * 1000)))
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state lock failed: {e}")
+            return False
+
+    async def release_lock(self, key: str, token: str):
+        try:
+            await self.client.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state unlock failed: {e}")
+
+    async def publish(self, channel: str, message: Dict[str, Any]):
+        self._published += 1
+        try:
+            await self.client.publish(channel, json.dumps(message))
+        except Exception as e:
+            self._errors += 1
+            print(f"Shared state publish failed: {e}")
+
+def create_shared_backend(url: str) -> SharedBackend:
+    if url:
+        return RedisBackend(url)
+    return MemoryBackend()
+
+shared_backend = create_shared_backend(settings.SHARED_BACKEND_URL)
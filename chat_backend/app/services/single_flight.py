@@ -0,0 +1,189 @@
+import time
+import uuid
+import asyncio
+from typing import Dict, Any, Callable, Awaitable, AsyncIterator, List, Optional
+
+class _StreamFlight:
+    """
+    一次正在进行的流式调用：缓存已收到的增量，后加入的订阅者先补发已有内容再接收新内容；
+    所有订阅者都在完成前离开时取消上游调用
+    """
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self._event = asyncio.Event()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        # 唤醒当前所有等待者，并为下一次更新准备新的事件
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                event = self._event
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await event.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.abandoned = True
+                self.task.cancel()
+
+    async def result(self) -> str:
+        return "".join([chunk async for chunk in self.subscribe()])
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一key同时只有一个上游调用，其余请求等待并共享同一结果。
+    阻塞调用和流式调用可以互相加入对方正在进行的调用。
+    指定跨进程共享的backend时，阻塞调用还会通过共享锁在多个进程之间合并
+    """
+    def __init__(self, backend=None, lock_ttl: float = 60, poll_interval: float = 0.1):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._leaders = 0
+        self._coalesced = 0
+        self.backend = backend
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._remote_coalesced = 0
+        # 每个阻塞调用当前的等待者数量
+        self._refs: Dict[asyncio.Future, int] = {}
+        self._cancelled = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        """执行或加入一次阻塞调用"""
+        flight = self._streams.get(key)
+        if flight is not None:
+            self._coalesced += 1
+            return await flight.result()
+
+        task = self._calls.get(key)
+        if task is None:
+            self._leaders += 1
+            task = asyncio.ensure_future(self._run(key, factory))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._on_call_done(key, t))
+        else:
+            self._coalesced += 1
+        return await self._join(task)
+
+    async def _join(self, task: asyncio.Future) -> str:
+        """
+        等待共享的调用：单个等待者被取消不影响其他等待者，
+        最后一个等待者也被取消时说明没有人需要结果，取消上游调用以尽快释放名额
+        """
+        self._refs[task] = self._refs.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._refs[task] -= 1
+            if self._refs[task] == 0:
+                del self._refs[task]
+                if not task.done():
+                    self._cancelled += 1
+                    task.cancel()
+
+    async def _run(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        """
+        本进程的领头调用。有跨进程backend时先抢共享锁，抢不到说明其他进程正在调用同一请求，
+        轮询等待其结果；对方失败或超时未写入结果时自己调用
+        """
+        if self.backend is None or not self.backend.distributed:
+            return await factory()
+
+        lock_key, result_key = f"flight:{key}", f"flight-result:{key}"
+        token = uuid.uuid4().hex
+        if await self.backend.acquire_lock(lock_key, token, self.lock_ttl):
+            try:
+                result = await factory()
+                await self.backend.set(result_key, result, ttl=self.lock_ttl)
+                return result
+            finally:
+                await self.backend.release_lock(lock_key, token)
+
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            result = await self.backend.get(result_key)
+            if result is not None:
+                self._remote_coalesced += 1
+                return result
+            if await self.backend.get(lock_key) is None:
+                # 锁已释放但没有结果，说明对方调用失败
+                break
+        return await factory()
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """执行或加入一次流式调用"""
+        task = self._calls.get(key)
+        if task is not None:
+            self._coalesced += 1
+            yield await self._join(task)
+            return
+
+        flight = self._streams.get(key)
+        if flight is None:
+            self._leaders += 1
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.ensure_future(self._produce(key, flight, factory))
+        else:
+            self._coalesced += 1
+
+        async for chunk in flight.subscribe():
+            yield chunk
+
+    async def _produce(self, key: str, flight: _StreamFlight, factory: Callable[[], AsyncIterator[str]]):
+        try:
+            async for chunk in factory():
+                flight.publish(chunk)
+        except BaseException as e:
+            flight.finish(e)
+            if isinstance(e, asyncio.CancelledError):
+                if flight.abandoned:
+                    self._cancelled += 1
+                raise
+        else:
+            flight.finish()
+        finally:
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+
+    def _on_call_done(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 标记异常已被读取，避免所有等待者都已离开时出现未处理异常的警告
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self._leaders,
+            "coalesced": self._coalesced,
+            "remote_coalesced": self._remote_coalesced,
+            "cancelled": self._cancelled
+        }
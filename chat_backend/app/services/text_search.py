@@ -0,0 +1,74 @@
+import re
+from typing import List, Dict, Optional
+
+# 连续的中日韩字符，或连续的字母数字
+_TOKEN_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+|[0-9a-zA-Z]+")
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]")
+
+def _is_cjk(run: str) -> bool:
+    return bool(_CJK_RE.match(run))
+
+def tokenize(text: str, max_terms: int = 0) -> List[str]:
+    """
+    生成写入消息文档terms字段的索引词：中文按单字和相邻两字（bigram）切分，
+    英文和数字按单词切分并转为小写；去重后按首次出现的顺序返回。
+    max_terms大于0时只保留前max_terms个索引词，之后才出现的词搜索不到
+    """
+    terms: Dict[str, None] = {}
+    for run in _TOKEN_RE.findall(text or ""):
+        if _is_cjk(run):
+            for index, char in enumerate(run):
+                terms[char] = None
+                if index + 1 < len(run):
+                    terms[run[index:index + 2]] = None
+        else:
+            terms[run.lower()] = None
+        if max_terms and len(terms) >= max_terms:
+            break
+    return list(terms)[:max_terms] if max_terms else list(terms)
+
+def query_terms(query: str) -> List[str]:
+    """
+    把搜索词切分为必须全部命中的索引词：中文优先使用bigram，只有单个汉字时才使用单字
+    """
+    terms: Dict[str, None] = {}
+    for run in _TOKEN_RE.findall(query or ""):
+        if _is_cjk(run):
+            if len(run) == 1:
+                terms[run] = None
+            for index in range(len(run) - 1):
+                terms[run[index:index + 2]] = None
+        else:
+            terms[run.lower()] = None
+    return list(terms)
+
+def score(content: str, query: str, terms: List[str]) -> float:
+    """
+    计算消息与搜索词的相关度：完整搜索词出现的次数权重最高，其次是各索引词出现的次数，较短的消息略微加分
+    """
+    text = content.lower()
+    phrase = query.strip().lower()
+    value = 0.0
+    if phrase:
+        value += 5.0 * text.count(phrase)
+    value += sum(min(text.count(term), 5) for term in terms)
+    return value / (1.0 + len(text) / 500.0)
+
+def snippet(content: str, query: str, terms: List[str], width: int = 80) -> str:
+    """
+    截取包含搜索词的片段，优先以完整搜索词定位，其次以第一个命中的索引词定位
+    """
+    text = content.lower()
+    position: Optional[int] = None
+    for needle in [query.strip().lower()] + terms:
+        if needle:
+            found = text.find(needle)
+            if found >= 0:
+                position = found
+                break
+    if position is None:
+        return content[:width] + ("..." if len(content) > width else "")
+
+    start = max(0, position - width // 4)
+    end = min(len(content), start + width)
+    return ("..." if start > 0 else "") + content[start:end] + ("..." if end < len(content) else "")
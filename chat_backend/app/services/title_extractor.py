@@ -0,0 +1,123 @@
+"""
+本地抽取式标题生成：从用户的第一条消息中去掉寒暄、客套和语气词，取第一个有内容的分句作为标题，
+超出长度时分词后去掉虚词，仍然超长时不抽取。只用正则和分词，不调用AI。
+
+安装jieba时使用jieba分词，否则按虚词切分中文；jieba词典在后台线程中加载，加载完成前同样使用后者。
+两者只在标题超出长度、需要去掉虚词压缩时有区别：按虚词切分会把含虚词字的实词切开
+（例如“目的”中的“的”被当作虚词去掉），压缩后的标题可能缺字，但不会超长，也不会返回寒暄或空标题。
+"""
+import re
+from typing import List, Optional
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:
+    jieba = None
+
+_CJK = "㐀-䶿一-鿿豈-﫿぀-ヿ가-힯"
+_CODE_RE = re.compile(r"```.*?(```|$)|`[^`\n]*`", re.S)
+_URL_RE = re.compile(r"https?://\S+|www\.\S+")
+# 分句：中英文句末标点、分号、换行，以及英文句点后的空格
+_CLAUSE_RE = re.compile(r"[。！？!?；;\n]+|\.(?:\s+|$)")
+_COMMA_RE = re.compile(r"[，,、]")
+# 句首的寒暄和客套，可以连续出现多个
+_LEADING_RE = re.compile(
+    r"^(?:"
+    r"你好|您好|嗨|哈喽|请问一下|请问|请你|请|麻烦你|麻烦|帮我|帮忙|能不能|能否|可不可以|可以|你能|您能|你可以|您可以|"
+    r"我想知道|我想问一下|我想问|想问一下|想问|我想了解|告诉我|给我|问一下|一下|"
+    r"hi|hello|hey|please|can you|could you|would you|help me|i want to know|i want to|i'd like to|tell me|"
+    r"[\s,，、:：~～]"
+    r")+",
+    re.I
+)
+# 句尾的语气词和客套
+_TRAILING_RE = re.compile(r"(?:吗|呢|吧|啊|呀|嘛|一下|谢谢|多谢|thanks|thank you|please|[\s?？!！.。,，~～、:：])+$", re.I)
+# 只有寒暄时不值得作为标题
+_GREETING_RE = re.compile(r"^(?:你好|您好|嗨|哈喽|在吗|在不在|谢谢|hi|hello|hey|thanks|test|测试)?$", re.I)
+# 压缩标题时去掉的虚词（jieba分词后按词过滤；未分词时作为中文的切分点）
+_STOP_WORDS = {
+    "的", "了", "着", "过", "是", "我", "你", "您", "他", "她", "它", "我们", "你们", "他们", "她们", "它们", "这", "那", "这个", "那个",
+    "在", "和", "与", "及", "而", "就", "都", "也", "还", "把", "被", "让", "给", "对", "从", "向", "吗", "呢", "吧", "啊",
+    "一个", "一些", "有没有", "是不是", "能", "会", "要", "想", "请", "帮", "一下", "以及", "并且", "而且", "或者", "还有",
+    "a", "an", "the", "to", "of", "for", "in", "on", "is", "are", "be", "do", "does", "i", "me", "my", "you", "your",
+    "it", "this", "that", "with", "and", "or", "how", "what", "can", "about", "between", "some", "any",
+}
+_HEURISTIC_RE = re.compile(rf"[{_CJK}]+|[0-9a-zA-Z][0-9a-zA-Z+#._-]*")
+# 未分词时的中文虚词，长的优先匹配
+_CJK_STOP_RE = re.compile("|".join(sorted((word for word in _STOP_WORDS if re.match(f"[{_CJK}]", word)), key=len, reverse=True)))
+
+def warm_up():
+    """加载jieba词典（约一秒），应在线程中调用"""
+    if jieba is not None:
+        jieba.initialize()
+
+def _segment(text: str) -> List[str]:
+    """分词，返回去掉标点和空白后的词"""
+    if jieba is not None and jieba.dt.initialized:
+        return [word for word in jieba.lcut(text) if _HEURISTIC_RE.match(word)]
+    words: List[str] = []
+    for run in _HEURISTIC_RE.findall(text):
+        if re.match(f"[{_CJK}]", run):
+            # 以虚词为界切开中文，虚词单独成词以便后续过滤
+            position = 0
+            for stop in _CJK_STOP_RE.finditer(run):
+                if stop.start() > position:
+                    words.append(run[position:stop.start()])
+                words.append(stop.group())
+                position = stop.end()
+            if position < len(run):
+                words.append(run[position:])
+        else:
+            words.append(run)
+    return words
+
+def _join(words: List[str], max_length: int) -> Optional[str]:
+    """
+    按原顺序拼接词语，相邻的英文单词之间加空格；超过长度上限时返回None，
+    按顺序截断会丢掉句末的主题（例如“如何在Ubuntu上安装CUDA”截断后只剩“如何Ubuntu上安装”）
+    """
+    title = ""
+    for word in words:
+        separator = " " if title and title[-1].isascii() and title[-1].isalnum() and word[0].isascii() else ""
+        title += separator + word
+    return title if len(title) <= max_length else None
+
+def _clean(clause: str) -> str:
+    previous = None
+    while clause != previous:
+        previous = clause
+        clause = _TRAILING_RE.sub("", _LEADING_RE.sub("", clause)).strip()
+    return clause
+
+def extract_title(text: str, max_length: int = 20) -> Optional[str]:
+    """
+    从消息中抽取不超过max_length个字符的标题；消息只有寒暄、代码或过短，
+    或去掉虚词后仍然超长时返回None，由调用方改用AI生成
+    """
+    text = _URL_RE.sub(" ", _CODE_RE.sub(" ", text or ""))
+    for clause in _CLAUSE_RE.split(text):
+        clause = _clean(" ".join(clause.split()))
+        if len(clause) >= 2 and not _GREETING_RE.match(clause):
+            break
+    else:
+        return None
+
+    if len(clause) > max_length:
+        # 优先使用第一个逗号之前的部分
+        head = _clean(_COMMA_RE.split(clause, 1)[0])
+        if 4 <= len(head) <= max_length:
+            clause = head
+    if len(clause) > max_length:
+        # 去掉虚词后仍然超长时不截断，由调用方改用AI生成
+        words = _segment(clause)
+        content = [word for word in words if word.lower() not in _STOP_WORDS]
+        joined = _join(content or words, max_length)
+        if joined is None:
+            return None
+        clause = _clean(joined)
+    if len(clause) < 2 or not _HEURISTIC_RE.search(clause):
+        return None
+    if clause[0].isascii():
+        clause = clause[0].upper() + clause[1:]
+    return clause
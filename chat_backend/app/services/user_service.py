@@ -10,6 +10,7 @@ from fastapi import UploadFile, HTTPException
 from app.database import db
 from app.config import settings
 from app.models.user import UserCreate, UserLogin, UserUpdate
+from app.services.shared_state import shared_backend, dumps, loads
 
 class UserService:
     def __init__(self):
@@ -113,7 +114,12 @@ class UserService:
         }
     
     async def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """获取用户信息"""
+        """获取用户信息，每个请求鉴权时都会调用，结果在共享缓存中保存USER_CACHE_TTL秒"""
+        if settings.USER_CACHE_TTL > 0:
+            cached = await shared_backend.get(f"user:{user_id}")
+            if cached is not None:
+                return loads(cached)
+        
         user = await db.db.users.find_one({"_id": ObjectId(user_id)})
         if user:
             # 转换ID为字符串
@@ -128,8 +134,15 @@ class UserService:
                 
             if "avatar_url" not in user:
                 user["avatar_url"] = None
+            
+            if settings.USER_CACHE_TTL > 0:
+                await shared_backend.set(f"user:{user_id}", dumps(user), ttl=settings.USER_CACHE_TTL)
         return user
     
+    async def _invalidate_user(self, user_id: str):
+        """用户信息修改后删除缓存"""
+        await shared_backend.delete(f"user:{user_id}")
+    
     async def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """通过邮箱获取用户"""
         user = await db.db.users.find_one({"email": email})
@@ -157,6 +170,7 @@ class UserService:
         
         if result.matched_count == 0:
             raise ValueError("User not found")
+        await self._invalidate_user(user_id)
             
         # 获取更新后的用户信息
         return await self.get_user(user_id)
@@ -205,6 +219,7 @@ class UserService:
                     "updated_at": now
                 }}
             )
+            await self._invalidate_user(user_id)
             
             return {"avatar_url": avatar_url}
             
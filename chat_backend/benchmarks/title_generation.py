@@ -0,0 +1,121 @@
+"""
+对比本地抽取标题与AI生成标题的耗时，并统计本地抽取能覆盖的比例（即可省去的上游调用）
+
+运行（在后端项目根目录下）：
+    python -m benchmarks.title_generation                      # 只测本地抽取
+    python -m benchmarks.title_generation --input first_messages.txt
+    python -m benchmarks.title_generation --llm 10             # 另外对前10条调用AI（需要配置模型密钥）
+
+--input为每行一条用户首条消息的文本文件，不指定时使用内置样例
+"""
+import time
+import asyncio
+import argparse
+import statistics
+from typing import List, Dict, Any
+
+from app.config import settings
+from app.services import title_extractor
+
+SAMPLES = [
+    "你好，请问如何学习Python？",
+    "怎么学习Python",
+    "帮我写一个快速排序的Python实现，要求支持自定义比较函数并且是原地排序",
+    "在吗？我想问一下机器学习和深度学习的区别是什么呢",
+    "请用通俗易懂的语言解释一下量子计算的基本原理以及它与经典计算的区别",
+    "我的电脑开机后蓝屏了，显示错误代码0x0000007B，该怎么办？",
+    "给我推荐几本关于历史的书",
+    "```python\nprint(1/0)\n```\n这段代码为什么报错",
+    "https://example.com 这个网站打不开",
+    "帮我把下面这段话翻译成英文：今天天气很好，我们去公园散步吧",
+    "Can you explain the difference between TCP and UDP?",
+    "How do I reverse a list in Python?",
+    "What is RAG?",
+    "Write a poem about autumn leaves falling in the quiet forest",
+    "你好",
+    "hi",
+    "谢谢",
+]
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        "max": ordered[-1],
+    }
+
+def bench_local(samples: List[str], rounds: int) -> Dict[str, Any]:
+    titles = [title_extractor.extract_title(text, settings.CHAT_TITLE_MAX_LENGTH) for text in samples]
+    timings = []
+    for _ in range(rounds):
+        for text in samples:
+            start = time.perf_counter()
+            title_extractor.extract_title(text, settings.CHAT_TITLE_MAX_LENGTH)
+            timings.append((time.perf_counter() - start) * 1e6)
+    return {
+        "titles": titles,
+        "covered": sum(1 for title in titles if title) / len(samples),
+        "us": percentiles(timings),
+    }
+
+async def bench_llm(samples: List[str]) -> Dict[str, Any]:
+    from app.services.ai_service import ai_service
+    from app.services.chat_service import ChatService
+
+    titles, timings = [], []
+    try:
+        for text in samples:
+            prompt = ChatService.title_prompt([{"role": "user", "content": text}])
+            start = time.perf_counter()
+            # 不使用回复缓存，测量真实的上游耗时
+            title = await ai_service.get_response(
+                [{"role": "user", "content": prompt}],
+                settings.CHAT_TITLE_MODEL_ID,
+                use_cache=False,
+                policy=settings.AI_BACKGROUND_ROUTING_POLICY,
+                priority="background"
+            )
+            timings.append((time.perf_counter() - start) * 1e3)
+            titles.append(title.strip())
+    finally:
+        await ai_service.close()
+    return {"titles": titles, "ms": percentiles(timings)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local title extraction against AI title generation")
+    parser.add_argument("--input", help="每行一条用户首条消息的文本文件")
+    parser.add_argument("--rounds", type=int, default=2000, help="本地抽取的重复轮数")
+    parser.add_argument("--llm", type=int, default=0, metavar="N", help="对前N条消息调用AI生成标题")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, encoding="utf-8") as f:
+            samples = [line.strip() for line in f if line.strip()]
+    else:
+        samples = SAMPLES
+
+    title_extractor.warm_up()
+    segmenter = "jieba" if title_extractor.jieba is not None else "heuristic"
+    local = bench_local(samples, args.rounds)
+    print(f"local ({segmenter}): {len(samples)} messages, {local['covered']:.0%} titled without AI")
+    print("  latency (us): " + ", ".join(f"{k}={v:.1f}" for k, v in local["us"].items()))
+
+    if args.llm:
+        try:
+            remote = asyncio.run(bench_llm(samples[:args.llm]))
+        except Exception as e:
+            print(f"llm benchmark failed (check the model configuration): {e!r}")
+            return
+        print(f"llm (model {settings.CHAT_TITLE_MODEL_ID}): {len(remote['titles'])} messages")
+        print("  latency (ms): " + ", ".join(f"{k}={v:.1f}" for k, v in remote["ms"].items()))
+        print(f"  speedup at p50: {remote['ms']['p50'] * 1e3 / local['us']['p50']:.0f}x")
+        for text, title in zip(samples, remote["titles"]):
+            print(f"  {text[:30]!r}: local={title_extractor.extract_title(text, settings.CHAT_TITLE_MAX_LENGTH)!r} llm={title!r}")
+    else:
+        for text, title in zip(samples, local["titles"]):
+            print(f"  {text[:30]!r}: {title!r}")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import uvicorn
 import os
@@ -7,6 +8,10 @@ from fastapi.staticfiles import StaticFiles  # 导入StaticFiles
 from app.api.routes import api_router
 from app.database import connect_to_mongo, close_mongo_connection
 from app.config import settings
+from app.services.ai_service import ai_service
+from app.services.background import background_runner
+from app.services.shared_state import shared_backend
+from app.services import title_extractor
 from fastapi.security import HTTPBearer
 
 @contextlib.asynccontextmanager
@@ -17,8 +22,14 @@ async def lifespan(app: FastAPI):
     os.makedirs(settings.AVATAR_DIR, exist_ok=True)
     
     await connect_to_mongo()
+    await shared_backend.start()
+    # 在线程中加载分词词典，不阻塞启动；加载完成前标题抽取使用简单切分
+    asyncio.get_running_loop().run_in_executor(None, title_extractor.warm_up)
     yield
     # 关闭事件 - 在应用关闭时执行
+    await background_runner.shutdown()
+    await ai_service.close()
+    await shared_backend.close()
     await close_mongo_connection()
 
 # 定义安全组件
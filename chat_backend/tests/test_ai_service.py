@@ -0,0 +1,200 @@
+"""
+AIService的测试：使用本地模拟provider，不访问网络
+"""
+import asyncio
+import pytest
+from app.config import settings
+from app.services.ai_service import AIService
+from app.services.resilience import CircuitOpenError, RetryPolicy
+from app.services.providers.base import LLMProvider, ProviderError
+from app.services.providers.mock import MockProvider
+
+class CountingProvider(MockProvider):
+    """记录上游调用次数和进行中的调用数的模拟provider"""
+    def __init__(self, **options):
+        super().__init__(**{"ttft_median": 0, "tokens_per_second": 0, "response_tokens": 5, "seed": 1, **options})
+        self.calls = 0
+        self.active = 0
+
+    async def create_completion(self, model, messages, **params):
+        self.calls += 1
+        self.active += 1
+        try:
+            return await super().create_completion(model, messages, **params)
+        finally:
+            self.active -= 1
+
+    async def stream_completion(self, model, messages, **params):
+        self.calls += 1
+        async for delta in super().stream_completion(model, messages, **params):
+            yield delta
+
+class ScriptedProvider(CountingProvider):
+    """按顺序执行预设的(耗时, 状态码)，状态码为None时成功，回复内容为调用序号"""
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+
+    async def create_completion(self, model, messages, **params):
+        self.calls += 1
+        self.active += 1
+        call = self.calls
+        try:
+            delay, status = self.outcomes.pop(0) if self.outcomes else (0, None)
+            await asyncio.sleep(delay)
+            if status is not None:
+                raise ProviderError("上游错误", status)
+            return f"第{call}次调用"
+        finally:
+            self.active -= 1
+
+@pytest.fixture
+def service():
+    service = AIService()
+    service.models = {"default": "mock:test"}
+    service.providers["mock"] = CountingProvider()
+    # 重试不等待
+    service.retry_policy = RetryPolicy(3, 0, 0)
+    return service
+
+@pytest.mark.asyncio
+async def test_chat_replies_are_not_cached_by_default(service):
+    provider = service.providers["mock"]
+    for _ in range(2):
+        await service.generate([{"role": "user", "content": "你好"}])
+        async for _ in service.stream_generate([{"role": "user", "content": "你好"}]):
+            pass
+    # 对话回复每次都调用上游，不会把一个用户的随机回复原样返回给另一个用户
+    assert provider.calls == 4
+    assert service.cache.stats()["entries"] == 0
+
+@pytest.mark.asyncio
+async def test_cache_is_opt_in(service):
+    provider = service.providers["mock"]
+    first = await service.get_response([{"role": "user", "content": "标题"}], use_cache=True)
+    second = await service.get_response([{"role": "user", "content": "标题"}], use_cache=True)
+    assert first == second
+    assert provider.calls == 1
+
+def test_incomplete_provider_cannot_be_instantiated():
+    class CompletionOnly(LLMProvider):
+        async def create_completion(self, model, messages, **params):
+            return ""
+
+    with pytest.raises(TypeError):
+        CompletionOnly()
+
+@pytest.mark.asyncio
+async def test_stream_records_upstream_latency(service):
+    service.providers["mock"] = CountingProvider(ttft_median=0.05, ttft_sigma=0)
+    async for event in service.stream_generate([{"role": "user", "content": "你好"}]):
+        # 调用方处理每段内容的时间不计入上游耗时
+        await asyncio.sleep(0.05)
+    latency = service.router.health("mock:test").latency
+    assert latency.count() == 1
+    assert 0.05 <= latency.percentile(50) < 0.2
+
+def enable_hedging(monkeypatch, service, threshold):
+    """启用对冲，并让近期延迟的分位数等于threshold"""
+    monkeypatch.setattr(settings, "AI_HEDGE_ENABLED", True)
+    monkeypatch.setattr(settings, "AI_HEDGE_MIN_SAMPLES", 1)
+    service.router.health("mock:test").latency.record(threshold)
+
+@pytest.mark.asyncio
+async def test_cancelling_during_hedge_wait_cancels_the_upstream_call(service, monkeypatch):
+    provider = CountingProvider(ttft_median=10, ttft_sigma=0)
+    service.providers["mock"] = provider
+    enable_hedging(monkeypatch, service, threshold=1)
+
+    task = asyncio.ensure_future(service.generate([{"role": "user", "content": "你好"}]))
+    await asyncio.sleep(0.01)
+    assert provider.active == 1
+    # 例如客户端断开连接
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0)
+    assert provider.active == 0
+    assert service.limiters["mock:test"].stats()["active"] == 0
+    assert service.breakers["mock:test"].stats()["state"] == "closed"
+
+@pytest.mark.asyncio
+async def test_breaker_counts_a_call_once_after_its_retries(service, monkeypatch):
+    monkeypatch.setattr(settings, "AI_BREAKER_FAILURE_THRESHOLD", 2)
+    provider = CountingProvider(error_rate=1, error_status=503)
+    service.providers["mock"] = provider
+
+    with pytest.raises(Exception, match="模拟的上游错误"):
+        await service.generate([{"role": "user", "content": "你好"}])
+    assert provider.calls == 3
+    assert service.breakers["mock:test"].stats()["consecutive_failures"] == 1
+
+    # 第二次调用在自己的重试中返回真实错误，之后熔断器才打开
+    with pytest.raises(Exception, match="模拟的上游错误"):
+        await service.generate([{"role": "user", "content": "你好"}])
+    assert provider.calls == 6
+    assert service.breakers["mock:test"].stats()["state"] == "open"
+    with pytest.raises(CircuitOpenError):
+        await service.generate([{"role": "user", "content": "你好"}])
+    assert provider.calls == 6
+
+@pytest.mark.asyncio
+async def test_retryable_error_is_retried(service):
+    provider = ScriptedProvider([(0, 503), (0, 429)])
+    service.providers["mock"] = provider
+    result = await service.generate([{"role": "user", "content": "你好"}])
+    assert result == {"content": "第3次调用", "model": "mock:test"}
+    assert service.counters["retries"] == 2
+    assert service.breakers["mock:test"].stats()["consecutive_failures"] == 0
+
+@pytest.mark.asyncio
+async def test_client_error_is_not_retried(service):
+    provider = ScriptedProvider([(0, 400)])
+    service.providers["mock"] = provider
+    with pytest.raises(Exception, match="上游错误"):
+        await service.generate([{"role": "user", "content": "你好"}])
+    assert provider.calls == 1
+    assert service.counters["retries"] == 0
+    # 上游可达，不计入熔断
+    assert service.breakers["mock:test"].stats() == {"state": "closed", "consecutive_failures": 0, "open_count": 0, "rejected": 0}
+
+@pytest.mark.asyncio
+async def test_breaker_opens_then_probes_then_closes(service, monkeypatch):
+    monkeypatch.setattr(settings, "AI_BREAKER_FAILURE_THRESHOLD", 1)
+    monkeypatch.setattr(settings, "AI_BREAKER_RESET_TIMEOUT", 0.05)
+    provider = ScriptedProvider([(0, 503)] * 3 + [(0.05, None)])
+    service.providers["mock"] = provider
+    breaker = service._get_breaker("mock:test")
+
+    with pytest.raises(Exception, match="上游错误"):
+        await service.generate([{"role": "user", "content": "你好"}])
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        await service.generate([{"role": "user", "content": "你好"}])
+    assert provider.calls == 3
+
+    # 冷却结束后只放行一个探测请求
+    await asyncio.sleep(0.06)
+    probe = asyncio.ensure_future(service.generate([{"role": "user", "content": "你好"}]))
+    await asyncio.sleep(0.01)
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError, match="恢复中"):
+        await service.generate([{"role": "user", "content": "你好"}])
+
+    assert (await probe)["content"] == "第4次调用"
+    assert breaker.stats()["state"] == "closed"
+    assert breaker.stats()["open_count"] == 1
+
+@pytest.mark.asyncio
+async def test_hedge_wins_when_the_primary_is_slow(service, monkeypatch):
+    provider = ScriptedProvider([(1, None), (0, None)])
+    service.providers["mock"] = provider
+    enable_hedging(monkeypatch, service, threshold=0.01)
+
+    result = await service.generate([{"role": "user", "content": "你好"}])
+    assert result["content"] == "第2次调用"
+    assert service.counters["hedges"] == 1 and service.counters["hedge_wins"] == 1
+    # 较慢的首次请求被取消，名额已归还
+    await asyncio.sleep(0)
+    assert provider.active == 0
+    assert service.limiters["mock:test"].stats()["active"] == 0
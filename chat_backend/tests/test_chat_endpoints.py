@@ -0,0 +1,65 @@
+"""
+聊天接口的测试：直接调用接口函数，用替身替换ChatService，不需要MongoDB
+"""
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.api.endpoints import chat as chat_endpoints
+
+pytestmark = pytest.mark.asyncio
+
+class StubEvents:
+    """替换add_message_stream返回的生成器，记录是否被关闭"""
+    def __init__(self, events=(), error=None):
+        self.events = list(events)
+        self.error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.error is not None:
+            raise self.error
+        if not self.events:
+            raise StopAsyncIteration
+        return self.events.pop(0)
+
+    async def aclose(self):
+        self.closed = True
+
+@pytest.fixture
+def stub_events(monkeypatch):
+    def install(events=(), error=None):
+        stub = StubEvents(events, error)
+        monkeypatch.setattr(chat_endpoints.chat_service, "add_message_stream", lambda *args, **kwargs: stub)
+        return stub
+    return install
+
+async def send(chat_id="chat"):
+    return await chat_endpoints.add_message_stream(chat_id, "你好", None, {"_id": "u"})
+
+@pytest.mark.parametrize("error, status_code", [(ValueError("Chat not found"), 404), (PermissionError(), 403)])
+async def test_errors_before_the_stream_close_the_generator(stub_events, error, status_code):
+    stub = stub_events(error=error)
+    with pytest.raises(HTTPException) as raised:
+        await send()
+    assert raised.value.status_code == status_code
+    assert stub.closed
+
+async def test_cancelled_before_the_stream_closes_the_generator(stub_events):
+    stub = stub_events(error=asyncio.CancelledError())
+    with pytest.raises(asyncio.CancelledError):
+        await send()
+    assert stub.closed
+
+async def test_abandoned_stream_closes_the_generator(stub_events):
+    stub = stub_events([{"type": "start", "chat_id": "chat"}, {"type": "delta", "content": "你"}])
+    response = await send()
+    body = response.body_iterator
+    assert (await body.__anext__()).startswith("event: start")
+    assert not stub.closed
+
+    # 客户端中途断开，Starlette关闭响应体
+    await body.aclose()
+    assert stub.closed
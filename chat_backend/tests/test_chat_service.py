@@ -0,0 +1,388 @@
+"""
+ChatService的测试：用替身替换消息存储，只验证服务层的读写次数和缓存行为，不需要MongoDB
+"""
+import asyncio
+import pytest
+from bson import ObjectId
+from app.config import settings
+from app.services import chat_service as chat_service_module
+from app.services.ai_service import AIService
+from app.services.chat_service import ChatService
+from app.services.shared_state import MemoryBackend, MemoryStore
+from tests.test_ai_service import CountingProvider
+
+pytestmark = pytest.mark.asyncio
+
+class FakeMessageStore:
+    """记录每个方法被调用的次数，序号按对话递增"""
+    def __init__(self):
+        self.chats = {}
+        self.messages = {}
+        self.calls = {"reserve": 0, "get_context": 0, "get_pinned": 0, "get_recent": 0, "insert": 0}
+
+    def add_chat(self, user_id="u", pinned=True):
+        chat_id = str(ObjectId())
+        self.chats[chat_id] = {"_id": ObjectId(chat_id), "user_id": user_id, "model_id": "default", "message_seq": 0, "message_count": 0}
+        self.messages[chat_id] = []
+        if pinned:
+            self.chats[chat_id]["message_seq"] = 1
+            self.messages[chat_id].append({"seq": 1, "role": "user", "content": "设定", "hidden": True})
+        return chat_id
+
+    async def reserve(self, chat_id, user_id, count, projection):
+        self.calls["reserve"] += 1
+        chat = self.chats.get(chat_id)
+        if chat is None or (user_id is not None and chat["user_id"] != user_id):
+            return None
+        chat["message_seq"] += count
+        return dict(chat)
+
+    async def get_context(self, chat_id, limit, after_seq=0):
+        self.calls["get_context"] += 1
+        messages = self.messages[chat_id]
+        pinned = [dict(message) for message in messages if message.get("hidden")]
+        recent = [dict(message) for message in messages if not message.get("hidden") and message["seq"] > after_seq][-limit:]
+        return pinned, recent
+
+    async def get_pinned(self, chat_id):
+        self.calls["get_pinned"] += 1
+        return [dict(message) for message in self.messages[chat_id] if message.get("hidden")]
+
+    async def get_recent(self, chat_id, limit, after_seq=0):
+        self.calls["get_recent"] += 1
+        return [dict(message) for message in self.messages[chat_id] if message["seq"] > after_seq][-limit:]
+
+    async def insert(self, chat_id, user_id, messages, touch=True):
+        self.calls["insert"] += 1
+        # 写入需要时间，期间其他任务可以运行
+        await asyncio.sleep(0.01)
+        self.messages[chat_id].extend(dict(message) for message in messages)
+        self.chats[chat_id]["message_count"] += len(messages)
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeMessageStore()
+    for name in ("reserve", "get_context", "get_pinned", "get_recent", "insert"):
+        monkeypatch.setattr(chat_service_module.message_store, name, getattr(store, name))
+    monkeypatch.setattr(settings, "CHAT_CONTEXT_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "AI_SUMMARY_ENABLED", False)
+    monkeypatch.setattr(settings, "CHAT_TITLE_AUTO_GENERATE", False)
+    return store
+
+def reply_to(service, store, chat_id, user_message, content="好的"):
+    """模拟一轮对话成功后的写入：消息写入存储并追加到上下文缓存"""
+    assistant = {"role": "assistant", "content": content, "seq": user_message["seq"] + 1}
+    store.messages[chat_id].extend([dict(user_message), assistant])
+    service.context_cache.append(chat_id, [user_message, assistant])
+
+async def test_cache_hit_skips_message_reads(store):
+    service = ChatService()
+    chat_id = store.add_chat()
+
+    _, first, history = await service._prepare_turn(chat_id, "第一个问题", user_id="u")
+    assert store.calls["get_context"] == 1
+    assert [message["content"] for message in history[-2:]] == ["设定", "第一个问题"]
+    reply_to(service, store, chat_id, first)
+
+    # 命中缓存：只有预留序号的一次操作（同时校验归属和缓存是否最新），不读取消息
+    _, second, history = await service._prepare_turn(chat_id, "第二个问题", user_id="u")
+    assert store.calls == {"reserve": 2, "get_context": 1, "get_pinned": 0, "get_recent": 0, "insert": 0}
+    assert second["seq"] == 4
+    assert [message["content"] for message in history if message["role"] != "system"] == ["设定", "第一个问题", "好的", "第二个问题"]
+    assert service.context_cache.stats()["hits"] == 1
+
+async def test_cache_is_bypassed_after_a_write_from_elsewhere(store):
+    service = ChatService()
+    chat_id = store.add_chat()
+    _, first, _ = await service._prepare_turn(chat_id, "第一个问题", user_id="u")
+    reply_to(service, store, chat_id, first)
+
+    # 其他进程在两轮之间预留了序号，缓存不再连续，重新读取
+    store.chats[chat_id]["message_seq"] += 2
+    await service._prepare_turn(chat_id, "第二个问题", user_id="u")
+    assert store.calls["get_context"] == 2
+
+async def test_other_users_chat_is_rejected(store):
+    service = ChatService()
+    chat_id = store.add_chat(user_id="owner")
+
+    async def owner_miss(chat_id, user_id):
+        raise PermissionError("Not allowed to access this chat")
+
+    service._check_owner_miss = owner_miss
+    with pytest.raises(PermissionError):
+        await service._prepare_turn(chat_id, "hi", user_id="intruder")
+
+async def test_invalidation_from_one_worker_drops_the_others_cache(store, monkeypatch):
+    # 两个worker各自连接到同一个共享存储
+    shared = MemoryStore()
+    workers = []
+    for name in ("a", "b"):
+        monkeypatch.setattr(chat_service_module, "shared_backend", MemoryBackend(shared))
+        service = ChatService()
+        service.worker_id = name
+        workers.append(service)
+    first, second = workers
+    chat_id = store.add_chat()
+
+    _, user_message, _ = await first._prepare_turn(chat_id, "第一个问题", user_id="u")
+    reply_to(first, store, chat_id, user_message)
+    await second._prepare_turn(chat_id, "第二个问题", user_id="u")
+    assert first.context_cache.stats()["entries"] == 1
+    assert second.context_cache.stats()["entries"] == 1
+
+    # second修改了对话（例如重命名），first的缓存被丢弃，second不会处理自己发出的消息
+    await second._invalidate_context(chat_id)
+    assert first.context_cache.stats()["entries"] == 0
+    assert first.context_cache.stats()["invalidations"] == 1
+    assert second.context_cache.stats()["invalidations"] == 1
+
+    reads = store.calls["get_context"]
+    await first._prepare_turn(chat_id, "第三个问题", user_id="u")
+    assert store.calls["get_context"] == reads + 1
+
+class StubStream:
+    """替换ai_service.stream_generate：记录每次收到的消息历史，以及上游的流是否被关闭"""
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.histories = []
+        self.closed = 0
+
+    async def __call__(self, messages, model_id=None, policy=None, **kwargs):
+        self.histories.append(messages)
+        try:
+            yield {"model": "mock:test"}
+            for delta in self.deltas:
+                await asyncio.sleep(0)
+                yield {"delta": delta}
+        finally:
+            self.closed += 1
+
+async def test_partial_reply_is_saved_before_the_next_turn(store, monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_SAVE_PARTIAL_ON_DISCONNECT", True)
+    stream = StubStream(["部分", "回复", "没有发完"])
+    monkeypatch.setattr(chat_service_module.ai_service, "stream_generate", stream)
+    service = ChatService()
+    chat_id = store.add_chat()
+
+    # 客户端收到两段内容后断开
+    events = service.add_message_stream(chat_id, "第一个问题", user_id="u")
+    assert (await events.__anext__())["type"] == "start"
+    await events.__anext__()
+    await events.__anext__()
+    await events.aclose()
+    assert stream.closed == 1
+
+    # 下一轮等待部分回复写入后才开始，上下文中包含它
+    async for event in service.add_message_stream(chat_id, "第二个问题", user_id="u"):
+        pass
+    assert event["type"] == "done"
+    contents = [message["content"] for message in stream.histories[1]]
+    assert contents[-3:] == ["第一个问题", "部分回复", "第二个问题"]
+    assert [message.get("partial") for message in store.messages[chat_id] if message["role"] == "assistant"] == [True, None]
+    assert service.counters["partial_replies_saved"] == 1
+    assert service.turn_locks.stats()["keys"] == 0
+
+class StubChats:
+    """替换db.db.chats：前pending_polls次查询时初始回复仍在生成，之后写入回复并清除reply_pending"""
+    def __init__(self, store, chat_id, pending_polls):
+        self.store = store
+        self.chat_id = chat_id
+        self.pending_polls = pending_polls
+        self.polls = 0
+        self.updates = []
+
+    async def find_one(self, query, projection=None):
+        self.polls += 1
+        if self.polls <= self.pending_polls:
+            return {"_id": query["_id"], "reply_pending": True}
+        if self.polls == self.pending_polls + 1:
+            self.store.messages[self.chat_id].append({"seq": 2, "role": "assistant", "content": "好的，明白", "hidden": True})
+            del self.store.chats[self.chat_id]["reply_pending"]
+        return {"_id": query["_id"]}
+
+    async def update_one(self, query, update):
+        # 只支持按reply_pending条件清除
+        assert query.get("reply_pending") is True
+        self.updates.append(update)
+        self.store.chats[self.chat_id].pop("reply_pending", None)
+
+class StubDatabase:
+    def __init__(self, chats):
+        self.chats = chats
+
+def pending_chat(store, monkeypatch, pending_polls):
+    """另一个进程刚创建的对话：序号1、2已预留，初始回复尚未写入"""
+    chat_id = store.add_chat()
+    store.chats[chat_id].update({"message_seq": 2, "reply_pending": True})
+    chats = StubChats(store, chat_id, pending_polls)
+    monkeypatch.setattr(chat_service_module.db, "db", StubDatabase(chats))
+    monkeypatch.setattr(chat_service_module, "INITIAL_REPLY_POLL_INTERVAL", 0.001)
+    return chat_id, chats
+
+async def test_waits_for_initial_reply_from_another_worker(store, monkeypatch):
+    chat_id, chats = pending_chat(store, monkeypatch, pending_polls=2)
+    service = ChatService()
+
+    chat, user_message, history = await service._prepare_turn(chat_id, "第一个问题", user_id="u")
+    assert chats.polls == 3
+    assert user_message["seq"] == 3
+    assert [message["content"] for message in history if message["role"] != "system"] == ["设定", "好的，明白", "第一个问题"]
+    # 缓存的对话字段中不保留reply_pending
+    assert "reply_pending" not in chat
+
+async def test_stops_waiting_for_initial_reply_after_timeout(store, monkeypatch):
+    chat_id, chats = pending_chat(store, monkeypatch, pending_polls=10 ** 6)
+    monkeypatch.setattr(settings, "CHAT_INITIAL_REPLY_WAIT", 0.02)
+    service = ChatService()
+
+    _, first, history = await service._prepare_turn(chat_id, "第一个问题", user_id="u")
+    assert service.counters["initial_reply_timeouts"] == 1
+    assert [message["content"] for message in history if message["role"] != "system"] == ["设定", "第一个问题"]
+    # 超时后清除reply_pending，之后的消息不再等待
+    assert chats.updates == [{"$unset": {"reply_pending": ""}, "$set": {"reply_error": "timed out"}}]
+    reply_to(service, store, chat_id, first)
+    polls = chats.polls
+    await service._prepare_turn(chat_id, "第二个问题", user_id="u")
+    assert chats.polls == polls
+    assert service.counters["initial_reply_timeouts"] == 1
+
+class RecordingChats:
+    def __init__(self):
+        self.updates = []
+        self.inserted = []
+        self.deleted = []
+
+    async def insert_one(self, document):
+        document["_id"] = ObjectId()
+        self.inserted.append(document)
+        return type("InsertOneResult", (), {"inserted_id": document["_id"]})()
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+    async def delete_one(self, query):
+        self.deleted.append(query)
+
+async def test_identical_initial_messages_share_one_upstream_call(store, monkeypatch):
+    ai = AIService()
+    ai.models = {"default": "mock:test"}
+    provider = CountingProvider(ttft_median=0.02, ttft_sigma=0)
+    ai.providers["mock"] = provider
+    monkeypatch.setattr(chat_service_module, "ai_service", ai)
+    chats = RecordingChats()
+    monkeypatch.setattr(chat_service_module.db, "db", StubDatabase(chats))
+    service = ChatService()
+
+    # 大量用户同时用相同的初始消息创建对话
+    chat_ids = [store.add_chat() for _ in range(3)]
+    for chat_id in chat_ids:
+        await service.turn_locks.acquire(chat_id)
+    await asyncio.gather(*(service._generate_initial_reply(chat_id, "u", "default", "扮演一名英语老师") for chat_id in chat_ids))
+    assert provider.calls == 1
+    assert ai.flights.stats()["coalesced"] == 2
+    assert len({store.messages[chat_id][-1]["content"] for chat_id in chat_ids}) == 1
+
+    # 之后的相同初始消息命中缓存
+    later = store.add_chat()
+    await service.turn_locks.acquire(later)
+    await service._generate_initial_reply(later, "u", "default", "扮演一名英语老师")
+    assert provider.calls == 1
+    assert all("reply_error" not in update.get("$set", {}) for _, update in chats.updates)
+    assert service.turn_locks.stats()["keys"] == 0
+
+async def test_cancelled_initial_reply_clears_reply_pending(store, monkeypatch):
+    started = asyncio.Event()
+
+    async def never_answers(*args, **kwargs):
+        started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(chat_service_module.ai_service, "generate", never_answers)
+    chats = RecordingChats()
+    monkeypatch.setattr(chat_service_module.db, "db", StubDatabase(chats))
+    service = ChatService()
+    chat_id = store.add_chat()
+    await service.turn_locks.acquire(chat_id)
+
+    # 例如进程关闭时background_runner取消后台任务
+    task = asyncio.ensure_future(service._generate_initial_reply(chat_id, "u", "default", "你好"))
+    await started.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert chats.updates == [({"_id": ObjectId(chat_id)}, {"$unset": {"reply_pending": ""}, "$set": {"reply_error": "cancelled"}})]
+    assert service.turn_locks.stats()["keys"] == 0
+
+async def test_failed_initial_message_write_removes_the_chat(store, monkeypatch):
+    async def failing_insert(*args, **kwargs):
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(chat_service_module.message_store, "insert", failing_insert)
+    chats = RecordingChats()
+    monkeypatch.setattr(chat_service_module.db, "db", StubDatabase(chats))
+    service = ChatService()
+
+    with pytest.raises(RuntimeError):
+        await service.create_chat("u", "新对话", "default", initial_message="你好")
+    # 不会留下reply_pending永远为True的对话，也不会启动初始回复
+    assert chats.deleted == [{"_id": chats.inserted[0]["_id"]}]
+    assert chats.updates == []
+    assert service.turn_locks.stats()["keys"] == 0
+
+class TitleChats:
+    """替换db.db.chats：只有一个对话，记录标题的更新"""
+    def __init__(self, chat):
+        self.chat = chat
+        self.updates = []
+
+    async def find_one(self, query, projection=None):
+        return dict(self.chat)
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+@pytest.fixture
+def titled_chat(store, monkeypatch):
+    chat_id = str(ObjectId())
+    chats = TitleChats({"_id": ObjectId(chat_id), "user_id": "u", "title": "我的标题", "title_source": "user", "message_count": 2})
+
+    async def get_messages(chat_id, include_hidden=True, after_seq=0, limit=None):
+        return [{"role": "user", "content": "如何学习Python？"}, {"role": "assistant", "content": "先学基础语法"}]
+
+    async def get_response(messages, model_id=None, **kwargs):
+        return "Python学习路线"
+
+    monkeypatch.setattr(chat_service_module.db, "db", StubDatabase(chats))
+    monkeypatch.setattr(chat_service_module.message_store, "get_messages", get_messages)
+    monkeypatch.setattr(chat_service_module.ai_service, "get_response", get_response)
+    return chat_id, chats
+
+async def test_background_title_keeps_a_manual_title(titled_chat):
+    chat_id, chats = titled_chat
+    assert await ChatService().generate_title(chat_id) == "我的标题"
+    assert chats.updates == []
+
+async def test_requested_title_replaces_a_manual_title(titled_chat):
+    chat_id, chats = titled_chat
+    service = ChatService()
+    assert await service.generate_title(chat_id, force=True) == "Python学习路线"
+    query, update = chats.updates[0]
+    assert update["$set"]["title"] == "Python学习路线"
+    assert update["$set"]["title_source"] == "auto"
+    # 只替换请求时的标题，生成期间用户又改了标题时保留用户的
+    assert query["$or"] == [{"title_source": {"$ne": "user"}}, {"title": "我的标题"}]
+
+    # 生成后没有新消息，再次明确请求仍然重新生成
+    chats.chat.update(title="Python学习路线", title_source="auto", title_message_count=2)
+    await service.generate_title(chat_id, force=True)
+    assert len(chats.updates) == 2
+
+async def test_request_title_schedules_a_forced_generation(titled_chat, monkeypatch):
+    chat_id, chats = titled_chat
+    service = ChatService()
+    scheduled = []
+    monkeypatch.setattr(service, "schedule_title", lambda chat_id, force=False: scheduled.append((chat_id, force)))
+    result = await service.request_title(chat_id, user_id="u")
+    assert result["title"] == "我的标题"
+    assert scheduled == [(chat_id, True)]
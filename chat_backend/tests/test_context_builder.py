@@ -0,0 +1,97 @@
+"""
+ContextBuilder的测试：token预算内的截断、设定消息保留、窗口起点、超长消息省略，以及跳过已摘要的消息
+"""
+import pytest
+from app.config import settings
+from app.services.context_builder import ContextBuilder, ELISION_MARKER, MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+MODEL = "test-model"
+SYSTEM_PROMPT = "系统"
+
+def conversation(count, tokens=100):
+    """序号1到count的对话，奇数为用户消息、偶数为助手回复，最后一条是本轮的用户消息"""
+    return [
+        {"seq": seq, "role": "user" if seq % 2 else "assistant", "content": f"m{seq}", "tokens": tokens}
+        for seq in range(1, count + 1)
+    ]
+
+@pytest.fixture
+def fit(monkeypatch):
+    """设置恰好能放下n条（每条tokens个token）消息的预算"""
+    monkeypatch.setattr(settings, "AI_CONTEXT_RESPONSE_RESERVE", 0)
+    monkeypatch.setattr(settings, "AI_CONTEXT_MAX_MESSAGE_TOKENS", 2000)
+
+    def budget(n, tokens=100, extra=0):
+        base = estimate_tokens(SYSTEM_PROMPT, MODEL) + MESSAGE_OVERHEAD_TOKENS
+        monkeypatch.setattr(settings, "AI_CONTEXT_TOKEN_BUDGET", {"default": base + n * (tokens + MESSAGE_OVERHEAD_TOKENS) + extra})
+    return budget
+
+def contents(context):
+    return [message["content"] for message in context["messages"][1:]]
+
+def test_keeps_the_newest_messages_within_budget(fit):
+    fit(3)
+    context = ContextBuilder().build(conversation(9), MODEL, system_prompt=SYSTEM_PROMPT)
+    assert contents(context) == ["m7", "m8", "m9"]
+    assert context["window_start"] == 7
+    assert context["messages"][0] == {"role": "system", "content": SYSTEM_PROMPT}
+
+def test_current_message_is_kept_even_over_budget(fit):
+    fit(0)
+    context = ContextBuilder().build(conversation(3), MODEL, system_prompt=SYSTEM_PROMPT)
+    assert contents(context) == ["m3"]
+    assert context["window_start"] == 3
+
+def test_pinned_messages_are_always_kept(fit):
+    messages = conversation(9)
+    for message in messages[:2]:
+        message["hidden"] = True
+    # 预算只够设定消息和另外三条
+    fit(5)
+    context = ContextBuilder().build(messages, MODEL, system_prompt=SYSTEM_PROMPT)
+    assert contents(context) == ["m1", "m2", "m7", "m8", "m9"]
+    assert context["pinned_until"] == 2
+    assert context["window_start"] == 7
+
+def test_window_never_starts_with_an_assistant_reply(fit):
+    fit(2)
+    context = ContextBuilder().build(conversation(9), MODEL, system_prompt=SYSTEM_PROMPT)
+    # 放得下m8和m9，但m8是助手回复，被去掉
+    assert contents(context) == ["m9"]
+    assert context["window_start"] == 9
+
+def test_long_message_is_elided_in_the_middle(fit, monkeypatch):
+    fit(3)
+    monkeypatch.setattr(settings, "AI_CONTEXT_MAX_MESSAGE_TOKENS", 50)
+    content = "开头" + "中" * 500 + "结尾"
+    messages = [{"seq": 1, "role": "user", "content": content, "tokens": estimate_tokens(content, MODEL)}]
+    context = ContextBuilder().build(messages, MODEL, system_prompt=SYSTEM_PROMPT)
+
+    elided = context["messages"][1]["content"]
+    assert ELISION_MARKER in elided
+    assert elided.startswith("开头") and elided.endswith("结尾")
+    assert len(elided) < len(content)
+    assert estimate_tokens(elided.replace(ELISION_MARKER, ""), MODEL) <= 50 + 2
+
+def test_short_messages_are_not_elided(fit):
+    fit(3)
+    context = ContextBuilder().build(conversation(1), MODEL, system_prompt=SYSTEM_PROMPT)
+    assert contents(context) == ["m1"]
+
+def test_summarized_messages_are_not_sent(fit):
+    messages = conversation(9)
+    messages[0]["hidden"] = True
+    fit(20)
+    context = ContextBuilder().build(messages, MODEL, system_prompt=SYSTEM_PROMPT, summary="之前聊了m2到m6", summary_until=6)
+    # 设定消息仍然保留，序号不大于6的其余消息由摘要代替
+    assert contents(context) == ["m1", "m7", "m8", "m9"]
+    assert "之前聊了m2到m6" in context["messages"][0]["content"]
+    assert context["window_start"] == 7
+
+def test_summary_counts_against_the_budget(fit):
+    fit(3)
+    summary = "摘" * 200
+    context = ContextBuilder().build(conversation(9), MODEL, system_prompt=SYSTEM_PROMPT, summary=summary, summary_until=2)
+    # 摘要占用了预算，能放下的最近消息变少
+    assert len(contents(context)) < 3
+    assert contents(context)[-1] == "m9"
@@ -0,0 +1,41 @@
+"""
+对话列表接口的测试：直接调用接口函数，分页游标的编码和解码，不需要MongoDB
+"""
+from datetime import datetime, timezone
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+from app.config import settings
+from app.api.endpoints import history as history_endpoints
+from app.services.chat_service import ChatService
+
+pytestmark = pytest.mark.asyncio
+
+async def test_cursor_round_trips():
+    service = ChatService()
+    chat = {"_id": ObjectId(), "updated_at": datetime(2024, 5, 1, 12, 30, 15, 123000, tzinfo=timezone.utc)}
+    cursor = service._encode_cursor(chat)
+    assert "=" not in cursor
+    assert service._decode_cursor(cursor) == (chat["updated_at"], chat["_id"])
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "eyJ1IjogIngifQ", "e30"])
+async def test_malformed_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as raised:
+        await history_endpoints.get_user_chats(limit=None, cursor=cursor, current_user={"_id": "u"})
+    assert raised.value.status_code == 400
+    assert raised.value.detail == "Invalid cursor"
+
+async def test_chat_list_uses_its_own_page_size(monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_PAGE_SIZE", 50)
+    monkeypatch.setattr(settings, "CHAT_LIST_PAGE_SIZE", 20)
+    monkeypatch.setattr(settings, "CHAT_LIST_MAX_PAGE_SIZE", 100)
+    limits = []
+
+    async def get_user_chats_page(user_id, limit, cursor=None):
+        limits.append(limit)
+        return {"chats": [], "next_cursor": None}
+
+    monkeypatch.setattr(history_endpoints.chat_service, "get_user_chats_page", get_user_chats_page)
+    await history_endpoints.get_user_chats(limit=None, cursor="c", current_user={"_id": "u"})
+    await history_endpoints.get_user_chats(limit=500, cursor=None, current_user={"_id": "u"})
+    assert limits == [20, 100]
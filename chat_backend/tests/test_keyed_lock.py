@@ -0,0 +1,73 @@
+"""
+KeyedLock的测试：同一key互斥、不同key互不影响，以及没有持有者和等待者时清理条目
+"""
+import asyncio
+import pytest
+from app.services.concurrency import KeyedLock
+
+pytestmark = pytest.mark.asyncio
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+async def test_same_key_runs_in_order_and_other_keys_do_not_wait():
+    locks = KeyedLock()
+    log = []
+    release = asyncio.Event()
+
+    async def turn(key, name):
+        async with locks.hold(key):
+            log.append(name)
+            await release.wait()
+
+    tasks = [asyncio.ensure_future(turn("a", "a1")), asyncio.ensure_future(turn("a", "a2")), asyncio.ensure_future(turn("b", "b1"))]
+    await settle()
+    assert log == ["a1", "b1"]
+    assert locks.queued("a") == 1
+    assert locks.queued("b") == 0
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert log == ["a1", "b1", "a2"]
+    assert locks.stats() == {"keys": 0, "waiting": 0, "contended": 1}
+
+async def test_entry_removed_after_hold_and_after_exception():
+    locks = KeyedLock()
+    async with locks.hold("a"):
+        assert locks.stats()["keys"] == 1
+    assert locks.stats()["keys"] == 0
+
+    with pytest.raises(RuntimeError):
+        async with locks.hold("a"):
+            raise RuntimeError("boom")
+    assert locks.stats()["keys"] == 0
+
+async def test_cancelled_waiter_leaves_no_entry():
+    locks = KeyedLock()
+    await locks.acquire("a")
+    waiter = asyncio.ensure_future(locks.acquire("a"))
+    await settle()
+    assert locks.queued("a") == 1
+
+    waiter.cancel()
+    await settle()
+    assert locks.queued("a") == 0
+    locks.release("a")
+    assert locks.stats()["keys"] == 0
+
+async def test_release_from_another_task():
+    locks = KeyedLock()
+    await locks.acquire("a")
+    follower = asyncio.ensure_future(locks.acquire("a"))
+    await settle()
+    assert not follower.done()
+
+    # 持有者把锁交给后台任务，由后台任务释放
+    async def background():
+        locks.release("a")
+
+    await asyncio.ensure_future(background())
+    await follower
+    locks.release("a")
+    assert locks.stats()["keys"] == 0
@@ -0,0 +1,92 @@
+"""
+MessageStore的测试：用替身集合记录发出的查询，不需要MongoDB
+"""
+import pytest
+from app.database import db
+from app.services.message_store import message_store
+
+pytestmark = pytest.mark.asyncio
+
+class AggregateCursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FindCursor(AggregateCursor):
+    """记录find之后链式调用的sort和limit"""
+    def __init__(self, documents):
+        super().__init__(documents)
+        self.calls = []
+
+    def sort(self, *args):
+        self.calls.append(("sort", args))
+        return self
+
+    def limit(self, limit):
+        self.calls.append(("limit", limit))
+        return self
+
+    async def to_list(self, length=None):
+        return [document async for document in self]
+
+class StubMessages:
+    def __init__(self, documents):
+        self.documents = documents
+        self.pipelines = []
+        self.finds = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return AggregateCursor(self.documents)
+
+    def find(self, query, projection=None):
+        cursor = FindCursor(self.documents)
+        self.finds.append((query, cursor))
+        return cursor
+
+class StubDatabase:
+    def __init__(self, documents):
+        self.messages = StubMessages(documents)
+
+async def test_get_context_reads_pinned_and_recent_in_one_query(monkeypatch):
+    # $unionWith的结果：先是设定消息，再是倒序的最新消息（短对话中包含设定消息本身）
+    documents = [
+        {"seq": 1, "role": "user", "content": "设定", "hidden": True},
+        {"seq": 4, "role": "assistant", "content": "d"},
+        {"seq": 3, "role": "user", "content": "c"},
+        {"seq": 2, "role": "assistant", "content": "b"},
+        {"seq": 1, "role": "user", "content": "设定", "hidden": True},
+    ]
+    stub = StubDatabase(documents)
+    monkeypatch.setattr(db, "db", stub)
+
+    pinned, recent = await message_store.get_context("chat", 10, after_seq=0)
+
+    assert len(stub.messages.pipelines) == 1
+    pipeline = stub.messages.pipelines[0]
+    assert pipeline[0] == {"$match": {"chat_id": "chat", "hidden": True}}
+    union = pipeline[1]["$unionWith"]
+    assert union["pipeline"][0] == {"$match": {"chat_id": "chat", "seq": {"$gt": 0}}}
+    assert union["pipeline"][-1] == {"$limit": 10}
+    assert [message["seq"] for message in pinned] == [1]
+    assert [message["seq"] for message in recent] == [2, 3, 4]
+
+async def test_search_takes_the_newest_candidates(monkeypatch):
+    stub = StubDatabase([{"chat_id": "chat", "seq": 3, "role": "user", "content": "学习"}])
+    monkeypatch.setattr(db, "db", stub)
+
+    candidates = await message_store.search("u", ["学习"], 200)
+
+    query, cursor = stub.messages.finds[0]
+    assert query["terms"] == {"$all": ["学习"]}
+    # 先按时间倒序再截断，候选集合是确定的，而不是任意200条
+    assert cursor.calls == [("sort", ("timestamp", -1)), ("limit", 200)]
+    assert [candidate["seq"] for candidate in candidates] == [3]
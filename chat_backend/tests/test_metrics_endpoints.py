@@ -0,0 +1,31 @@
+"""
+运维接口的访问控制：/metrics下的接口只对METRICS_ADMIN_USERS中的用户开放
+"""
+import pytest
+from fastapi import HTTPException
+from app.config import settings
+from app.api.endpoints import metrics as metrics_endpoints
+from app.auth.dependencies import get_admin_user
+
+pytestmark = pytest.mark.asyncio
+
+async def test_regular_user_is_forbidden(monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_ADMIN_USERS", ["ops"])
+    with pytest.raises(HTTPException) as raised:
+        await get_admin_user({"_id": "u", "username": "alice"})
+    assert raised.value.status_code == 403
+
+async def test_nobody_is_allowed_by_default(monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_ADMIN_USERS", [])
+    with pytest.raises(HTTPException):
+        await get_admin_user({"_id": "u", "username": "ops"})
+
+async def test_listed_user_is_allowed(monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_ADMIN_USERS", ["ops"])
+    user = {"_id": "u", "username": "ops"}
+    assert await get_admin_user(user) is user
+
+async def test_every_metrics_route_requires_admin():
+    for route in metrics_endpoints.router.routes:
+        calls = [dependency.call for dependency in route.dependant.dependencies]
+        assert get_admin_user in calls, route.path
@@ -0,0 +1,242 @@
+"""
+ModelLimiter的测试：并发上限、排队已满、等待超时，以及名额转交后请求被取消时归还名额
+"""
+import asyncio
+import pytest
+from app.services.concurrency import ModelLimiter, AIServiceBusyError
+
+pytestmark = pytest.mark.asyncio
+
+async def settle():
+    """让已就绪的任务都运行到下一个等待点"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+class Holder:
+    """在任务中持有一个名额，直到调用finish"""
+    def __init__(self, limiter: ModelLimiter, priority: str = "interactive", log: list = None, name: str = None):
+        self.done = asyncio.Event()
+        self.entered = False
+        self.log = log if log is not None else []
+        self.name = name or priority
+        self.task = asyncio.ensure_future(self._run(limiter, priority))
+
+    async def _run(self, limiter, priority):
+        async with limiter.acquire(priority):
+            self.entered = True
+            self.log.append(self.name)
+            await self.done.wait()
+
+    def finish(self):
+        self.done.set()
+
+async def test_admits_up_to_max_concurrency_then_queues_in_order():
+    limiter = ModelLimiter("m", 2, 10, 5)
+    log = []
+    holders = [Holder(limiter, log=log, name=str(i)) for i in range(4)]
+    await settle()
+    assert log == ["0", "1"]
+    assert limiter.stats()["active"] == 2
+    assert limiter.stats()["queue_depth"] == 2
+
+    holders[0].finish()
+    await settle()
+    assert log == ["0", "1", "2"]
+    # 名额直接转交，活跃数不变
+    assert limiter.stats()["active"] == 2
+
+    for holder in holders:
+        holder.finish()
+    await asyncio.gather(*(holder.task for holder in holders))
+    stats = limiter.stats()
+    assert stats["active"] == 0 and stats["queue_depth"] == 0 and stats["admitted"] == 4
+
+async def test_rejects_when_queue_is_full():
+    limiter = ModelLimiter("m", 1, 1, 5)
+    first, second = Holder(limiter), Holder(limiter)
+    await settle()
+    with pytest.raises(AIServiceBusyError, match="请求过多"):
+        async with limiter.acquire():
+            pass
+    assert limiter.stats()["rejected"] == 1
+
+    first.finish()
+    second.finish()
+    await asyncio.gather(first.task, second.task)
+    assert limiter.stats()["active"] == 0
+
+async def test_times_out_and_leaves_the_queue():
+    limiter = ModelLimiter("m", 1, 10, 0.05)
+    holder = Holder(limiter)
+    await settle()
+    with pytest.raises(AIServiceBusyError, match="超时"):
+        async with limiter.acquire():
+            pass
+    stats = limiter.stats()
+    assert stats["timeouts"] == 1
+    assert stats["queue_depth"] == 0
+
+    holder.finish()
+    await holder.task
+    assert limiter.stats()["active"] == 0
+
+async def test_cancelled_waiter_does_not_take_a_slot():
+    limiter = ModelLimiter("m", 1, 10, 5)
+    log = []
+    holder = Holder(limiter, log=log, name="holder")
+    waiting = Holder(limiter, log=log, name="cancelled")
+    after = Holder(limiter, log=log, name="after")
+    await settle()
+    waiting.task.cancel()
+    await settle()
+    assert limiter.stats()["queue_depth"] == 1
+
+    holder.finish()
+    await settle()
+    assert log == ["holder", "after"]
+    after.finish()
+    await after.task
+    assert limiter.stats()["active"] == 0
+
+async def test_slot_handed_to_cancelled_waiter_is_returned():
+    limiter = ModelLimiter("m", 1, 10, 5)
+    log = []
+    await limiter._acquire("interactive")
+    handed = Holder(limiter, log=log, name="handed")
+    after = Holder(limiter, log=log, name="after")
+    await settle()
+
+    # 释放时名额转交给handed，在它恢复运行之前取消：名额要继续转交给after，而不是泄漏或被handed使用
+    limiter._release("interactive")
+    handed.task.cancel()
+    await settle()
+    assert handed.task.cancelled()
+    assert log == ["after"]
+    assert limiter.stats()["active"] == 1
+
+    after.finish()
+    await after.task
+    stats = limiter.stats()
+    assert stats["active"] == 0 and stats["queue_depth"] == 0
+
+async def run_queued(limiter, priorities, log):
+    """排队一组拿到名额后立即释放的请求，返回它们的任务"""
+    async def job(priority):
+        async with limiter.acquire(priority):
+            log.append(priority)
+    tasks = [asyncio.ensure_future(job(priority)) for priority in priorities]
+    await settle()
+    return tasks
+
+async def test_reserved_slots_only_serve_interactive():
+    limiter = ModelLimiter("m", 3, 10, 5, reserved=1)
+    background = [Holder(limiter, "background") for _ in range(3)]
+    await settle()
+    assert [holder.entered for holder in background] == [True, True, False]
+
+    interactive = Holder(limiter, "interactive")
+    await settle()
+    assert interactive.entered
+    stats = limiter.stats()
+    assert stats["reserved_for_interactive"] == 1
+    assert stats["priorities"]["background"]["active"] == 2
+    assert stats["priorities"]["background"]["queue_depth"] == 1
+
+    for holder in background + [interactive]:
+        holder.finish()
+    await asyncio.gather(*(holder.task for holder in background + [interactive]))
+    assert limiter.stats()["active"] == 0
+
+async def test_reserved_never_takes_the_last_slot():
+    limiter = ModelLimiter("m", 1, 10, 5, reserved=1)
+    assert limiter.reserved == 0
+    async with limiter.acquire("batch"):
+        pass
+
+async def test_freed_slot_goes_to_interactive_before_earlier_background():
+    limiter = ModelLimiter("m", 2, 10, 5, reserved=1)
+    log = []
+    holders = [Holder(limiter, "interactive"), Holder(limiter, "background")]
+    await settle()
+    tasks = await run_queued(limiter, ["background", "background"], log)
+    tasks += await run_queued(limiter, ["interactive", "interactive"], log)
+    assert log == []
+
+    holders[1].finish()
+    await settle()
+    assert log == ["interactive", "interactive", "background", "background"]
+    holders[0].finish()
+    await asyncio.gather(*tasks, *(holder.task for holder in holders))
+
+async def test_background_and_batch_share_by_weight():
+    limiter = ModelLimiter("m", 2, 100, 5, reserved=1, weights={"background": 3, "batch": 1})
+    log = []
+    blocker = Holder(limiter, "batch")
+    await settle()
+    tasks = await run_queued(limiter, ["batch"] * 8 + ["background"] * 8, log)
+
+    blocker.finish()
+    await asyncio.gather(*tasks, blocker.task)
+    assert log[:8].count("background") == 6
+    assert log[:8].count("batch") == 2
+
+async def test_idle_class_does_not_bank_its_share():
+    limiter = ModelLimiter("m", 2, 100, 5, reserved=1, weights={"background": 1, "batch": 1})
+    # background单独运行很多次，虚拟时间不断增加
+    for _ in range(10):
+        async with limiter.acquire("background"):
+            pass
+    background_pass = limiter._pass["background"]
+    assert background_pass == 10
+
+    log = []
+    blocker = Holder(limiter, "background")
+    await settle()
+    tasks = await run_queued(limiter, ["batch"] * 4 + ["background"] * 4, log)
+    # 空闲的batch从繁忙类别的虚拟时间开始，而不是从0开始连续获得10个名额
+    assert limiter._pass["batch"] >= background_pass
+
+    blocker.finish()
+    await asyncio.gather(*tasks, blocker.task)
+    assert log[:4].count("background") == 2
+
+async def test_aged_background_competes_with_interactive_by_arrival():
+    for aging, expected in [(float("inf"), ["interactive", "background"]), (0, ["background", "interactive"])]:
+        limiter = ModelLimiter("m", 2, 10, 5, reserved=1, aging=aging)
+        log = []
+        holders = [Holder(limiter, "interactive"), Holder(limiter, "interactive")]
+        await settle()
+        tasks = await run_queued(limiter, ["background"], log)
+        tasks += await run_queued(limiter, ["interactive"], log)
+
+        holders[0].finish()
+        await settle()
+        holders[1].finish()
+        await asyncio.gather(*tasks, *(holder.task for holder in holders))
+        assert log == expected
+        assert limiter.stats()["aged"] == (1 if aging == 0 else 0)
+
+async def test_queue_limit_is_per_priority():
+    limiter = ModelLimiter("m", 2, 1, 5, reserved=1)
+    holders = [Holder(limiter, "interactive"), Holder(limiter, "background"), Holder(limiter, "background")]
+    await settle()
+    with pytest.raises(AIServiceBusyError):
+        async with limiter.acquire("background"):
+            pass
+
+    # 后台队列已满不影响interactive排队
+    interactive = Holder(limiter, "interactive")
+    await settle()
+    assert limiter.stats()["priorities"]["interactive"]["queue_depth"] == 1
+    for holder in holders + [interactive]:
+        holder.finish()
+    await asyncio.gather(*(holder.task for holder in holders + [interactive]))
+    assert interactive.entered
+    assert limiter.stats()["active"] == 0
+
+async def test_unknown_priority_is_rejected():
+    limiter = ModelLimiter("m", 1, 1, 5)
+    with pytest.raises(ValueError):
+        async with limiter.acquire("urgent"):
+            pass
+    assert limiter.stats()["active"] == 0
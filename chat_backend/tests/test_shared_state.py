@@ -0,0 +1,153 @@
+"""
+共享状态后端的测试：MemoryBackend的存取、计数、锁和广播，以及RedisBackend在Redis出错时的行为（使用替身客户端，不需要Redis）
+"""
+import asyncio
+import pytest
+from app.services import shared_state
+from app.services.shared_state import SharedBackend, MemoryBackend, MemoryStore, RedisBackend
+
+pytestmark = pytest.mark.asyncio
+
+async def test_get_set_delete_with_ttl():
+    backend = MemoryBackend()
+    assert await backend.get("k") is None
+    await backend.set("k", "v")
+    assert await backend.get("k") == "v"
+    await backend.delete("k")
+    assert await backend.get("k") is None
+
+    await backend.set("short", "v", ttl=0.01)
+    await asyncio.sleep(0.02)
+    assert await backend.get("short") is None
+
+async def test_incr_counts_until_the_window_expires():
+    backend = MemoryBackend()
+    assert [await backend.incr("c", 0.05) for _ in range(3)] == [1, 2, 3]
+    await asyncio.sleep(0.06)
+    # 过期时间从首次创建算起，不会被后续的计数延长
+    assert await backend.incr("c", 0.05) == 1
+
+async def test_lock_is_exclusive_and_released_only_by_its_owner():
+    store = MemoryStore()
+    first, second = MemoryBackend(store), MemoryBackend(store)
+    assert await first.acquire_lock("lock", "a", 5)
+    assert not await second.acquire_lock("lock", "b", 5)
+
+    await second.release_lock("lock", "b")
+    assert not await second.acquire_lock("lock", "b", 5)
+    await first.release_lock("lock", "a")
+    assert await second.acquire_lock("lock", "b", 5)
+
+async def test_lock_expires_after_ttl():
+    backend = MemoryBackend()
+    assert await backend.acquire_lock("lock", "a", 0.01)
+    await asyncio.sleep(0.02)
+    assert await backend.acquire_lock("lock", "b", 5)
+
+async def test_publish_reaches_every_backend_sharing_the_store():
+    store = MemoryStore()
+    first, second = MemoryBackend(store), MemoryBackend(store)
+    assert first.distributed and not MemoryBackend().distributed
+    received = {"first": [], "second": []}
+
+    async def on_first(message):
+        received["first"].append(message)
+
+    async def on_second(message):
+        received["second"].append(message)
+
+    first.subscribe("invalidate", on_first)
+    second.subscribe("invalidate", on_second)
+    await first.publish("invalidate", {"chat_id": "c", "origin": "first"})
+    await first.publish("other", {"chat_id": "c"})
+    assert received == {"first": [{"chat_id": "c", "origin": "first"}], "second": [{"chat_id": "c", "origin": "first"}]}
+
+    await second.close()
+    await first.publish("invalidate", {"chat_id": "d"})
+    assert len(received["second"]) == 1
+
+async def test_failing_handler_does_not_stop_other_handlers():
+    backend = MemoryBackend()
+    received = []
+
+    async def broken(message):
+        raise RuntimeError("boom")
+
+    async def working(message):
+        received.append(message)
+
+    backend.subscribe("invalidate", broken)
+    backend.subscribe("invalidate", working)
+    await backend.publish("invalidate", {"chat_id": "c"})
+    assert received == [{"chat_id": "c"}]
+    assert backend.stats()["errors"] == 1
+
+async def test_incomplete_backend_cannot_be_instantiated():
+    class GetOnly(SharedBackend):
+        async def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnly()
+
+class FailingClient:
+    """所有命令都因连接断开而失败的Redis客户端"""
+    async def set(self, *args, **kwargs):
+        raise ConnectionError("connection refused")
+
+    async def get(self, *args, **kwargs):
+        raise ConnectionError("connection refused")
+
+class EndingPubSub:
+    """listen()每次都立即正常结束，模拟订阅被服务端取消"""
+    def __init__(self, times):
+        self.times = times
+        self.subscribed = True
+        self.subscribes = 0
+
+    async def subscribe(self, *channels):
+        self.subscribes += 1
+        self.subscribed = True
+
+    async def listen(self):
+        self.times.append(asyncio.get_running_loop().time())
+        self.subscribed = False
+        if len(self.times) == 4:
+            raise asyncio.CancelledError
+        return
+        yield
+
+def redis_backend(client) -> RedisBackend:
+    # 不导入redis包，直接使用替身客户端
+    backend = RedisBackend.__new__(RedisBackend)
+    SharedBackend.__init__(backend)
+    backend.client = client
+    backend._pubsub = None
+    backend._listener = None
+    return backend
+
+async def test_redis_lock_fails_closed():
+    backend = redis_backend(FailingClient())
+    assert await backend.get("k") is None
+    assert not await backend.acquire_lock("lock", "a", 5)
+    assert backend.stats()["errors"] == 2
+
+async def test_redis_listener_backs_off_and_resets_after_subscription_ends(monkeypatch):
+    monkeypatch.setattr(shared_state, "SUBSCRIBE_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(shared_state, "SUBSCRIBE_RETRY_MAX_DELAY", 0.02)
+    backend = redis_backend(FailingClient())
+    resets = []
+
+    async def on_message(message):
+        resets.append(message)
+
+    backend.subscribe("invalidate", on_message)
+    times = []
+    backend._pubsub = EndingPubSub(times)
+    with pytest.raises(asyncio.CancelledError):
+        await backend._listen()
+
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert gaps[0] >= 0.01 and gaps[1] >= 0.02 and gaps[2] >= 0.02
+    assert backend._pubsub.subscribes == 3
+    assert resets == [{"reset": True}] * 3
@@ -0,0 +1,203 @@
+"""
+SingleFlight的测试：相同请求合并为一次调用、阻塞与流式调用互相加入、等待者取消，以及通过共享锁跨进程合并
+"""
+import asyncio
+import pytest
+from app.services.shared_state import MemoryBackend, MemoryStore
+from app.services.single_flight import SingleFlight
+
+pytestmark = pytest.mark.asyncio
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+class Upstream:
+    """模拟上游调用：记录调用次数，在release之前不返回，记录是否被取消"""
+    def __init__(self, chunks=("你", "好")):
+        self.chunks = list(chunks)
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+
+    async def complete(self):
+        self.calls += 1
+        self.started.set()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return "".join(self.chunks)
+
+    async def stream(self):
+        self.calls += 1
+        self.started.set()
+        try:
+            for index, chunk in enumerate(self.chunks):
+                if index:
+                    await self.release.wait()
+                yield chunk
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+async def collect(iterator):
+    return [chunk async for chunk in iterator]
+
+async def test_concurrent_calls_share_one_upstream_call():
+    flights = SingleFlight()
+    upstream = Upstream()
+    tasks = [asyncio.ensure_future(flights.do("k", upstream.complete)) for _ in range(3)]
+    await settle()
+    upstream.release.set()
+    assert await asyncio.gather(*tasks) == ["你好"] * 3
+    assert upstream.calls == 1
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 2, "remote_coalesced": 0, "cancelled": 0}
+
+async def test_error_reaches_every_waiter():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise RuntimeError("upstream failed")
+
+    results = await asyncio.gather(*(flights.do("k", fail) for _ in range(2)), return_exceptions=True)
+    assert [str(result) for result in results] == ["upstream failed"] * 2
+    assert flights.stats()["in_flight"] == 0
+
+async def test_blocking_call_joins_a_stream():
+    flights = SingleFlight()
+    upstream = Upstream()
+    streaming = asyncio.ensure_future(collect(flights.stream("k", upstream.stream)))
+    await settle()
+    blocking = asyncio.ensure_future(flights.do("k", upstream.complete))
+    await settle()
+
+    upstream.release.set()
+    assert await streaming == ["你", "好"]
+    assert await blocking == "你好"
+    assert upstream.calls == 1
+
+async def test_stream_joins_a_blocking_call_and_late_subscribers_replay():
+    flights = SingleFlight()
+    upstream = Upstream()
+    blocking = asyncio.ensure_future(flights.do("k", upstream.complete))
+    await settle()
+    # 加入阻塞调用的流式请求一次性收到完整结果
+    streaming = asyncio.ensure_future(collect(flights.stream("k", upstream.stream)))
+    await settle()
+    upstream.release.set()
+    assert await blocking == "你好"
+    assert await streaming == ["你好"]
+    assert upstream.calls == 1
+
+    # 流式调用进行中加入的订阅者先补发已有内容
+    upstream = Upstream()
+    first = asyncio.ensure_future(collect(flights.stream("s", upstream.stream)))
+    await settle()
+    second = asyncio.ensure_future(collect(flights.stream("s", upstream.stream)))
+    await settle()
+    upstream.release.set()
+    assert await first == await second == ["你", "好"]
+    assert upstream.calls == 1
+
+async def test_cancelled_waiter_does_not_cancel_the_others():
+    flights = SingleFlight()
+    upstream = Upstream()
+    leaving = asyncio.ensure_future(flights.do("k", upstream.complete))
+    staying = asyncio.ensure_future(flights.do("k", upstream.complete))
+    await settle()
+
+    leaving.cancel()
+    await settle()
+    assert upstream.cancelled == 0
+    upstream.release.set()
+    assert await staying == "你好"
+    assert flights.stats()["cancelled"] == 0
+
+async def test_upstream_cancelled_when_every_waiter_leaves():
+    flights = SingleFlight()
+    upstream = Upstream()
+    tasks = [asyncio.ensure_future(flights.do("k", upstream.complete)) for _ in range(2)]
+    await settle()
+    for task in tasks:
+        task.cancel()
+    await settle()
+    assert upstream.cancelled == 1
+    assert flights.stats()["cancelled"] == 1
+    assert flights.stats()["in_flight"] == 0
+
+async def test_stream_cancelled_when_every_subscriber_leaves():
+    flights = SingleFlight()
+    upstream = Upstream()
+    subscribers = [flights.stream("k", upstream.stream) for _ in range(2)]
+    for subscriber in subscribers:
+        assert await subscriber.__anext__() == "你"
+
+    await subscribers[0].aclose()
+    await settle()
+    assert upstream.cancelled == 0
+    await subscribers[1].aclose()
+    await settle()
+    assert upstream.cancelled == 1
+    assert flights.stats()["cancelled"] == 1
+    assert flights.stats()["in_flight"] == 0
+
+async def test_calls_in_different_processes_share_the_result():
+    store = MemoryStore()
+    # 两个进程各自的SingleFlight，连接到同一个共享存储
+    first = SingleFlight(MemoryBackend(store), lock_ttl=5, poll_interval=0.001)
+    second = SingleFlight(MemoryBackend(store), lock_ttl=5, poll_interval=0.001)
+    upstream = Upstream()
+    leader = asyncio.ensure_future(first.do("k", upstream.complete))
+    await upstream.started.wait()
+    follower = asyncio.ensure_future(second.do("k", upstream.complete))
+    await asyncio.sleep(0.01)
+    assert upstream.calls == 1
+
+    upstream.release.set()
+    assert await leader == await follower == "你好"
+    assert upstream.calls == 1
+    assert second.stats()["remote_coalesced"] == 1
+
+async def test_follower_calls_upstream_itself_when_the_leader_fails():
+    store = MemoryStore()
+    first = SingleFlight(MemoryBackend(store), lock_ttl=5, poll_interval=0.001)
+    second = SingleFlight(MemoryBackend(store), lock_ttl=5, poll_interval=0.001)
+    started, fail = asyncio.Event(), asyncio.Event()
+
+    async def failing():
+        started.set()
+        await fail.wait()
+        raise RuntimeError("upstream failed")
+
+    async def working():
+        return "你好"
+
+    leader = asyncio.ensure_future(first.do("k", failing))
+    await started.wait()
+    follower = asyncio.ensure_future(second.do("k", working))
+    await asyncio.sleep(0.01)
+    assert not follower.done()
+
+    fail.set()
+    with pytest.raises(RuntimeError):
+        await leader
+    # 锁已释放但没有结果，跟随者自己调用
+    assert await follower == "你好"
+    assert second.stats()["remote_coalesced"] == 0
+
+async def test_refused_lock_without_holder_calls_upstream():
+    class RefusingBackend(MemoryBackend):
+        """加锁总是失败，例如共享后端不可用"""
+        async def acquire_lock(self, key, token, ttl):
+            return False
+
+    flights = SingleFlight(RefusingBackend(MemoryStore()), lock_ttl=5, poll_interval=0.001)
+
+    async def working():
+        return "你好"
+
+    assert await flights.do("k", working) == "你好"
@@ -0,0 +1,21 @@
+"""
+聊天记录搜索分词的测试
+"""
+from app.services.text_search import tokenize, query_terms
+
+def test_tokenize_indexes_every_distinct_term_of_a_long_message():
+    words = [f"word{index}" for index in range(2000)]
+    text = " ".join(words) + " 结尾的中文"
+    terms = tokenize(text)
+    assert len(terms) == len(set(terms))
+    # 长消息末尾的内容同样可以被搜索到
+    assert "word1999" in terms
+    assert all(term in terms for term in query_terms("结尾的中文"))
+
+def test_tokenize_splits_chinese_into_chars_and_bigrams():
+    assert tokenize("学习Python，学习") == ["学", "学习", "习", "python"]
+
+def test_tokenize_cap_keeps_the_first_terms():
+    text = " ".join(f"word{index}" for index in range(10))
+    assert tokenize(text, max_terms=3) == ["word0", "word1", "word2"]
+    assert len(tokenize("一二三四五六", max_terms=4)) == 4
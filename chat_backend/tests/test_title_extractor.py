@@ -0,0 +1,54 @@
+"""
+本地标题抽取的测试：未安装jieba（或词典尚未加载）时使用的按虚词切分，以及安装jieba时的分词
+"""
+import pytest
+from app.services import title_extractor
+from app.services.title_extractor import extract_title
+
+SAMPLES = [
+    "你好，请问如何学习Python？",
+    "我想了解一下机器学习和深度学习之间的区别以及它们各自的应用场景",
+    "帮我看看这段代码 `x=1` 为什么报错",
+    "https://example.com 这个网站打不开怎么办",
+    "解释一下Python中的装饰器是怎么工作的",
+]
+# 去掉虚词后仍然超长，截断会丢掉主题，交给AI生成
+TOO_LONG = [
+    "请帮我写一个用Python读取Excel文件并把其中的数据按照日期汇总后导出成CSV的脚本",
+    "Can you explain the difference between TCP and UDP?",
+    "如何在Ubuntu 22.04上安装CUDA 12并配置PyTorch的GPU环境",
+]
+
+@pytest.fixture(params=["fallback", "jieba"])
+def segmenter(request, monkeypatch):
+    if request.param == "fallback":
+        monkeypatch.setattr(title_extractor, "jieba", None)
+    else:
+        pytest.importorskip("jieba")
+        title_extractor.warm_up()
+    return request.param
+
+def test_titles_fit_and_keep_the_topic(segmenter):
+    for text in SAMPLES:
+        title = extract_title(text)
+        assert title and 2 <= len(title) <= 20, text
+    assert extract_title(SAMPLES[0]) == "如何学习Python"
+    assert extract_title(SAMPLES[3]) == "这个网站打不开怎么办"
+
+def test_titles_that_would_lose_their_subject_are_left_to_the_llm(segmenter):
+    for text in TOO_LONG:
+        assert extract_title(text) is None, text
+
+@pytest.mark.parametrize("text", ["你好", "谢谢！", "hi", "在吗？", "```python\nprint(1)\n```", "  "])
+def test_greetings_and_code_only_messages_have_no_title(segmenter, text):
+    assert extract_title(text) is None
+
+def test_fallback_drops_function_words_when_compressing(monkeypatch):
+    monkeypatch.setattr(title_extractor, "jieba", None)
+    assert extract_title(SAMPLES[1]) == "机器学习深度学习之间区别各自应用场景"
+    assert extract_title(SAMPLES[4]) == "解释Python中装饰器怎么工作"
+
+def test_respects_max_length(segmenter):
+    for text in SAMPLES + TOO_LONG:
+        title = extract_title(text, max_length=8)
+        assert title is None or len(title) <= 8
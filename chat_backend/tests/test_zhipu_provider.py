@@ -0,0 +1,151 @@
+"""
+ZhipuProvider对接本地aiohttp桩服务的测试：非流式补全、SSE流式解析、错误和超时的映射
+"""
+import json
+import asyncio
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from app.services.providers.zhipu import ZhipuProvider, ZhipuAPIError
+from app.services.resilience import is_retryable
+
+pytestmark = pytest.mark.asyncio
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+async def start_stub(handler):
+    """在随机端口启动只有/chat/completions一个接口的桩服务，返回(runner, base_url)"""
+    app = web.Application()
+    app.router.add_post("/chat/completions", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+@pytest_asyncio.fixture
+async def stub():
+    """用法：provider = await stub(handler, **provider参数)"""
+    runners, providers = [], []
+
+    async def create(handler, **options):
+        runner, base_url = await start_stub(handler)
+        runners.append(runner)
+        provider = ZhipuProvider("stub-key", base_url, **options)
+        providers.append(provider)
+        return provider
+
+    yield create
+    for provider in providers:
+        await provider.close()
+    for runner in runners:
+        await runner.cleanup()
+
+async def test_create_completion_returns_content(stub):
+    received = {}
+
+    async def handler(request):
+        received["auth"] = request.headers["Authorization"]
+        received["payload"] = await request.json()
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": "你好！"}}]})
+
+    provider = await stub(handler)
+    assert await provider.create_completion("glm-4", MESSAGES, temperature=0.7) == "你好！"
+    # 非"id.secret"格式的密钥原样作为令牌
+    assert received["auth"] == "Bearer stub-key"
+    assert received["payload"] == {"model": "glm-4", "messages": MESSAGES, "temperature": 0.7}
+
+async def test_create_completion_rejects_malformed_response(stub):
+    async def handler(request):
+        return web.json_response({"choices": []})
+
+    provider = await stub(handler)
+    with pytest.raises(ZhipuAPIError, match="无法解析"):
+        await provider.create_completion("glm-4", MESSAGES)
+
+async def test_stream_completion_parses_sse(stub):
+    async def handler(request):
+        assert (await request.json())["stream"] is True
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        events = [
+            ": keep-alive",
+            "data: " + json.dumps({"choices": [{"delta": {"role": "assistant"}}]}),
+            "data: " + json.dumps({"choices": [{"delta": {"content": "你"}}]}),
+            "",
+            "data: " + json.dumps({"choices": [{"delta": {"content": "好"}}]}),
+            "data: [DONE]",
+            "data: " + json.dumps({"choices": [{"delta": {"content": "不应出现"}}]}),
+        ]
+        for event in events:
+            await response.write((event + "\n").encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    provider = await stub(handler)
+    deltas = [delta async for delta in provider.stream_completion("glm-4", MESSAGES)]
+    assert deltas == ["你", "好"]
+
+async def test_http_error_maps_to_status(stub):
+    async def handler(request):
+        return web.Response(status=500, text="upstream failed")
+
+    provider = await stub(handler)
+    with pytest.raises(ZhipuAPIError) as server_error:
+        await provider.create_completion("glm-4", MESSAGES)
+    assert server_error.value.status == 500
+    assert "upstream failed" in str(server_error.value)
+    assert is_retryable(server_error.value)
+
+    with pytest.raises(ZhipuAPIError) as stream_error:
+        async for _ in provider.stream_completion("glm-4", MESSAGES):
+            pass
+    assert stream_error.value.status == 500
+
+async def test_client_error_is_not_retryable(stub):
+    async def handler(request):
+        return web.Response(status=400, text="bad request")
+
+    provider = await stub(handler)
+    with pytest.raises(ZhipuAPIError) as error:
+        await provider.create_completion("glm-4", MESSAGES)
+    assert error.value.status == 400
+    assert not is_retryable(error.value)
+
+async def test_timeout_maps_to_retryable_error(stub):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return web.json_response({"choices": [{"message": {"content": "late"}}]})
+
+    provider = await stub(handler, timeout=0.1)
+    with pytest.raises(ZhipuAPIError, match="请求超时") as error:
+        await provider.create_completion("glm-4", MESSAGES)
+    assert error.value.status is None
+    assert is_retryable(error.value)
+
+async def test_stream_read_timeout_between_chunks(stub):
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(("data: " + json.dumps({"choices": [{"delta": {"content": "a"}}]}) + "\n").encode())
+        await asyncio.sleep(1)
+        return response
+
+    provider = await stub(handler, read_timeout=0.1)
+    deltas = []
+    with pytest.raises(ZhipuAPIError, match="请求超时"):
+        async for delta in provider.stream_completion("glm-4", MESSAGES):
+            deltas.append(delta)
+    assert deltas == ["a"]
+
+async def test_connection_error_maps_to_retryable_error():
+    # 没有服务监听的端口
+    provider = ZhipuProvider("stub-key", "http://127.0.0.1:9", connect_timeout=1)
+    try:
+        with pytest.raises(ZhipuAPIError) as error:
+            await provider.create_completion("glm-4", MESSAGES)
+        assert error.value.status is None
+        assert is_retryable(error.value)
+    finally:
+        await provider.close()